@@ -0,0 +1,5 @@
+# mcp/__init__.py
+# 包导入即开始记录启动耗时（模块导入、启动阶段、首个请求），见 mcp/startup.py
+from .startup import startup_profile
+
+startup_profile.install_import_timer()
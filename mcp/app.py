@@ -1,18 +1,19 @@
 # mcp/app.py
-from fastapi import FastAPI, HTTPException, Query,Depends
-from fastapi.responses import JSONResponse,HTMLResponse
+from fastapi import FastAPI, HTTPException, Query,Depends, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse,HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from datetime import datetime, date, time as dtime, timedelta, date as _date
 from zoneinfo import ZoneInfo
-from sqlalchemy import text, and_, or_,case
+from sqlalchemy import text, and_, or_,case, func, select, bindparam
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from shared.models import OutgoingQueue
-from threading import Thread, Event
-from typing import Optional, Any, List, Dict
+from typing import Optional, Any, List, Dict, Literal
 import logging
 import asyncio
 import json
-import requests
 import time
 
 # Schema 导入（请确保 shared/schemas.py 已经定义以下类）
@@ -42,17 +43,64 @@ class OpenWindowCreate(BaseModel):
 # ORM 导入（请确保 shared/models.py 已正确定义）
 from shared.models import (
     User, Message, Memo, Notice, School,
-    OpenWindow, NoticeType, Class, DailyQuote, UserRole, Grade, parent_students
+    OpenWindow, NoticeType, Class, DailyQuote, UserRole, Grade, parent_students, FanoutJob
 )
-from .db import init_db, SessionLocal, get_user_id_from_external_id, get_class_id_from_class_code
-from werkzeug.security import generate_password_hash, check_password_hash
+from .db import (
+    init_db, ENGINE_SETTINGS, SessionLocal, get_db, get_read_db, get_async_db, run_db, async_engine,
+    get_user_id_from_external_id, get_class_id_from_class_code,
+    pool_status, route_db_stats, warm_up_pool, note_writer,
+    external_id_cache, class_code_cache, lookup_cache_stats,
+)
+from .notify import notify_hub, install_session_hooks
+from .counters import (
+    install_counter_hooks, lock_queue_rows, settle_pending, pending_count,
+    rebuild_pending_counters,
+)
+from .outgoing import (
+    claim_due, next_visible_at, terminal_owner, POLL_LEASE_SECONDS,
+    get_or_create_payload, resolve_payloads, row_payload, enqueue_deduped,
+    list_order, keyset_filter, encode_list_cursor, decode_list_cursor, estimate_count,
+)
+from .delivery import DeliveryEngine
+from .retention import RetentionManager
+from .fanout import FanoutWorker, create_job, job_to_dict
+from .openwindows import open_window_schedule
+from .quotes import DailyQuoteScheduler
+from .leader import LeaderElector
+from .roster import roster_cache
+from .reminders import cancel_memo_reminder, reschedule_class, schedule_memo_reminder, sweep_day
+from .startup import FirstRequestMiddleware, startup_profile
+
+
+def generate_password_hash(password: str) -> str:
+    # werkzeug 只在注册 / 登录时用到，首次调用时再导入，不拖慢 worker 启动
+    from werkzeug.security import generate_password_hash as _generate
+    return _generate(password)
+
+
+def check_password_hash(pwhash: str, password: str) -> bool:
+    from werkzeug.security import check_password_hash as _check
+    return _check(pwhash, password)
+
 
 app = FastAPI(title="Campus Assistant MCP API")
+app.add_middleware(FirstRequestMiddleware, profile=startup_profile)
+
+
+@app.on_event("startup")
+def _init_schema():
+    # 建表 / 补列不在导入时执行（每个 worker 启动、每次 --reload 都会做一轮 DDL 检查）：
+    # 部署时先执行 python -m mcp.db init；本地需要时可设 DB_INIT_ON_STARTUP=1
+    if ENGINE_SETTINGS["init_on_startup"]:
+        init_db()
+        startup_profile.mark("init_db")
 
-# 初始化数据库（create_all 已在 db.init_db 中实现）
-init_db()
+# outgoing_queue 入队提交后唤醒对应用户的长轮询
+install_session_hooks()
+# ORM 入队时同步维护未投递计数
+install_counter_hooks()
 
-BG_LOOP_SLEEP = 30  # 秒；开发阶段短些
+BG_LOOP_SLEEP = 300  # 秒；memo 提醒在写入时计算，后台循环只做兜底补齐
 
 # 全局时区：北京时间
 TZ = ZoneInfo("Asia/Shanghai")
@@ -80,16 +128,18 @@ if not logger.handlers:
     logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
-# 配置
-DELIVERY_POLL_INTERVAL = 5  # 秒，轮询间隔
-DELIVERY_MODE = "log"       # "log" 或 "http"
-DELIVERY_HTTP_CALLBACK: Optional[str] = None
-
-# 线程控制
-_delivery_thread: Optional[Thread] = None
-_delivery_stop_evt = Event()
-_delivery_started = False
-_delivery_lock = Event()
+# 投递引擎（配置见 /mcp/delivery/config；启停见 /mcp/delivery/start|stop）
+delivery_engine = DeliveryEngine(SessionLocal, lambda: now_sh_naive())
+# 已投递行的保留 / 归档（见 /mcp/retention/*）
+retention_manager = RetentionManager(SessionLocal, lambda: now_sh_naive())
+# 群发任务（通知 / 每日一句的按班级、按角色广播），见 /mcp/jobs/{id}
+fanout_worker = FanoutWorker(SessionLocal, lambda: now_sh_naive())
+# 每日一句定时广播（见 /mcp/scheduler/status）
+quote_scheduler = DailyQuoteScheduler(SessionLocal, lambda: now_sh_naive(),
+                                      lambda quote_id, day: _fire_daily_quote(quote_id, day))
+# 多 worker / 多实例时只有持有 scheduler 租约的进程运行 memo 提醒、每日一句定时器和保留清理；
+# 投递引擎与群发 worker 按行租约认领，每个进程都运行
+leader = LeaderElector(SessionLocal, lambda: now_sh_naive(), name="scheduler")
 
 # 基础命令模型（与 schemas 中的 Command 对应）
 class UserIdentifier(BaseModel):
@@ -127,9 +177,12 @@ class AckResponseModel(BaseModel):
 
 class OutgoingListResponseModel(BaseModel):
     status: str
-    page: int
+    page: Optional[int] = None
     size: int
-    total: int
+    total: Optional[int] = None
+    total_mode: str = "exact"
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
     items: List[OutgoingItemModel] = []
 
 
@@ -166,78 +219,9 @@ def parse_hm_to_time(hm: str) -> dtime:
 def is_now_within_open_windows_for_student(db, student_user_id: int) -> bool:
     """
     支持跨午夜时段判断（Asia/Shanghai）。
-    逻辑参见注释。
+    查编译好的“一周分钟位图”缓存（见 mcp/openwindows.py），缓存命中时不访问数据库。
     """
-    user = db.get(User, student_user_id)
-    if not user:
-        return False
-
-    class_id = None
-    for attr in ("class_id", "managed_class_id"):
-        if hasattr(user, attr):
-            val = getattr(user, attr)
-            if val:
-                class_id = val
-                break
-
-    if class_id is None:
-        try:
-            res = db.execute(text("SELECT class_id FROM class_students WHERE student_id = :sid LIMIT 1"), {"sid": student_user_id})
-            row = res.fetchone()
-            if row:
-                class_id = row[0]
-        except Exception:
-            class_id = None
-
-    if class_id is None:
-        return False
-
-    rows = db.query(OpenWindow).filter(OpenWindow.class_id == int(class_id)).all()
-    if not rows:
-        return False
-
-    tz = TZ
-    now = datetime.now(tz)
-    now_time = now.time()
-    weekday_map = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-    today_name = weekday_map[now.weekday()]
-    yesterday_name = weekday_map[(now.weekday() - 1) % 7]
-
-    for w in rows:
-        days = w.days_json or []
-        if isinstance(days, str):
-            try:
-                days = json.loads(days)
-            except Exception:
-                days = []
-        days_list = days if days else []
-
-        try:
-            start_t = parse_hm_to_time(w.start_time)
-            end_t = parse_hm_to_time(w.end_time)
-        except Exception:
-            continue
-
-        if start_t == end_t:
-            if days_list and today_name not in days_list:
-                continue
-            return True
-
-        if start_t < end_t:
-            if days_list and today_name not in days_list:
-                continue
-            if start_t <= now_time <= end_t:
-                return True
-            else:
-                continue
-
-        # 跨午夜
-        if (not days_list or today_name in days_list) and (now_time >= start_t):
-            return True
-        if (not days_list or yesterday_name in days_list) and (now_time <= end_t):
-            return True
-
-    return False
+    return open_window_schedule.user_open_at(db, student_user_id, datetime.now(TZ))
 
 # -------------------- Outgoing queue helper --------------------
 def enqueue_message_for_terminal(db_session, msg: Message, priority_override: Optional[str] = None):
@@ -299,39 +283,86 @@ def enqueue_notice_for_class(db_session, notice_obj: Notice, target_class: Optio
 
     created_user_ids = []
 
-    q = db_session.query(User)
     if target_class is not None:
         try:
-            cid = int(target_class)
-            q = q.filter(User.class_id == cid)
+            user_ids = roster_cache.member_ids(db_session, int(target_class))
         except Exception:
             return created_user_ids
     elif target_role is not None:
         try:
-            q = q.filter(User.role == target_role)
+            user_ids = db_session.execute(select(User.id).where(User.role == target_role)).scalars().all()
         except Exception:
             return created_user_ids
     else:
         # 默认不广播所有用户（安全）
         return created_user_ids
 
-    users = q.all()
-    for u in users:
+    # 内容只存一份，每个接收者一行引用
+    payload_id = get_or_create_payload(db_session, payload, now_sh_naive())
+    for uid in user_ids:
         oq = OutgoingQueue(
-            target_user_id=int(u.id),
-            payload=payload,
+            target_user_id=int(uid),
+            payload_id=payload_id,
             priority=priority,
             deliver_after=deliver_after,
             created_at=now_sh_naive()
         )
         db_session.add(oq)
-        created_user_ids.append(u.id)
+        created_user_ids.append(uid)
 
     return created_user_ids
 
+def daily_quote_dedupe_key(day_iso: str, quote_id: int, user_id: int) -> str:
+    """每日一句的幂等键：日期在前，便于按天前缀统计（见 admin_stats）。"""
+    return f"dq:{day_iso}:{int(quote_id)}:{int(user_id)}"
+
+def enqueue_daily_quote(db, q: DailyQuote, day_iso: str) -> int:
+    """
+    把一条 daily_quote 入队给其班级的所有用户（不提交）。
+    同一天同一用户同一条只入队一次（定时触发、手动触发重复执行都幂等），返回实际入队条数。
+    """
+    class_id = q.class_id
+    if not class_id:
+        return 0
+    user_ids = roster_cache.member_ids(db, class_id)
+    if not user_ids:
+        return 0
+    payload = {
+        "type": "daily_quote",
+        "text": q.content,
+        "voice_url": q.voice_url,
+        "class_id": class_id,
+        "quote_id": q.id
+    }
+    payload_id = get_or_create_payload(db, payload, now_sh_naive())
+    return enqueue_deduped(db, [{
+        "target_user_id": int(uid),
+        "payload_id": payload_id,
+        "priority": "normal",
+        "deliver_after": None,
+        "created_at": now_sh_naive(),
+        "dedupe_key": daily_quote_dedupe_key(day_iso, q.id, uid),
+    } for uid in user_ids])
+
+def _fire_daily_quote(quote_id: int, day: date) -> int:
+    """定时器触发：按计划日期入队一条 quote（在线程池中执行）。"""
+    db = SessionLocal()
+    try:
+        q = db.get(DailyQuote, quote_id)
+        if not q or not q.active:
+            return 0
+        n = enqueue_daily_quote(db, q, day.isoformat())
+        db.commit()
+        return n
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
 # -------------- helper: 将符合条件的 daily_quotes 入队（一次性执行） --------------
 async def enqueue_daily_quotes_once():
-    """把当前北京时间对应 minute 的 daily_quote 入队（一次性执行）。"""
+    """把当前北京时间对应 minute 的 daily_quote 入队（一次性执行，手动触发用；定时广播见 quote_scheduler）。"""
     db = SessionLocal()
     try:
         now_sh = datetime.now(TZ)
@@ -344,29 +375,10 @@ async def enqueue_daily_quotes_once():
         if not quotes:
             return {"status": "no_quotes", "checked_time": hm, "count": 0}
 
+        today_iso = now_sh.date().isoformat()
         enqueue_count = 0
         for q in quotes:
-            class_id = q.class_id
-            if not class_id:
-                continue
-            students = db.query(User).filter(User.class_id == int(class_id)).all()
-            for s in students:
-                payload = {
-                    "type": "daily_quote",
-                    "text": q.content,
-                    "voice_url": q.voice_url,
-                    "class_id": class_id,
-                    "quote_id": q.id
-                }
-                out = OutgoingQueue(
-                    target_user_id=int(s.id),
-                    payload=payload,
-                    priority="normal",
-                    deliver_after=None,
-                    created_at=now_sh_naive()
-                )
-                db.add(out)
-                enqueue_count += 1
+            enqueue_count += enqueue_daily_quote(db, q, today_iso)
         db.commit()
         return {"status": "enqueued", "time": hm, "enqueued": enqueue_count}
     except Exception as e:
@@ -374,7 +386,7 @@ async def enqueue_daily_quotes_once():
         return {"status": "error", "detail": str(e)}
     finally:
         db.close()
-        
+
 def sanitize_payload(obj):
     """
     递归把 payload 中的 datetime / date 转为 ISO 字符串，保留其他可序列化类型。
@@ -404,392 +416,231 @@ def sanitize_payload(obj):
         pass
     return obj
 
+def outgoing_item_to_dict(r: OutgoingQueue, payloads: Optional[Dict[int, Dict[str, Any]]] = None) -> dict:
+    """
+    把 OutgoingQueue 行转为 OutgoingItemModel 结构（poll / stream / list 共用）。
+    payloads 为 resolve_payloads 批量取回的共享内容，引用型行从中取 payload。
+    """
+    return {
+        "id": r.id,
+        "target_user_id": r.target_user_id,
+        # 深度清洗 payload，保证 JSON 可序列化
+        "payload": sanitize_payload(row_payload(r, payloads or {})),
+        "priority": r.priority,
+        # 返回带时区的 ISO 字符串（对模型中的时间字段做转换）
+        "deliver_after": iso_tz(r.deliver_after),
+        "delivered": bool(r.delivered),
+        "created_at": iso_tz(r.created_at),
+        "delivered_at": iso_tz(r.delivered_at)
+    }
+
+
+# get_messages 的查询预先构造（参数用 bindparam 传入），不再每次重建 ORM Query
+_MESSAGES_FOR_RECEIVER = (
+    select(Message).where(Message.receiver_id == bindparam("receiver_id")).order_by(Message.timestamp.desc())
+)
+_USERNAMES_BY_ID = select(User.id, User.username).where(User.id.in_(bindparam("ids", expanding=True)))
+
 
 # -------------------- 主路由：统一的 MCP 命令入口 --------------------
-@app.post("/mcp/command")
-async def handle_mcp(cmd: Command):
-    db = SessionLocal()
-    try:
-        # ---------------- leave_message (始终允许) ----------------
-        if cmd.command == "leave_message":
-            leave_cmd = LeaveMessageCommand(**cmd.dict())
-            try:
-                # 规范化 timestamp：若来自外部含 tz，先转到北京时间再去掉 tz 存入 DB（naive）
-                ts = leave_cmd.timestamp
-                if ts is None:
-                    ts_naive = now_sh_naive()
-                else:
-                    if ts.tzinfo is None:
-                        ts = ts.replace(tzinfo=TZ)
-                    ts_naive = ts.astimezone(TZ).replace(tzinfo=None)
-
-                sender_id = get_user_id_from_external_id(db, leave_cmd.user_id) or int(leave_cmd.user_id)
-                receiver_id = get_user_id_from_external_id(db, leave_cmd.context.receiver_id) or int(leave_cmd.context.receiver_id)
-
-                if not sender_id or not receiver_id:
-                    raise HTTPException(status_code=404, detail="Sender or receiver not found")
-
-                msg = Message(
-                    sender_id=sender_id,
-                    receiver_id=receiver_id,
-                    content=leave_cmd.context.content,
-                    audio_url=getattr(leave_cmd.context, "audio_url", None),
-                    priority=NoticeType(leave_cmd.context.priority),
-                    timestamp=ts_naive,
-                )
-                db.add(msg)
-                db.flush()
-                # 把 message 加入 outgoing queue（入队函数会设 created_at/deliver_after）
-                enqueue_message_for_terminal(db, msg)
-                db.commit()
-                db.refresh(msg)
-                return LeaveMessageResponse(status="success", message_id=msg.id, detail=None)
-            except Exception as e:
-                db.rollback()
-                return LeaveMessageResponse(status="error", message_id=None, detail=str(e))
-
-        # ---------------- get_messages (受限：学生仅开放时段) ----------------
-        elif cmd.command == "get_messages":
-            get_cmd = GetMessagesCommand(**cmd.dict())
-            user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
-            if not user_id:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            if cmd.role == "student":
-                if not is_now_within_open_windows_for_student(db, user_id):
-                    return GetMessagesResponse(status="error", messages=[], detail="Not within open time window")
-            try:
-                rows = db.query(Message).filter(Message.receiver_id == user_id).order_by(Message.timestamp.desc()).all()
-                
-                sender_ids = {m.sender_id for m in rows}
-                senders = db.query(User).filter(User.id.in_(sender_ids)).all()
-                sender_map = {s.id: s.username for s in senders}
-
-                items = [
-                    {
-                        "id": m.id,
-                        "sender_id": str(m.sender_id),
-                        "name": sender_map.get(m.sender_id, "Unknown"),
-                        "content": m.content,
-                        "audio_url": m.audio_url,
-                        "priority": m.priority.value if hasattr(m.priority, "value") else str(m.priority),
-                        "timestamp": iso_tz(m.timestamp)
-                    } for m in rows
-                ]
-                return {"status": "success", "messages": items, "detail": None}
-            except Exception as e:
-                return {"status": "error", "messages": [], "detail": str(e)}
-
-        # ---------------- play_audio (受限：学生仅开放时段) ----------------
-        elif cmd.command == "play_audio":
-            play_cmd = PlayAudioCommand(**cmd.dict())
-            user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
-            if not user_id:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            if cmd.role == "student":
-                if not is_now_within_open_windows_for_student(db, user_id):
-                    return PlayAudioResponse(status="error", audio_url=None, detail="Not within open time window")
-            try:
-                msg = db.get(Message, play_cmd.context.message_id)
-                if not msg or not msg.audio_url:
-                    return PlayAudioResponse(status="error", audio_url=None, detail="No audio available")
-                return PlayAudioResponse(status="success", audio_url=msg.audio_url, detail=None)
-            except Exception as e:
-                return PlayAudioResponse(status="error", audio_url=None, detail=str(e))
-
-        # ---------------- add_memo (受限：学生仅开放时段) ----------------
-        elif cmd.command == "add_memo":
-            add_cmd = AddMemoCommand(**cmd.dict())
-            user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
-            if not user_id:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            if cmd.role == "student":
-                if not is_now_within_open_windows_for_student(db, user_id):
-                    return AddMemoResponse(status="error", memo_id=None, detail="Not within open time window")
-            try:
-                remind_date = add_cmd.context.remind_date
-                # 如果是 datetime -> 把其转到北京时区再取 date
-                if isinstance(remind_date, datetime):
-                    if remind_date.tzinfo is None:
-                        remind_date = remind_date.replace(tzinfo=TZ)
-                    remind_date = remind_date.astimezone(TZ).date()
-
-                memo = Memo(
-                    student_id=user_id,
-                    content=add_cmd.context.content,
-                    remind_date=remind_date
-                )
-                db.add(memo)
-                db.commit()
-                db.refresh(memo)
-                return AddMemoResponse(status="success", memo_id=memo.id, detail=None)
-            except Exception as e:
-                db.rollback()
-                return AddMemoResponse(status="error", memo_id=None, detail=str(e))
-
-        # ---------------- confirm_memo (受限：学生仅开放时段) ----------------
-        elif cmd.command == "confirm_memo":
-            confirm_cmd = ConfirmMemoCommand(**cmd.dict())
-            user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
-            if not user_id:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            if cmd.role == "student":
-                if not is_now_within_open_windows_for_student(db, user_id):
-                    return ConfirmMemoResponse(status="error", detail="Not within open time window")
-            try:
-                memo = db.get(Memo, confirm_cmd.context.memo_id)
-                if not memo:
-                    return ConfirmMemoResponse(status="error", detail="Memo not found")
-                db.delete(memo)
-                db.commit()
-                return ConfirmMemoResponse(status="success", detail=None)
-            except Exception as e:
-                db.rollback()
-                return ConfirmMemoResponse(status="error", detail=str(e))
-
-        # ---------------- get_today_memo (受限：学生仅开放时段) ----------------
-        elif cmd.command == "get_today_memo":
-            get_cmd = GetTodayMemoCommand(**cmd.dict())
-            user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
-            if not user_id:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            if cmd.role == "student":
-                if not is_now_within_open_windows_for_student(db, user_id):
-                    return GetTodayMemoResponse(status="error", memos=[], detail="Not within open time window")
-            try:
-                today = datetime.now(TZ).date()
-                rows = db.query(Memo).filter(Memo.student_id == user_id, Memo.remind_date == today).all()
-                items = [{"id": m.id, "content": m.content, "remind_date": m.remind_date} for m in rows]
-                return GetTodayMemoResponse(status="success", memos=items, detail=None)
-            except Exception as e:
-                return GetTodayMemoResponse(status="error", memos=[], detail=str(e))
+def _handle_command(db: Session, cmd: Command):
+    # ---------------- leave_message (始终允许) ----------------
+    if cmd.command == "leave_message":
+        leave_cmd = LeaveMessageCommand(**cmd.dict())
+        try:
+            # 规范化 timestamp：若来自外部含 tz，先转到北京时间再去掉 tz 存入 DB（naive）
+            ts = leave_cmd.timestamp
+            if ts is None:
+                ts_naive = now_sh_naive()
+            else:
+                if ts.tzinfo is None:
+                    ts = ts.replace(tzinfo=TZ)
+                ts_naive = ts.astimezone(TZ).replace(tzinfo=None)
+
+            sender_id = get_user_id_from_external_id(db, leave_cmd.user_id) or int(leave_cmd.user_id)
+            receiver_id = get_user_id_from_external_id(db, leave_cmd.context.receiver_id) or int(leave_cmd.context.receiver_id)
+
+            if not sender_id or not receiver_id:
+                raise HTTPException(status_code=404, detail="Sender or receiver not found")
+
+            msg = Message(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=leave_cmd.context.content,
+                audio_url=getattr(leave_cmd.context, "audio_url", None),
+                priority=NoticeType(leave_cmd.context.priority),
+                timestamp=ts_naive,
+            )
+            db.add(msg)
+            db.flush()
+            # 把 message 加入 outgoing queue（入队函数会设 created_at/deliver_after）
+            enqueue_message_for_terminal(db, msg)
+            db.commit()
+            db.refresh(msg)
+            return LeaveMessageResponse(status="success", message_id=msg.id, detail=None)
+        except Exception as e:
+            db.rollback()
+            return LeaveMessageResponse(status="error", message_id=None, detail=str(e))
 
-        else:
-            raise HTTPException(status_code=400, detail=f"Unsupported command: {cmd.command}")
+    # ---------------- get_messages (受限：学生仅开放时段) ----------------
+    elif cmd.command == "get_messages":
+        get_cmd = GetMessagesCommand(**cmd.dict())
+        user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
+        if not user_id:
+            raise HTTPException(status_code=404, detail="User not found")
 
-    finally:
-        db.close()
+        if cmd.role == "student":
+            if not is_now_within_open_windows_for_student(db, user_id):
+                return GetMessagesResponse(status="error", messages=[], detail="Not within open time window")
+        try:
+            rows = db.execute(_MESSAGES_FOR_RECEIVER, {"receiver_id": user_id}).scalars().all()
+            
+            sender_ids = {m.sender_id for m in rows}
+            sender_map = dict(db.execute(_USERNAMES_BY_ID, {"ids": list(sender_ids)}).all()) if sender_ids else {}
+
+            items = [
+                {
+                    "id": m.id,
+                    "sender_id": str(m.sender_id),
+                    "name": sender_map.get(m.sender_id, "Unknown"),
+                    "content": m.content,
+                    "audio_url": m.audio_url,
+                    "priority": m.priority.value if hasattr(m.priority, "value") else str(m.priority),
+                    "timestamp": iso_tz(m.timestamp)
+                } for m in rows
+            ]
+            return {"status": "success", "messages": items, "detail": None}
+        except Exception as e:
+            return {"status": "error", "messages": [], "detail": str(e)}
 
-# -------------------- 后台调度与入队循环 --------------------
-async def background_scheduler_loop():
-    """长期运行的调度循环：检查 memo reminders 与 daily quotes（已加强去重与北京时间一致性）。"""
-    tz = TZ
-    while True:
+    # ---------------- play_audio (受限：学生仅开放时段) ----------------
+    elif cmd.command == "play_audio":
+        play_cmd = PlayAudioCommand(**cmd.dict())
+        user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
+        if not user_id:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        if cmd.role == "student":
+            if not is_now_within_open_windows_for_student(db, user_id):
+                return PlayAudioResponse(status="error", audio_url=None, detail="Not within open time window")
         try:
-            db = SessionLocal()
-            now_sh = datetime.now(tz)
-            today = now_sh.date()
-            now_time = now_sh.time()
-
-            # 为当天范围做 naive 时间边界（与 DB 中存储的 naive 北京时间一致）
-            start_today_naive = datetime(today.year, today.month, today.day)
-            start_tomorrow_naive = start_today_naive + timedelta(days=1)
-
-            # -------------------- 1) memo 提醒 --------------------
-            memos = db.query(Memo).filter(Memo.remind_date == today).all()
-            # 内存集合：避免同一循环内重复入队
-            created_set = set()
-            for m in memos:
-                # 找学生与班级
-                student = db.get(User, int(m.student_id))
-                class_id = None
-                if student:
-                    class_id = getattr(student, "class_id", None) or getattr(student, "managed_class_id", None)
-                if not class_id:
-                    continue
+            msg = db.get(Message, play_cmd.context.message_id)
+            if not msg or not msg.audio_url:
+                return PlayAudioResponse(status="error", audio_url=None, detail="No audio available")
+            return PlayAudioResponse(status="success", audio_url=msg.audio_url, detail=None)
+        except Exception as e:
+            return PlayAudioResponse(status="error", audio_url=None, detail=str(e))
 
-                open_windows = db.query(OpenWindow).filter(OpenWindow.class_id == int(class_id)).all()
-                if not open_windows:
-                    continue
+    # ---------------- add_memo (受限：学生仅开放时段) ----------------
+    elif cmd.command == "add_memo":
+        add_cmd = AddMemoCommand(**cmd.dict())
+        user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
+        if not user_id:
+            raise HTTPException(status_code=404, detail="User not found")
 
-                for w in open_windows:
-                    # 解析 start/end（兼容字符串或 time-like）
-                    try:
-                        st = parse_hm_to_time(w.start_time)
-                        et = parse_hm_to_time(w.end_time)
-                    except Exception:
-                        # 忽略此窗口配置
-                        continue
-
-                    # days_json 解析
-                    days = w.days_json or []
-                    if isinstance(days, str):
-                        try:
-                            days = json.loads(days)
-                        except Exception:
-                            days = []
-                    days_list = days if days else []
-
-                    # 判断是否在窗口内（含跨午夜）
-                    in_window = False
-                    if st == et:
-                        in_window = True
-                    elif st < et:
-                        in_window = (st <= now_time <= et)
-                    else:
-                        # 跨午夜：若现在 >= start 或 now <= end 则匹配
-                        if now_time >= st or now_time <= et:
-                            in_window = True
-
-                    # 如果配置了 days 并且今天不在其中 -> 跳过
-                    weekday_map = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-                    today_name = weekday_map[now_sh.weekday()]
-                    if days_list and (today_name not in days_list):
-                        in_window = False
-
-                    if not in_window:
-                        continue
-
-                    # 内存去重 key
-                    key = (int(m.student_id), int(m.id), int(w.id))
-                    if key in created_set:
-                        continue
-
-                    # DB 去重：按 target_user_id + payload contains + 当天 created_at 范围
-                    try:
-                        exists = db.query(OutgoingQueue).filter(
-                            OutgoingQueue.target_user_id == int(m.student_id),
-                            OutgoingQueue.payload.contains({
-                                "type": "memo_reminder",
-                                "memo_id": m.id,
-                                "open_window_id": w.id
-                            }),
-                            OutgoingQueue.created_at >= start_today_naive,
-                            OutgoingQueue.created_at < start_tomorrow_naive
-                        ).first()
-                    except Exception:
-                        # 若数据库无法支持 JSON contains 或者报错，则退回到只按 target_user_id + payload.contains 的判断（尽量保守）
-                        try:
-                            exists = db.query(OutgoingQueue).filter(
-                                OutgoingQueue.target_user_id == int(m.student_id),
-                                OutgoingQueue.payload.contains({
-                                    "type": "memo_reminder",
-                                    "memo_id": m.id,
-                                    "open_window_id": w.id
-                                })
-                            ).first()
-                        except Exception:
-                            exists = None
-
-                    if exists:
-                        continue
-
-                    # 入队（使用北京时间 naive 存 created_at / deliver_after）
-                    oq = OutgoingQueue(
-                        target_user_id=int(m.student_id),
-                        payload={
-                            "type": "memo_reminder",
-                            "memo_id": m.id,
-                            "open_window_id": w.id,
-                            "content": m.content,
-                        },
-                        priority="normal",
-                        deliver_after=now_sh_naive(),
-                        created_at=now_sh_naive()
-                    )
-                    db.add(oq)
-                    created_set.add(key)
+        if cmd.role == "student":
+            if not is_now_within_open_windows_for_student(db, user_id):
+                return AddMemoResponse(status="error", memo_id=None, detail="Not within open time window")
+        try:
+            remind_date = add_cmd.context.remind_date
+            # 如果是 datetime -> 把其转到北京时区再取 date
+            if isinstance(remind_date, datetime):
+                if remind_date.tzinfo is None:
+                    remind_date = remind_date.replace(tzinfo=TZ)
+                remind_date = remind_date.astimezone(TZ).date()
+
+            memo = Memo(
+                student_id=user_id,
+                content=add_cmd.context.content,
+                remind_date=remind_date
+            )
+            db.add(memo)
+            db.flush()
+            # 按开放时段算好提醒时间，与 memo 同一事务入队
+            schedule_memo_reminder(db, memo, now_sh_naive())
+            db.commit()
+            db.refresh(memo)
+            return AddMemoResponse(status="success", memo_id=memo.id, detail=None)
+        except Exception as e:
+            db.rollback()
+            return AddMemoResponse(status="error", memo_id=None, detail=str(e))
 
-            # 如果有新增则 commit 一次
-            if created_set:
-                try:
-                    db.commit()
-                except Exception:
-                    db.rollback()
-                    logger.exception("Failed to commit memo reminders")
+    # ---------------- confirm_memo (受限：学生仅开放时段) ----------------
+    elif cmd.command == "confirm_memo":
+        confirm_cmd = ConfirmMemoCommand(**cmd.dict())
+        user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
+        if not user_id:
+            raise HTTPException(status_code=404, detail="User not found")
 
-            # -------------------- 2) 每日鸡汤：按 broadcast_time 入队（按分钟匹配） --------------------
-            try:
-                dq_rows = db.execute(text("SELECT id, class_id, content, broadcast_time FROM daily_quotes WHERE active=1")).fetchall()
-            except Exception:
-                dq_rows = []
+        if cmd.role == "student":
+            if not is_now_within_open_windows_for_student(db, user_id):
+                return ConfirmMemoResponse(status="error", detail="Not within open time window")
+        try:
+            memo = db.get(Memo, confirm_cmd.context.memo_id)
+            if not memo:
+                return ConfirmMemoResponse(status="error", detail="Memo not found")
+            cancel_memo_reminder(db, memo)
+            db.delete(memo)
+            db.commit()
+            return ConfirmMemoResponse(status="success", detail=None)
+        except Exception as e:
+            db.rollback()
+            return ConfirmMemoResponse(status="error", detail=str(e))
 
-            daily_created_set = set()
-            for dq in dq_rows:
-                try:
-                    scheduled_hm = dq["broadcast_time"]
-                    sh = dtime.fromisoformat(scheduled_hm)
-                except Exception:
-                    continue
+    # ---------------- get_today_memo (受限：学生仅开放时段) ----------------
+    elif cmd.command == "get_today_memo":
+        get_cmd = GetTodayMemoCommand(**cmd.dict())
+        user_id = get_user_id_from_external_id(db, cmd.user_id) or int(cmd.user_id)
+        if not user_id:
+            raise HTTPException(status_code=404, detail="User not found")
 
-                # 在同一分钟匹配
-                if now_time.hour == sh.hour and now_time.minute == sh.minute:
-                    # 为每个目标用户去重并入队
-                    try:
-                        users = db.query(User).filter(User.class_id == int(dq["class_id"])).all()
-                    except Exception:
-                        users = []
+        if cmd.role == "student":
+            if not is_now_within_open_windows_for_student(db, user_id):
+                return GetTodayMemoResponse(status="error", memos=[], detail="Not within open time window")
+        try:
+            today = datetime.now(TZ).date()
+            rows = db.query(Memo).filter(Memo.student_id == user_id, Memo.remind_date == today).all()
+            items = [{"id": m.id, "content": m.content, "remind_date": m.remind_date} for m in rows]
+            return GetTodayMemoResponse(status="success", memos=items, detail=None)
+        except Exception as e:
+            return GetTodayMemoResponse(status="error", memos=[], detail=str(e))
 
-                    for u in users:
-                        key = (int(u.id), int(dq["id"]))
-                        if key in daily_created_set:
-                            continue
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported command: {cmd.command}")
 
-                        # DB 去重：按 target_user_id + payload contains + 当天 created_at 范围
-                        try:
-                            exists = db.query(OutgoingQueue).filter(
-                                OutgoingQueue.target_user_id == int(u.id),
-                                OutgoingQueue.payload.contains({
-                                    "type": "daily_quote",
-                                    "quote_id": dq["id"],
-                                    "date": today.isoformat()
-                                }),
-                                OutgoingQueue.created_at >= start_today_naive,
-                                OutgoingQueue.created_at < start_tomorrow_naive
-                            ).first()
-                        except Exception:
-                            try:
-                                exists = db.query(OutgoingQueue).filter(
-                                    OutgoingQueue.target_user_id == int(u.id),
-                                    OutgoingQueue.payload.contains({
-                                        "type": "daily_quote",
-                                        "quote_id": dq["id"],
-                                        "date": today.isoformat()
-                                    })
-                                ).first()
-                            except Exception:
-                                exists = None
-
-                        if exists:
-                            continue
-
-                        oq = OutgoingQueue(
-                            target_user_id=int(u.id),
-                            payload={
-                                "type": "daily_quote",
-                                "quote_id": int(dq["id"]),
-                                "content": dq["content"],
-                                "date": today.isoformat()
-                            },
-                            priority="normal",
-                            deliver_after=now_sh_naive(),
-                            created_at=now_sh_naive()
-                        )
-                        db.add(oq)
-                        daily_created_set.add(key)
-
-            if daily_created_set:
-                try:
-                    db.commit()
-                except Exception:
-                    db.rollback()
-                    logger.exception("Failed to commit daily_quote enqueues")
+@app.post("/mcp/command")
+async def handle_mcp(cmd: Command, adb: AsyncSession = Depends(get_async_db)):
+    # 命令处理是同步写法的 ORM 代码，经 run_sync 在异步会话上执行，数据库 I/O 不阻塞事件循环
+    return await adb.run_sync(_handle_command, cmd)
+
+
+# -------------------- 后台调度与入队循环 --------------------
+def _sweep_memo_reminders() -> int:
+    db = SessionLocal()
+    try:
+        now = now_sh_naive()
+        swept = sweep_day(db, now.date(), now)
+        db.commit()
+        return swept
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
+async def background_scheduler_loop():
+    """
+    memo 提醒的兜底循环：提醒在 add_memo / 开放时段变更时已按开放时段计算入队（见 mcp/reminders.py），
+    这里只为当天还没有提醒的 memo 补算（每日一句由 quote_scheduler 按计划时间广播）。
+    """
+    while True:
+        try:
+            swept = await run_in_threadpool(_sweep_memo_reminders)
+            if swept:
+                logger.info("Memo reminder sweep scheduled %s memos", swept)
         except Exception as e:
             # 记录错误但不要让循环停止
-            try:
-                logger.exception("Scheduler error: %s", str(e))
-            except Exception:
-                pass
-        finally:
-            try:
-                db.close()
-            except Exception:
-                pass
+            logger.exception("Scheduler error: %s", str(e))
 
         await asyncio.sleep(BG_LOOP_SLEEP)
 
@@ -825,78 +676,8 @@ def _find_daily_quote_for_class(db, class_id: int):
     )
     return q
 
-def _deliver_due_once():
-    """运行一次投递扫描并尝试投递到目标（同步）。所有时间比较以北京时间 naive 为准。"""
-    db = SessionLocal()
-    try:
-        now_naive = now_sh_naive()
-        due_rows = db.query(OutgoingQueue).filter(
-            OutgoingQueue.delivered == False,
-            or_(
-                OutgoingQueue.deliver_after == None,
-                OutgoingQueue.deliver_after <= now_naive
-            )
-        ).order_by(OutgoingQueue.priority.desc(), OutgoingQueue.created_at.asc()).limit(50).all()
-
-        if not due_rows:
-            return {"count": 0}
-
-        processed = []
-        for r in due_rows:
-            payload = r.payload or {}
-            queue_id = r.id
-            success = False
-            err = None
-            if DELIVERY_MODE == "http" and DELIVERY_HTTP_CALLBACK:
-                try:
-                    resp = requests.post(DELIVERY_HTTP_CALLBACK, json={
-                        "queue_id": queue_id,
-                        "target_user_id": r.target_user_id,
-                        "payload": payload
-                    }, timeout=5)
-                    success = 200 <= resp.status_code < 300
-                    if not success:
-                        err = f"callback_status:{resp.status_code}"
-                except Exception as e:
-                    err = str(e)
-                    success = False
-            else:
-                logger.info("Deliver (log-mode) queue_id=%s target_user=%s payload=%s", queue_id, r.target_user_id, payload)
-                success = True
-
-            if success:
-                try:
-                    # 标记为已投递（使用北京时间 naive 存入 DB）
-                    r.delivered = True
-                    r.delivered_at = now_naive
-                    db.add(r)
-                    db.commit()
-                    processed.append(queue_id)
-                except Exception as e:
-                    db.rollback()
-                    logger.exception("commit failed for queue_id=%s", queue_id)
-            else:
-                logger.warning("Delivery failed queue_id=%s: %s", queue_id, err)
-
-        return {"count": len(processed), "processed": processed}
-    finally:
-        db.close()
-
-def _delivery_loop(poll_interval: int = DELIVERY_POLL_INTERVAL):
-    logger.info("Delivery loop started (interval=%s)", poll_interval)
-    while not _delivery_stop_evt.wait(poll_interval):
-        try:
-            res = _deliver_due_once()
-            if res and res.get("count", 0) > 0:
-                logger.info("Delivered %d items: %s", res.get("count", 0), res.get("processed"))
-        except Exception:
-            logger.exception("Unhandled error in delivery loop")
-    logger.info("Delivery loop stopped")
-
 # -------------------- 单独的发布通知接口（教师/班主任用） --------------------
-@app.post("/mcp/notice", response_model=PostNoticeResponse)
-async def post_notice(cmd: PostNoticeCommand):
-    db = SessionLocal()
+def _post_notice(db: Session, cmd: PostNoticeCommand):
     try:
         # 规范化 timestamp 为 北京时间 naive 再存
         ts = cmd.timestamp
@@ -914,89 +695,63 @@ async def post_notice(cmd: PostNoticeCommand):
             timestamp=ts_naive
         )
         db.add(notice)
-        db.commit()
-        db.refresh(notice)
+        db.flush()
 
-        # 决定收件人列表
-        recipients = []
+        # 决定收件人范围（班级 / 角色，二者取并集；都没有则全体用户），由群发任务在后台分块入队
         tc = getattr(cmd.context, "target_class", None)
         tr = getattr(cmd.context, "target_role", None)
+        audience = {"class_ids": [], "roles": [], "combine": "or"}
 
         if tc:
             class_id = get_class_id_from_class_code(db, tc)
             if class_id:
-                users_q = db.query(User).filter(User.class_id == class_id).all()
+                audience["class_ids"].append(int(class_id))
             else:
                 try:
-                    class_id_int = int(tc)
-                    users_q = db.query(User).filter(User.class_id == class_id_int).all()
+                    audience["class_ids"].append(int(tc))
                 except Exception:
-                    users_q = db.query(User).join(Class).filter(Class.name == str(tc)).all()
-            recipients.extend(users_q)
+                    audience["class_ids"].extend(
+                        db.execute(select(Class.id).where(Class.name == str(tc))).scalars().all()
+                    )
+                    if not audience["class_ids"]:
+                        # 找不到班级时不应退化为全体广播
+                        audience["class_ids"].append(-1)
 
         if tr:
-            try:
-                role_enum = UserRole(tr)
-                users_by_role = db.query(User).filter(User.role == role_enum).all()
-            except Exception:
-                users_by_role = db.query(User).filter(User.role == tr).all()
-            for u in users_by_role:
-                if u not in recipients:
-                    recipients.append(u)
-
-        if not recipients:
-            recipients = db.query(User).all()
-
-        enqueued = 0
-        for u in recipients:
-            existing_rows = db.query(OutgoingQueue).filter(
-                OutgoingQueue.target_user_id == int(u.id),
-                OutgoingQueue.delivered == False
-            ).all()
-
-            skip = False
-            for ex in existing_rows:
-                try:
-                    nid = ex.payload.get("notice_id")
-                except Exception:
-                    nid = None
-                if nid is not None and str(nid) == str(notice.id):
-                    skip = True
-                    break
-            if skip:
-                continue
-
-            payload = {
-                "type": "notice",
-                "text": notice.content,
-                "notice_id": notice.id,
-                "creator_id": notice.creator_id,
-                "priority": notice.type.value if hasattr(notice.type, "value") else str(notice.type),
-                "timestamp": iso_tz(notice.timestamp)
-            }
-
-            oq = OutgoingQueue(
-                target_user_id=int(u.id),
-                payload=payload,
-                priority=payload["priority"] or "normal",
-                deliver_after=None,
-                created_at=now_sh_naive()
-            )
-            db.add(oq)
-            enqueued += 1
+            audience["roles"].append(str(tr))
+
+        payload = {
+            "type": "notice",
+            "text": notice.content,
+            "notice_id": notice.id,
+            "creator_id": notice.creator_id,
+            "priority": notice.type.value if hasattr(notice.type, "value") else str(notice.type),
+            "timestamp": iso_tz(notice.timestamp)
+        }
+        # 通知内容只存一份（ref_key 按 notice id），每个收件人一行引用
+        payload_id = get_or_create_payload(db, payload, now_sh_naive(), ref_key=f"notice:{notice.id}")
+        job = create_job(db, "notice", payload_id, audience, now_sh_naive(),
+                         priority=payload["priority"] or "normal", created_by=notice.creator_id)
 
         db.commit()
-        return PostNoticeResponse(status="success", notice_id=notice.id, detail=f"enqueued:{enqueued}")
+        fanout_worker.wake()
+        return PostNoticeResponse(status="success", notice_id=notice.id, job_id=job.id, detail="enqueued:0")
 
     except Exception as e:
         db.rollback()
         return PostNoticeResponse(status="error", notice_id=None, detail=str(e))
-    finally:
-        db.close()
+
+@app.post("/mcp/notice", response_model=PostNoticeResponse)
+async def post_notice(cmd: PostNoticeCommand, adb: AsyncSession = Depends(get_async_db)):
+    """
+    保存通知并创建群发任务，收件人由后台分块入队。
+    detail 保留原来的 "enqueued:N" 格式，但 N 只是本次请求内入队的行数（现在总是 0）；
+    实际入队 / 跳过数与进度见 GET /mcp/jobs/{job_id}。
+    """
+    return await adb.run_sync(_post_notice, cmd)
 
 @app.get("/mcp/debug_openwindow/{user_id}")
-def debug_openwindow(user_id: int):
-    db = SessionLocal()
+def debug_openwindow(user_id: int, db: Session = Depends(get_db)):
     try:
         # 当前时间（UTC 和 北京时间）
         now_utc = datetime.utcnow().isoformat() + "Z"
@@ -1033,15 +788,14 @@ def debug_openwindow(user_id: int):
             "user_info": user_info,
             "class_id_used": class_id,
             "open_windows_rows": rows,
-            "is_allowed": allowed
+            "is_allowed": allowed,
+            "schedule_cache": open_window_schedule.stats()
         }
     finally:
         db.close()
 
 # -------- POST /mcp/enqueue --------
-@app.post("/mcp/enqueue", response_model=EnqueueResponseModel, tags=["admin"])
-async def enqueue_item(item: dict):
-    db = SessionLocal()
+def _enqueue_item(db: Session, item: dict):
     try:
         tid = int(item.get("target_user_id"))
         payload = item.get("payload") or {}
@@ -1069,84 +823,208 @@ async def enqueue_item(item: dict):
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
+
+@app.post("/mcp/enqueue", response_model=EnqueueResponseModel, tags=["admin"])
+async def enqueue_item(item: dict, adb: AsyncSession = Depends(get_async_db)):
+    return await adb.run_sync(_enqueue_item, item)
 
 # -------- GET /mcp/poll --------
+POLL_BATCH_SIZE = 10
+
+def _fetch_due_for_user(db: Session, user_id: int, exclude_ids=None, limit: int = POLL_BATCH_SIZE):
+    """
+    为该用户的终端认领一批可投递项（exclude_ids：推送连接上已发出、尚未 ack 的 id）。
+    认领带租约，其它 worker / 投递线程不会在租约期内重复取到；未 ack 的项租约过期后重新可见。
+    无可投递项时顺带返回下一条可认领的时间，供长轮询决定最长等待时间。
+    由 run_db 调用（异步引擎上执行或退回线程池）。
+    """
+    # 使用北京时间 naive 与 DB 中的 naive 时间比较（与你代码风格保持一致）
+    now_naive = now_sh_naive()
+    owner = terminal_owner(user_id)
+    rows = claim_due(
+        db, owner, now_naive, limit, POLL_LEASE_SECONDS,
+        target_user_id=user_id, exclude_ids=exclude_ids
+    )
+    if rows:
+        payloads = resolve_payloads(db, rows)
+        items = [outgoing_item_to_dict(r, payloads) for r in rows]
+        db.commit()
+        return items, None
+
+    next_due = next_visible_at(db, owner, now_naive, user_id)
+    db.rollback()
+    return [], next_due
+
 @app.get("/mcp/poll")
 async def poll(user_id: int = Query(...), timeout: int = Query(0)):
     """
     Poll endpoint: 返回可投递项（已对 payload 做 sanitize，避免 datetime 等无法序列化导致 500）。
+    长轮询（timeout > 0）：进入时查询一次；没有可投递项就挂在 notify_hub 上等待，
+    直到该用户有新入队提交、最近的 deliver_after 到期或超时，等待期间不访问数据库。
     """
-    deadline = time.time() + max(0, int(timeout))
-    while True:
-        db = SessionLocal()
-        try:
-            # 使用北京时间 naive 与 DB 中的 naive 时间比较（与你代码风格保持一致）
-            now_naive = now_sh_naive()
-            rows = db.query(OutgoingQueue).filter(
-                OutgoingQueue.target_user_id == int(user_id),
-                OutgoingQueue.delivered == False,
-                or_(
-                    OutgoingQueue.deliver_after == None,
-                    OutgoingQueue.deliver_after <= now_naive
-                )
-            ).order_by(
-                OutgoingQueue.priority.desc(), OutgoingQueue.created_at.asc()
-            ).limit(10).all()
-            if rows:
-                items = []
-                for r in rows:
-                    # 深度清洗 payload，保证 JSON 可序列化
-                    raw_payload = r.payload or {}
-                    safe_payload = sanitize_payload(raw_payload)
-
-                    items.append({
-                        "id": r.id,
-                        "payload": safe_payload,
-                        "priority": r.priority,
-                        # 返回带时区的 ISO 字符串（对模型中的时间字段做转换）
-                        "created_at": iso_tz(r.created_at),
-                        "deliver_after": iso_tz(r.deliver_after)
-                    })
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(0, int(timeout))
+    # 先登记再查询：查询与等待之间到达的通知不会丢
+    with notify_hub.listen(int(user_id)) as listener:
+        while True:
+            items, next_due = await run_db(_fetch_due_for_user, int(user_id))
+            if items:
                 return {"status": "success", "items": items}
-        finally:
-            db.close()
 
-        if time.time() >= deadline:
-            return {"status": "success", "items": []}
-        time.sleep(0.8)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return {"status": "success", "items": []}
+            if next_due is not None:
+                until_due = (next_due - now_sh_naive()).total_seconds()
+                remaining = min(remaining, max(0.1, until_due))
+            await listener.wait(remaining)
 
 # -------- POST /mcp/ack --------
+def _ack_outgoing(db: Session, ids, user_id: Optional[int] = None) -> List[int]:
+    """把指定队列项标记为已投递；传 user_id 时只处理该用户自己的项（推送连接内 ack 用）。"""
+    try:
+        now_naive = now_sh_naive()
+        criteria = [OutgoingQueue.id.in_(ids)]
+        if user_id is not None:
+            criteria.append(OutgoingQueue.target_user_id == int(user_id))
+        # 先锁行再改：并发重复 ack 时只有第一个会扣减未投递计数
+        rows = lock_queue_rows(db, *criteria)
+        updated = [r.id for r in rows]
+        if updated:
+            db.query(OutgoingQueue).filter(OutgoingQueue.id.in_(updated)).update(
+                {OutgoingQueue.delivered: True, OutgoingQueue.delivered_at: now_naive},
+                synchronize_session=False
+            )
+            settle_pending(db, rows)
+        db.commit()
+        return updated
+    except Exception:
+        db.rollback()
+        raise
+
 @app.post("/mcp/ack", response_model=AckResponseModel, tags=["terminal"])
-def ack_items(body: dict):
+async def ack_items(body: dict, adb: AsyncSession = Depends(get_async_db)):
     ids = body.get("ids", [])
     if not ids:
         raise HTTPException(status_code=400, detail="ids required")
-    db = SessionLocal()
     try:
-        now_naive = now_sh_naive()
-        rows = db.query(OutgoingQueue).filter(OutgoingQueue.id.in_(ids)).all()
-        updated = []
-        for r in rows:
-            r.delivered = True
-            r.delivered_at = now_naive
-            updated.append(r.id)
-        db.commit()
-        return {"status": "success", "acked": updated}
+        return {"status": "success", "acked": await adb.run_sync(_ack_outgoing, ids)}
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
 
-@app.on_event("startup")
+# -------- /mcp/stream：服务端推送（WebSocket 双向 / SSE 单向） --------
+STREAM_BATCH_SIZE = 50
+STREAM_KEEPALIVE = 25     # 秒；空闲时发送心跳，防止中间代理断开
+STREAM_INFLIGHT_MAX = 500 # 已推送未 ack 的 id 超过该数量时，按库中实际状态收缩一次
+
+def _still_pending(db: Session, ids) -> set:
+    rows = db.query(OutgoingQueue.id).filter(
+        OutgoingQueue.id.in_(list(ids)),
+        OutgoingQueue.delivered == False
+    ).all()
+    return {r[0] for r in rows}
+
+class _StreamCursor:
+    """单条推送连接的状态：已推送未 ack 的 id，以及下一次最长等待时间。"""
+
+    def __init__(self, user_id: int):
+        self.user_id = int(user_id)
+        self.inflight: set = set()
+
+    async def next_batch(self):
+        if len(self.inflight) > STREAM_INFLIGHT_MAX:
+            # 通过 /mcp/ack 等其它途径确认的项不会回到连接上，这里顺手清掉
+            self.inflight = await run_db(_still_pending, self.inflight)
+        items, next_due = await run_db(
+            _fetch_due_for_user, self.user_id, self.inflight, STREAM_BATCH_SIZE
+        )
+        self.inflight.update(i["id"] for i in items)
+        wait = float(STREAM_KEEPALIVE)
+        if next_due is not None:
+            wait = min(wait, max(0.1, (next_due - now_sh_naive()).total_seconds()))
+        return items, wait
+
+    async def ack(self, ids) -> List[int]:
+        acked = await run_db(_ack_outgoing, ids, self.user_id)
+        self.inflight.difference_update(ids)
+        return acked
+
+@app.websocket("/mcp/stream/ws")
+async def stream_ws(websocket: WebSocket, user_id: int = Query(...)):
+    """
+    WebSocket 推送：连接建立后持续推送该用户的可投递项（结构同 OutgoingItemModel），
+    终端在同一连接上 ack，省去 poll + ack 两次 HTTP 往返。
+      服务端 -> 终端: {"type": "items", "items": [...]} / {"type": "acked", "ids": [...]} / {"type": "ping"}
+                      / {"type": "error", "detail": "..."}（收到无法解析的消息时回复，连接保持）
+      终端 -> 服务端: {"type": "ack", "ids": [1, 2]}
+    """
+    await websocket.accept()
+    cursor = _StreamCursor(user_id)
+    with notify_hub.listen(cursor.user_id) as listener:
+        receiver = asyncio.create_task(websocket.receive_json())
+        try:
+            while True:
+                items, wait = await cursor.next_batch()
+                if items:
+                    await websocket.send_json({"type": "items", "items": items})
+                    continue
+
+                waiter = asyncio.create_task(listener.wait(wait))
+                done, _ = await asyncio.wait({receiver, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                if receiver not in done:
+                    if not waiter.result() and wait >= STREAM_KEEPALIVE:
+                        await websocket.send_json({"type": "ping"})
+                    continue
+
+                waiter.cancel()
+                try:
+                    msg = receiver.result()
+                    is_ack = isinstance(msg, dict) and msg.get("type") == "ack"
+                    ids = [int(i) for i in (msg.get("ids") or [])] if is_ack else []
+                except (ValueError, TypeError):
+                    # 非 JSON 帧 / ids 不是整数列表：回错误帧，继续收下一条，不断开连接
+                    receiver = asyncio.create_task(websocket.receive_json())
+                    await websocket.send_json({"type": "error", "detail": "invalid message, expected "
+                                                                          '{"type": "ack", "ids": [int, ...]}'})
+                    continue
+                receiver = asyncio.create_task(websocket.receive_json())
+                if is_ack:
+                    acked = await cursor.ack(ids) if ids else []
+                    await websocket.send_json({"type": "acked", "ids": acked})
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            receiver.cancel()
+
+@app.get("/mcp/stream")
+async def stream_sse(request: Request, user_id: int = Query(...)):
+    """
+    SSE 推送（给不方便用 WebSocket 的客户端）：事件 "items" 的 data 为 OutgoingItemModel 列表。
+    SSE 是单向的，ack 仍走 POST /mcp/ack；已推送的项在本连接内不会重复推送。
+    """
+    cursor = _StreamCursor(user_id)
+
+    async def events():
+        with notify_hub.listen(cursor.user_id) as listener:
+            while not await request.is_disconnected():
+                items, wait = await cursor.next_batch()
+                if items:
+                    yield "event: items\ndata: " + json.dumps(items, ensure_ascii=False) + "\n\n"
+                    continue
+                if not await listener.wait(wait) and wait >= STREAM_KEEPALIVE:
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 async def start_background_scheduler():
     loop = asyncio.get_event_loop()
     app.state._bg_task = loop.create_task(background_scheduler_loop())
     print("Background scheduler started.")
 
-@app.on_event("shutdown")
 async def stop_background_scheduler():
     task = getattr(app.state, "_bg_task", None)
     if task:
@@ -1155,11 +1033,11 @@ async def stop_background_scheduler():
             await task
         except asyncio.CancelledError:
             pass
+        app.state._bg_task = None
         print("Background scheduler stopped.")
 
 @app.get("/mcp/daily_quote/{class_id}")
-def get_daily_quote(class_id: int):
-    db = SessionLocal()
+def get_daily_quote(class_id: int, db: Session = Depends(get_read_db)):
     try:
         q = _find_daily_quote_for_class(db, class_id)
         if not q:
@@ -1181,9 +1059,8 @@ def get_daily_quote(class_id: int):
 
 
 @app.put("/mcp/daily_quote/{quote_id}")
-def update_daily_quote(quote_id: int, body: DailyQuoteUpdate, requester_id: int = Query(...)):
+def update_daily_quote(quote_id: int, body: DailyQuoteUpdate, requester_id: int = Query(...), db: Session = Depends(get_db)):
     """更新每日鸡汤的内容（仅限教师）。"""
-    db = SessionLocal()
     try:
         # 权限检查：请求者必须是教师
         requester = db.get(User, requester_id)
@@ -1206,6 +1083,7 @@ def update_daily_quote(quote_id: int, body: DailyQuoteUpdate, requester_id: int
         quote.content = body.content
         db.commit()
         db.refresh(quote)
+        quote_scheduler.reload_quote(quote.id)
 
         return {
             "status": "success",
@@ -1225,37 +1103,35 @@ def update_daily_quote(quote_id: int, body: DailyQuoteUpdate, requester_id: int
 
 
 @app.post("/mcp/broadcast_daily/{class_id}")
-def broadcast_daily_quote(class_id: int):
-    db = SessionLocal()
+def broadcast_daily_quote(class_id: int, db: Session = Depends(get_db)):
+    """
+    为班级学生创建每日一句群发任务。enqueued 字段保留，含义是本次请求内入队的行数（现在总是 0），
+    实际进度见 GET /mcp/jobs/{job_id}。
+    """
     try:
         q = _find_daily_quote_for_class(db, class_id)
         if not q:
             return {"status": "error", "detail": "No daily quote to broadcast", "enqueued": 0}
 
-        students = db.query(User).filter(User.class_id == class_id, User.role == UserRole.student).all()
-        if not students:
+        has_students = roster_cache.member_ids(db, class_id, UserRole.student)
+        if not has_students:
             return {"status": "error", "detail": "No students in class", "enqueued": 0}
 
-        enqueued = 0
-        for s in students:
-            payload = {
-                "type": "daily_quote",
-                "text": q.content,
-                "voice_url": q.voice_url,
-                "broadcast_time": q.broadcast_time
-            }
-            item = OutgoingQueue(
-                target_user_id=s.id,
-                payload=payload,
-                priority="normal",
-                deliver_after=None,
-                created_at=now_sh_naive()
-            )
-            db.add(item)
-            enqueued += 1
+        payload = {
+            "type": "daily_quote",
+            "text": q.content,
+            "voice_url": q.voice_url,
+            "broadcast_time": q.broadcast_time
+        }
+        payload_id = get_or_create_payload(db, payload, now_sh_naive())
+        # 班级学生由群发任务在后台分块入队
+        job = create_job(db, "daily_quote", payload_id,
+                         {"class_ids": [int(class_id)], "roles": [UserRole.student.value], "combine": "and"},
+                         now_sh_naive())
 
         db.commit()
-        return {"status": "success", "detail": f"Enqueued {enqueued} items", "enqueued": enqueued}
+        fanout_worker.wake()
+        return {"status": "success", "detail": f"Fan-out job {job.id} created", "enqueued": 0, "job_id": job.id}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -1263,41 +1139,34 @@ def broadcast_daily_quote(class_id: int):
         db.close()
 
 @app.post("/mcp/trigger_daily_quote/{quote_id}")
-def trigger_daily_quote(quote_id: int):
-    db = SessionLocal()
+def trigger_daily_quote(quote_id: int, db: Session = Depends(get_db)):
+    """
+    手动触发指定每日一句：创建群发任务（有 class_id 发给该班全体，否则发给全体学生）。
+    enqueued 字段含义同 broadcast_daily_quote（现在总是 0），实际进度见 GET /mcp/jobs/{job_id}。
+    """
     try:
         quote = db.get(DailyQuote, quote_id)
         if not quote or (hasattr(quote, "active") and not quote.active):
             raise HTTPException(status_code=404, detail="daily_quote not found or inactive")
 
         if quote.class_id:
-            users = db.query(User).filter(User.class_id == int(quote.class_id)).all()
+            audience = {"class_ids": [int(quote.class_id)], "roles": [], "combine": "or"}
         else:
-            users = db.query(User).filter(User.role == UserRole.student).all()
-
-        if not users:
-            return {"status": "success", "enqueued": 0, "detail": "no target users"}
-
-        enqueued = 0
-        for u in users:
-            payload = {
-                "type": "daily_quote",
-                "quote_id": quote.id,
-                "content": quote.content,
-                "voice_url": getattr(quote, "voice_url", None),
-                "broadcast_time": getattr(quote, "broadcast_time", None)
-            }
-            q = OutgoingQueue(
-                target_user_id=int(u.id),
-                payload=payload,
-                priority="normal",
-                created_at=now_sh_naive()
-            )
-            db.add(q)
-            enqueued += 1
+            audience = {"class_ids": [], "roles": [UserRole.student.value], "combine": "or"}
+
+        payload = {
+            "type": "daily_quote",
+            "quote_id": quote.id,
+            "content": quote.content,
+            "voice_url": getattr(quote, "voice_url", None),
+            "broadcast_time": getattr(quote, "broadcast_time", None)
+        }
+        payload_id = get_or_create_payload(db, payload, now_sh_naive())
+        job = create_job(db, "daily_quote", payload_id, audience, now_sh_naive())
 
         db.commit()
-        return {"status": "success", "enqueued": enqueued}
+        fanout_worker.wake()
+        return {"status": "success", "enqueued": 0, "job_id": job.id}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -1309,22 +1178,24 @@ async def trigger_daily_quotes():
     task = asyncio.create_task(enqueue_daily_quotes_once())
     return {"status": "triggered"}
 
-# -------------- 启动时后台循环（每分钟检查一次并入队） --------------
-async def daily_scheduler_loop():
-    """后台循环：每分钟检查一次并入队。"""
-    tz = TZ
-    while True:
-        try:
-            await enqueue_daily_quotes_once()
-        except Exception:
-            pass
-        now = datetime.now(tz)
-        sec_to_next = 60 - now.second
-        await asyncio.sleep(sec_to_next)
+# -------------- 每日一句定时广播（按下一次触发时间睡眠，见 mcp/quotes.py） --------------
+async def start_quote_scheduler():
+    quote_scheduler.start()
 
-@app.on_event("startup")
-async def start_background_daily_scheduler():
-    asyncio.create_task(daily_scheduler_loop())
+async def stop_quote_scheduler():
+    await quote_scheduler.stop()
+
+@app.get("/mcp/scheduler/status")
+def scheduler_status():
+    """每日一句定时器：计划条数、最近的触发时间、触发延迟（lag）统计；leader 为本进程的租约状态。"""
+    return {"status": "success", "leader": leader.status(), "daily_quotes": quote_scheduler.status()}
+
+@app.post("/mcp/scheduler/reload")
+def scheduler_reload():
+    # 定时器只在 leader 上运行；其它 worker 上重载无意义，leader 会按变更指纹自行重载
+    if not quote_scheduler.running:
+        return {"status": "success", "scheduled": None, "detail": "daily quote timer runs on the leader"}
+    return {"status": "success", "scheduled": quote_scheduler.reload_all()}
 
 @app.get("/mcp/outgoing/list", response_model=OutgoingListResponseModel, tags=["admin"])
 def outgoing_list(
@@ -1332,17 +1203,23 @@ def outgoing_list(
     target_user_id: int | None = Query(None, description="可选：按 target_user_id 过滤"),
     delivered: int | None = Query(None, description="可选：0/1 过滤 delivered 状态"),
     priority: str | None = Query(None, description="可选：按 priority 过滤（e.g. urgent/normal）"),
-    page: int = Query(1, ge=1, description="页码，从1开始"),
-    size: int = Query(20, ge=1, le=200, description="每页大小，最大200")
+    page: int = Query(1, ge=1, description="页码，从1开始（兼容旧客户端；深翻页请用 cursor）"),
+    size: int = Query(20, ge=1, le=200, description="每页大小，最大200"),
+    cursor: str | None = Query(None, description="可选：上一次返回的 next_cursor / prev_cursor"),
+    direction: Literal["next", "prev"] = Query("next", description="cursor 的翻页方向"),
+    total: Literal["exact", "estimate", "none"] = Query("exact", description="总数：精确 COUNT / 统计估算 / 不计算"),
+    db: Session = Depends(get_read_db),
 ):
     """
     管理接口（分页 + 按 priority 排序 + 简单权限检查）。
     说明：
       - 必须传 requester_id（用来校验权限）。只有 teacher 或 role 为 'admin' 的用户可查看。
       - 支持按 target_user_id / delivered / priority 过滤。
-      - 按 (priority urgent 首) + created_at desc 排序。
+      - 按 (priority urgent 首) + created_at desc + id desc 排序。
+      - 传 cursor 时按 (rank, created_at, id) 做 keyset 翻页，不再 OFFSET；
+        不传 cursor 时按 page 走 OFFSET（page=1 即首页，同样返回 next_cursor）。
+      - total=estimate 在 MySQL 上取优化器估算（其它库退回精确计数），total=none 不计算总数。
     """
-    db = SessionLocal()
     try:
         # 1. 权限检查：请求者必须存在，且为 teacher 或 admin（兼容字符串或 Enum）
         requester = db.get(User, requester_id)
@@ -1377,37 +1254,56 @@ def outgoing_list(
         if priority is not None:
             q = q.filter(OutgoingQueue.priority == str(priority))
 
-        # 3. 计算总数（用于分页元数据）
-        total = q.count()
-
-        # 4. 优先按 priority 排序（urgent 首），其次按 created_at 降序
-        #    使用 SQLAlchemy case：urgent -> 1, else 0，然后 desc()
-        priority_case = case((OutgoingQueue.priority == "urgent", 1), else_=0)
-        q = q.order_by(priority_case.desc(), OutgoingQueue.created_at.desc())
-
-        # 5. 分页 offset/limit
-        offset = (page - 1) * size
-        rows = q.offset(offset).limit(size).all()
-
-        # 6. 构造返回项（对时间做时区友好输出）
-        items = []
-        for r in rows:
-            items.append({
-                "id": r.id,
-                "target_user_id": r.target_user_id,
-                "payload": r.payload,
-                "priority": r.priority,
-                "deliver_after": iso_tz(r.deliver_after),
-                "delivered": bool(r.delivered),
-                "created_at": iso_tz(r.created_at),
-                "delivered_at": iso_tz(r.delivered_at)
-            })
+        # 3. 总数（可选）：COUNT 随队列增长线性变慢，列表翻页时可改用估算或不算
+        total_count = None
+        total_mode = total
+        if total == "estimate":
+            total_count = estimate_count(db, q)
+            if total_count is None:
+                total_mode = "exact"
+        if total_mode == "exact":
+            total_count = q.count()
+
+        # 4. 排序 (urgent 首, created_at desc, id desc)；游标翻页时从游标处续读，向前翻页则逆序取再翻转
+        backwards = cursor is not None and direction == "prev"
+        if cursor is not None:
+            try:
+                key = decode_list_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="invalid cursor")
+            q = q.filter(keyset_filter(key, backwards=backwards))
+        q = q.order_by(*list_order(backwards=backwards))
+
+        # 5. 多取一条判断是否还有下一页；无 cursor 时兼容 page 的 OFFSET
+        if cursor is None and page > 1:
+            q = q.offset((page - 1) * size)
+        rows = q.limit(size + 1).all()
+        has_more = len(rows) > size
+        rows = rows[:size]
+        if backwards:
+            rows.reverse()
+
+        # 前后游标：向后翻时“有更多”决定 next，向前翻时决定 prev；另一侧只要是从游标/非首页进来就有
+        came_from_middle = cursor is not None or page > 1
+        next_cursor = prev_cursor = None
+        if rows:
+            if backwards or has_more:
+                next_cursor = encode_list_cursor(rows[-1])
+            if (has_more if backwards else came_from_middle):
+                prev_cursor = encode_list_cursor(rows[0])
+
+        # 6. 构造返回项（对时间做时区友好输出；共享 payload 一次批量取回）
+        payloads = resolve_payloads(db, rows)
+        items = [outgoing_item_to_dict(r, payloads) for r in rows]
 
         return {
             "status": "success",
-            "page": page,
+            "page": page if cursor is None else None,
             "size": size,
-            "total": total,
+            "total": total_count,
+            "total_mode": total_mode,
+            "next_cursor": next_cursor,
+            "prev_cursor": prev_cursor,
             "items": items
         }
     finally:
@@ -1415,19 +1311,20 @@ def outgoing_list(
 
 
 @app.post("/mcp/outgoing/mark_delivered")
-def mark_outgoing_delivered(body: dict):
+def mark_outgoing_delivered(body: dict, db: Session = Depends(get_db)):
     ids = body.get("ids", [])
     if not ids:
         raise HTTPException(status_code=400, detail="ids required")
-    db = SessionLocal()
     try:
         now_naive = now_sh_naive()
-        rows = db.query(OutgoingQueue).filter(OutgoingQueue.id.in_(ids)).all()
-        updated = []
-        for r in rows:
-            r.delivered = True
-            r.delivered_at = now_naive
-            updated.append(r.id)
+        rows = lock_queue_rows(db, OutgoingQueue.id.in_(ids))
+        updated = [r.id for r in rows]
+        if updated:
+            db.query(OutgoingQueue).filter(OutgoingQueue.id.in_(updated)).update(
+                {OutgoingQueue.delivered: True, OutgoingQueue.delivered_at: now_naive},
+                synchronize_session=False
+            )
+            settle_pending(db, rows)
         db.commit()
         return {"status": "success", "marked": updated}
     except Exception as e:
@@ -1437,16 +1334,16 @@ def mark_outgoing_delivered(body: dict):
         db.close()
 
 @app.post("/mcp/outgoing/delete")
-def delete_outgoing(body: dict):
+def delete_outgoing(body: dict, db: Session = Depends(get_db)):
     ids = body.get("ids", [])
     if not ids:
         raise HTTPException(status_code=400, detail="ids required")
-    db = SessionLocal()
     try:
-        rows = db.query(OutgoingQueue).filter(OutgoingQueue.id.in_(ids)).all()
+        rows = lock_queue_rows(db, OutgoingQueue.id.in_(ids))
         deleted = [r.id for r in rows]
-        for r in rows:
-            db.delete(r)
+        if deleted:
+            db.query(OutgoingQueue).filter(OutgoingQueue.id.in_(deleted)).delete(synchronize_session=False)
+            settle_pending(db, rows)
         db.commit()
         return {"status": "success", "deleted": deleted}
     except Exception as e:
@@ -1455,59 +1352,61 @@ def delete_outgoing(body: dict):
     finally:
         db.close()
 
-#@app.on_event("startup")
-#def _start_delivery_thread():
-    #global _delivery_thread, _delivery_started
-    #if _delivery_started:
-        #return
-    #_delivery_started = True
-    #_delivery_stop_evt.clear()
-    #_delivery_thread = Thread(target=_delivery_loop, args=(DELIVERY_POLL_INTERVAL,), daemon=True)
-    #_delivery_thread.start()
-    #logger.info("Background delivery thread started.")
+@app.get("/mcp/outgoing/pending_count")
+def outgoing_pending_count(user_id: int | None = Query(None, description="可选：只看该用户；不传为全局"), db: Session = Depends(get_db)):
+    """未投递项数量（含尚未到 deliver_after 的项），读维护好的计数，不扫描队列。"""
+    try:
+        return {"status": "success", "user_id": user_id, "pending": pending_count(db, user_id)}
+    finally:
+        db.close()
+
+@app.post("/mcp/outgoing/pending_count/rebuild")
+def outgoing_pending_count_rebuild(db: Session = Depends(get_db)):
+    """按队列全量重算计数（怀疑计数漂移时手动执行）。"""
+    try:
+        total = rebuild_pending_counters(db)
+        db.commit()
+        return {"status": "success", "pending": total}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        db.close()
+
+@app.on_event("startup")
+def _warm_up_db_pool():
+    try:
+        n = warm_up_pool()
+        logger.info("DB pool warmed up with %s connections", n)
+    except Exception:
+        logger.exception("DB pool warm-up failed")
+
+@app.on_event("shutdown")
+async def _stop_delivery_engine():
+    await delivery_engine.stop()
 
 @app.on_event("shutdown")
-def _stop_delivery_thread():
-    global _delivery_thread, _delivery_started
-    _delivery_stop_evt.set()
-    if _delivery_thread and _delivery_thread.is_alive():
-        _delivery_thread.join(timeout=2)
-    _delivery_started = False
-    logger.info("Background delivery thread stopped.")
+async def _dispose_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
 
 # 管理接口：查看/设置 delivery 配置
 @app.get("/mcp/delivery/status")
 def delivery_status():
-    return {
-        "running": _delivery_started,
-        "mode": DELIVERY_MODE,
-        "callback": DELIVERY_HTTP_CALLBACK,
-        "poll_interval": DELIVERY_POLL_INTERVAL
-    }
+    return delivery_engine.status()
 
 @app.post("/mcp/delivery/config")
 def delivery_config(body: dict):
-    global DELIVERY_MODE, DELIVERY_HTTP_CALLBACK, DELIVERY_POLL_INTERVAL
-    m = body.get("mode")
-    cb = body.get("callback")
-    pi = body.get("poll_interval")
-    if m:
-        if m not in ("log", "http"):
-            raise HTTPException(status_code=400, detail="mode must be 'log' or 'http'")
-        DELIVERY_MODE = m
-    if cb is not None:
-        DELIVERY_HTTP_CALLBACK = cb
-    if pi is not None:
-        try:
-            DELIVERY_POLL_INTERVAL = int(pi)
-        except Exception:
-            raise HTTPException(status_code=400, detail="poll_interval must be int")
-    return {"status": "ok", "mode": DELIVERY_MODE, "callback": DELIVERY_HTTP_CALLBACK, "poll_interval": DELIVERY_POLL_INTERVAL}
+    try:
+        cfg = delivery_engine.configure(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "ok", **cfg}
 
 @app.post("/mcp/delivery/trigger")
-def delivery_trigger():
+async def delivery_trigger():
     try:
-        res = _deliver_due_once()
+        res = await delivery_engine.run_once()
         return {"status": "ok", "result": res}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1515,30 +1414,93 @@ def delivery_trigger():
 @app.post("/mcp/delivery/mock_callback")
 def delivery_mock_callback(payload: dict):
     logger.info("Mock callback received: %s", payload)
+    # http_batch 模式：逐项返回成功
+    if isinstance(payload.get("items"), list):
+        return {"status": "ok", "results": [{"queue_id": it.get("queue_id"), "ok": True} for it in payload["items"]]}
     return {"status": "ok"}
 
 @app.post("/mcp/delivery/stop")
-def delivery_stop():
-    global _delivery_thread, _delivery_started
-    _delivery_stop_evt.set()
-    if _delivery_thread and _delivery_thread.is_alive():
-        _delivery_thread.join(timeout=2)
-    _delivery_started = False
+async def delivery_stop():
+    await delivery_engine.stop()
     return {"status": "stopped"}
 
 @app.post("/mcp/delivery/start")
-def delivery_start():
-    global _delivery_thread, _delivery_started
-    if _delivery_started:
+async def delivery_start():
+    if not await delivery_engine.start():
         return {"status": "already_running"}
-    _delivery_stop_evt.clear()
-    _delivery_thread = Thread(target=_delivery_loop, args=(DELIVERY_POLL_INTERVAL,), daemon=True)
-    _delivery_thread.start()
-    _delivery_started = True
     return {"status": "started"}
 
+# -------------------- 群发任务 --------------------
+@app.on_event("startup")
+async def start_fanout_worker():
+    fanout_worker.start()
+
+@app.on_event("shutdown")
+async def stop_fanout_worker():
+    await fanout_worker.stop()
+
+@app.get("/mcp/jobs/{job_id}")
+def get_fanout_job(job_id: int, db: Session = Depends(get_db)):
+    """群发任务进度：status / total / enqueued / skipped / progress / error。"""
+    try:
+        job = db.get(FanoutJob, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="job not found")
+        return {"status": "success", "job": job_to_dict(job)}
+    finally:
+        db.close()
+
+# -------------------- outgoing_queue 保留 / 归档 --------------------
+async def start_retention():
+    retention_manager.start()
+
+async def stop_retention():
+    await retention_manager.stop()
+
+# -------------------- 领导者选举（单例后台循环） --------------------
+leader.register(start_background_scheduler, stop_background_scheduler)
+leader.register(start_quote_scheduler, stop_quote_scheduler)
+leader.register(start_retention, stop_retention)
+
+@app.on_event("startup")
+async def start_leader_election():
+    leader.start()
+
+@app.on_event("shutdown")
+async def stop_leader_election():
+    await leader.stop()
+
+@app.get("/mcp/retention/status")
+def retention_status():
+    return retention_manager.status()
+
+@app.post("/mcp/retention/config")
+def retention_config(body: dict):
+    try:
+        cfg = retention_manager.configure(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "ok", **cfg}
+
+@app.post("/mcp/retention/run")
+async def retention_run():
+    try:
+        return {"status": "ok", "result": await retention_manager.run_once()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/mcp/retention/partition_archive")
+def retention_partition_archive():
+    """一次性把 outgoing_queue_archive 改为按天分区（仅 MySQL）。"""
+    try:
+        return retention_manager.partition_archive_table()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/mcp/grades/add")
-def add_grade(body: dict):
+def add_grade(body: dict, db: Session = Depends(get_db)):
     """
     老师录入成绩（简单权限校验：requester_id 必须是 teacher）
     Body:
@@ -1553,7 +1515,6 @@ def add_grade(body: dict):
     requester_id_str = body.get("requester_id")
     if requester_id_str is None:
         raise HTTPException(status_code=400, detail="requester_id required")
-    db = SessionLocal()
     try:
         # 使用 get_user_id_from_external_id 正确映射 external_id 到内部 id
         requester_id = get_user_id_from_external_id(db, requester_id_str)
@@ -1602,6 +1563,7 @@ def add_grade(body: dict):
             teacher_id=requester_id
         )
         db.add(g)
+        note_writer(db, requester_id_str, body.get("student_id"))
         db.commit()
         db.refresh(g)
         return {"status": "success", "grade_id": g.id}
@@ -1615,12 +1577,11 @@ def add_grade(body: dict):
         db.close()
 
 @app.get("/mcp/grades/student/{student_identifier}")
-def get_grades_for_student(student_identifier: str, requester_id: str = Query(...)):
+def get_grades_for_student(student_identifier: str, requester_id: str = Query(...), db: Session = Depends(get_read_db)):
     """
     查看某学生成绩（可由老师/该学生/家长查看）
     请求示例: /mcp/grades/student/ext456?requester_id=ext123
     """
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -1664,12 +1625,11 @@ def get_grades_for_student(student_identifier: str, requester_id: str = Query(..
         db.close()
 
 @app.get("/mcp/grades/class/{class_identifier}")
-def get_grades_for_class(class_identifier: str, subject: Optional[str] = Query(None), semester: Optional[str] = Query(None), requester_id: str = Query(...), page: int = Query(1), size: int = Query(50)):
+def get_grades_for_class(class_identifier: str, subject: Optional[str] = Query(None), semester: Optional[str] = Query(None), requester_id: str = Query(...), page: int = Query(1), size: int = Query(50), db: Session = Depends(get_read_db)):
     """
     按班级查询成绩（分页）。
     仅允许老师或管理员查看。
     """
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -1692,8 +1652,7 @@ def get_grades_for_class(class_identifier: str, subject: Optional[str] = Query(N
             raise HTTPException(status_code=403, detail="Permission denied")
 
         # 获取该班级学生 id 列表
-        students = db.query(User.id).filter(User.class_id == class_id).all()
-        student_ids = [s[0] for s in students]
+        student_ids = roster_cache.member_ids(db, class_id)
 
         q = db.query(Grade).filter(Grade.student_id.in_(student_ids))
         if subject:
@@ -1711,9 +1670,8 @@ def get_grades_for_class(class_identifier: str, subject: Optional[str] = Query(N
         db.close()
 
 @app.get("/mcp/class/{class_identifier}/students")
-def get_students_in_class(class_identifier: str, requester_id: str = Query(...)):
+def get_students_in_class(class_identifier: str, requester_id: str = Query(...), db: Session = Depends(get_db)):
     """获取班级学生列表（仅限教师/管理员）"""
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -1733,16 +1691,15 @@ def get_students_in_class(class_identifier: str, requester_id: str = Query(...))
         if requester_role == 'teacher' and requester.managed_class_id != class_id:
             raise HTTPException(status_code=403, detail="Permission denied: cannot access students of another class")
 
-        students = db.query(User).filter(User.class_id == class_id, User.role == UserRole.student).all()
+        students = roster_cache.members(db, class_id, UserRole.student)
         items = [{"id": s.id, "username": s.username} for s in students]
         return {"status": "success", "students": items}
     finally:
         db.close()
 
 @app.put("/mcp/grades/{grade_id}")
-def update_grade(grade_id: int, body: dict, requester_id: str = Query(...)):
+def update_grade(grade_id: int, body: dict, requester_id: str = Query(...), db: Session = Depends(get_db)):
     """修改成绩（仅限教师）"""
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -1786,9 +1743,8 @@ def update_grade(grade_id: int, body: dict, requester_id: str = Query(...)):
         db.close()
 
 @app.delete("/mcp/grades/{grade_id}")
-def delete_grade(grade_id: int, requester_id: str = Query(...)):
+def delete_grade(grade_id: int, requester_id: str = Query(...), db: Session = Depends(get_db)):
     """删除成绩（仅限教师）"""
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -1824,9 +1780,8 @@ def delete_grade(grade_id: int, requester_id: str = Query(...)):
         db.close()
 
 @app.get("/mcp/parent/{parent_identifier}/children")
-def get_parent_children(parent_identifier: str, requester_id: str = Query(...)):
+def get_parent_children(parent_identifier: str, requester_id: str = Query(...), db: Session = Depends(get_db)):
     """获取家长关联的孩子列表"""
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -1877,8 +1832,7 @@ class ContactsResponse(BaseModel):
     detail: Optional[str] = None
 
 @app.get("/mcp/contacts", response_model=ContactsResponse)
-def get_contacts(user_id: str = Query(...)):
-    db = SessionLocal()
+def get_contacts(user_id: str = Query(...), db: Session = Depends(get_read_db)):
     try:
         # Get the current user
         current_user_id = get_user_id_from_external_id(db, user_id) or int(user_id)
@@ -1896,32 +1850,21 @@ def get_contacts(user_id: str = Query(...)):
         if current_user.role == UserRole.student:
             # 1. Classmates
             if current_user.class_id:
-                classmates = db.query(User).filter(
-                    User.class_id == current_user.class_id,
-                    User.role == UserRole.student,
-                    User.id != current_user.id
-                ).all()
+                classmates = roster_cache.members(db, current_user.class_id, UserRole.student)
                 for user in classmates:
-                    if user.id not in contact_ids:
+                    if user.id != current_user.id and user.id not in contact_ids:
                         contacts.append({"id": user.id, "name": f"{user.username} (同学)", "role": "student"})
                         contact_ids.add(user.id)
 
             # 2. Parents
-            parent_ids = db.query(parent_students.c.parent_id).filter(parent_students.c.student_id == current_user.id).all()
-            parent_ids_list = [pid[0] for pid in parent_ids]
-            if parent_ids_list:
-                parents = db.query(User).filter(User.id.in_(parent_ids_list)).all()
-                for user in parents:
-                     if user.id not in contact_ids:
-                        contacts.append({"id": user.id, "name": f"{current_user.username}家长", "role": "parent"})
-                        contact_ids.add(user.id)
+            for pid in roster_cache.parents_of(db, current_user.id):
+                if pid not in contact_ids:
+                    contacts.append({"id": pid, "name": f"{current_user.username}家长", "role": "parent"})
+                    contact_ids.add(pid)
 
             # 3. Teachers
             if current_user.class_id:
-                teachers = db.query(User).filter(
-                    User.role == UserRole.teacher,
-                    User.managed_class_id == current_user.class_id
-                ).all()
+                teachers = roster_cache.teachers(db, current_user.class_id)
                 for user in teachers:
                     if user.id not in contact_ids:
                         contacts.append({"id": user.id, "name": f"{user.username} (老师)", "role": "teacher"})
@@ -1930,10 +1873,7 @@ def get_contacts(user_id: str = Query(...)):
         # Logic for teachers
         elif current_user.role == UserRole.teacher:
             if current_user.managed_class_id:
-                students = db.query(User).filter(
-                    User.class_id == current_user.managed_class_id,
-                    User.role == UserRole.student
-                ).all()
+                students = roster_cache.members(db, current_user.managed_class_id, UserRole.student)
                 for user in students:
                     if user.id not in contact_ids:
                         contacts.append({"id": user.id, "name": user.username, "role": "student"})
@@ -1941,8 +1881,7 @@ def get_contacts(user_id: str = Query(...)):
 
         # Logic for parents
         elif current_user.role == UserRole.parent:
-            children_ids = db.query(parent_students.c.student_id).filter(parent_students.c.parent_id == current_user.id).all()
-            children_ids_list = [cid[0] for cid in children_ids]
+            children_ids_list = list(roster_cache.children_of(db, current_user.id))
             if children_ids_list:
                 children = db.query(User).filter(User.id.in_(children_ids_list)).all()
                 for user in children:
@@ -1958,8 +1897,7 @@ def get_contacts(user_id: str = Query(...)):
         db.close()
 
 @app.get("/mcp/user/profile", response_model=UserProfileResponse)
-def get_user_profile(requester_id: str = Query(..., description="requester user id")):
-    db = SessionLocal()
+def get_user_profile(requester_id: str = Query(..., description="requester user id"), db: Session = Depends(get_read_db)):
     try:
         user_id = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not user_id:
@@ -2029,9 +1967,8 @@ def get_user_profile(requester_id: str = Query(..., description="requester user
         db.close()
 
 @app.get("/mcp/user/{user_identifier}")
-def get_user_info(user_identifier: str):
+def get_user_info(user_identifier: str, db: Session = Depends(get_db)):
     """返回 user 基本信息（id, username, role, class_id 等），供前端登录校验使用。"""
-    db = SessionLocal()
     try:
         user_id = get_user_id_from_external_id(db, user_identifier) or int(user_identifier)
         if not user_id:
@@ -2055,8 +1992,7 @@ def get_user_info(user_identifier: str):
         db.close()
 
 @app.put("/mcp/user/profile")
-def update_user_profile(requester_id: str = Query(...), profile_data: dict = {}):
-    db = SessionLocal()
+def update_user_profile(requester_id: str = Query(...), profile_data: dict = {}, db: Session = Depends(get_db)):
     try:
         user_id = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not user_id:
@@ -2083,10 +2019,16 @@ def update_user_profile(requester_id: str = Query(...), profile_data: dict = {})
             else:
                 target_user.username = profile_data['name']
 
+        old_external_id = target_user.external_id
         if 'external_id' in profile_data and user.role != UserRole.parent:
             target_user.external_id = profile_data['external_id']
         
         db.commit()
+        open_window_schedule.invalidate_user(target_user.id)
+        roster_cache.invalidate_user(target_user)
+        if target_user.external_id != old_external_id:
+            # 旧 external_id 不再有效，新 external_id 可能已被缓存为“不存在”
+            external_id_cache.invalidate(old_external_id, target_user.external_id)
         return {"status": "success"}
     except Exception as e:
         db.rollback()
@@ -2094,15 +2036,48 @@ def update_user_profile(requester_id: str = Query(...), profile_data: dict = {})
     finally:
         db.close()
 
+@app.get("/mcp/admin/db_pool")
+def db_pool_status():
+    """连接池：大小、已签出 / 空闲连接数、overflow、签出等待时间统计与当前配置。"""
+    return {"status": "success", "pool": pool_status()}
+
+@app.get("/mcp/admin/db_routes")
+def db_route_stats():
+    """按路由统计：请求数、实际访问数据库的会话数、连接签出次数、出错回滚数。"""
+    return {"status": "success", "routes": route_db_stats()}
+
+@app.get("/mcp/admin/roster_cache")
+def roster_cache_stats():
+    """班级花名册缓存：缓存的班级数、家长/孩子索引数、命中率。"""
+    return {"status": "success", "roster_cache": roster_cache.stats()}
+
+@app.post("/mcp/admin/roster_cache/invalidate")
+def roster_cache_invalidate():
+    """清空花名册缓存（直接改库后手动执行；否则等 TTL 过期）。"""
+    roster_cache.invalidate_class()
+    roster_cache.invalidate_links()
+    return {"status": "success"}
+
+@app.get("/mcp/admin/lookup_cache")
+def lookup_cache_status():
+    """external_id / class_code 解析缓存：条目数、命中率（含“不存在”命中）、淘汰数。"""
+    return {"status": "success", "lookup_cache": lookup_cache_stats()}
+
+@app.post("/mcp/admin/lookup_cache/invalidate")
+def lookup_cache_invalidate():
+    """清空解析缓存（直接改库修改 external_id / class_code 后手动执行；否则等 TTL 过期）。"""
+    external_id_cache.invalidate()
+    class_code_cache.invalidate()
+    return {"status": "success"}
+
 @app.get("/mcp/admin/stats")
-def admin_stats(requester_id: str = Query(..., description="requester user id for permission check")):
+def admin_stats(requester_id: str = Query(..., description="requester user id for permission check"), db: Session = Depends(get_read_db)):
     """
     返回管理面板的简要统计：
       - pending_outgoing: 待发送队列（未 delivered）的数量（仅 admin 可见）
       - unconfirmed_memos: 今日未确认的 memo 数（仅 admin 可见）
       - daily_quote: dict 包含 { total_active, scheduled_now: [...], enqueued_today }（admin 与 teacher 可见）
     """
-    db = SessionLocal()
     try:
         requester_id_internal = get_user_id_from_external_id(db, requester_id) or int(requester_id)
         if not requester_id_internal:
@@ -2127,7 +2102,7 @@ def admin_stats(requester_id: str = Query(..., description="requester user id fo
         # Admin-only metrics
         if is_admin:
             try:
-                pending = db.query(OutgoingQueue).filter(OutgoingQueue.delivered == False).count()
+                pending = pending_count(db)
             except Exception:
                 pending = 0
             # 今日未确认 memo（按 remind_date == today）
@@ -2164,13 +2139,12 @@ def admin_stats(requester_id: str = Query(..., description="requester user id fo
             except Exception:
                 scheduled_now = []
 
-            # 检查当天已入队的 daily_quote 数量（payload 中的 date 字段）
+            # 当天已入队的 daily_quote 数量：按 dedupe_key 日期前缀走唯一索引范围扫描
             today_iso = now_sh.date().isoformat()
             try:
-                enqueued_today = db.query(OutgoingQueue).filter(OutgoingQueue.payload.contains({
-                    "type": "daily_quote",
-                    "date": today_iso
-                })).count()
+                enqueued_today = db.query(func.count(OutgoingQueue.id)).filter(
+                    OutgoingQueue.dedupe_key.like(f"dq:{today_iso}:%")
+                ).scalar() or 0
             except Exception:
                 enqueued_today = 0
 
@@ -2186,8 +2160,7 @@ def admin_stats(requester_id: str = Query(..., description="requester user id fo
         db.close()
 
 @app.get("/mcp/open_windows/{class_id}", response_model=List[OpenWindowModel])
-def get_open_windows(class_id: int, requester_id: int = Query(...)):
-    db = SessionLocal()
+def get_open_windows(class_id: int, requester_id: int = Query(...), db: Session = Depends(get_db)):
     try:
         requester = db.get(User, requester_id)
         if not requester:
@@ -2207,9 +2180,20 @@ def get_open_windows(class_id: int, requester_id: int = Query(...)):
     finally:
         db.close()
 
-@app.post("/mcp/open_windows", response_model=OpenWindowModel)
-def create_open_window(window: OpenWindowCreate, requester_id: int = Query(...)):
+def _reschedule_memo_reminders(class_id: int):
+    """开放时段变化后重算该班级未到期的 memo 提醒；失败不影响时段本身的修改（兜底循环会补齐缺失的）。"""
     db = SessionLocal()
+    try:
+        reschedule_class(db, class_id, now_sh_naive())
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Failed to reschedule memo reminders for class %s", class_id)
+    finally:
+        db.close()
+
+@app.post("/mcp/open_windows", response_model=OpenWindowModel)
+def create_open_window(window: OpenWindowCreate, requester_id: int = Query(...), db: Session = Depends(get_db)):
     try:
         requester = db.get(User, requester_id)
         if not requester:
@@ -2228,13 +2212,14 @@ def create_open_window(window: OpenWindowCreate, requester_id: int = Query(...))
         db.add(new_window)
         db.commit()
         db.refresh(new_window)
+        open_window_schedule.invalidate_class(new_window.class_id)
+        _reschedule_memo_reminders(new_window.class_id)
         return new_window
     finally:
         db.close()
 
 @app.delete("/mcp/open_windows/{window_id}", status_code=204)
-def delete_open_window(window_id: int, requester_id: int = Query(...)):
-    db = SessionLocal()
+def delete_open_window(window_id: int, requester_id: int = Query(...), db: Session = Depends(get_db)):
     try:
         requester = db.get(User, requester_id)
         if not requester:
@@ -2253,8 +2238,11 @@ def delete_open_window(window_id: int, requester_id: int = Query(...)):
         else:
             raise HTTPException(status_code=403, detail="Permission denied")
         
+        class_id = window.class_id
         db.delete(window)
         db.commit()
+        open_window_schedule.invalidate_class(class_id)
+        _reschedule_memo_reminders(class_id)
         return
     finally:
         db.close()
@@ -2292,14 +2280,18 @@ def admin_outgoing_page():
         <label class="form-label">priority（可选）</label>
         <input id="priority" class="form-control" type="text" placeholder="urgent/normal" />
       </div>
-      <div class="col-md-2">
-        <label class="form-label">page</label>
-        <input id="page" class="form-control" type="number" value="1" min="1" />
-      </div>
-      <div class="col-md-2">
+      <div class="col-md-1">
         <label class="form-label">size</label>
         <input id="size" class="form-control" type="number" value="20" min="1" max="200" />
       </div>
+      <div class="col-md-1">
+        <label class="form-label">总数</label>
+        <select id="total_mode" class="form-select">
+          <option value="estimate">估算</option>
+          <option value="exact">精确</option>
+          <option value="none">不计算</option>
+        </select>
+      </div>
     </div>
 
     <div class="mt-3">
@@ -2329,8 +2321,10 @@ def admin_outgoing_page():
       </table>
     </div>
 
-    <nav>
-      <ul class="pagination" id="pager"></ul>
+    <nav class="d-flex align-items-center gap-2">
+      <button id="prevBtn" class="btn btn-outline-secondary btn-sm" disabled>上一页</button>
+      <button id="nextBtn" class="btn btn-outline-secondary btn-sm" disabled>下一页</button>
+      <span id="totalInfo" class="text-muted small"></span>
     </nav>
   </div>
 
@@ -2343,16 +2337,22 @@ function showAlert(msg, kind='info') {
   setTimeout(()=>area.innerHTML='', 4000);
 }
 
-async function loadPage() {
+// 当前页的游标（刷新时重新加载同一页）与最近一次返回的前后游标
+let pageCursor = null, pageDirection = 'next';
+let nextCursor = null, prevCursor = null;
+
+async function loadPage(cursor = pageCursor, direction = pageDirection) {
   const requester_id = $('requester_id').value;
   if(!requester_id){ showAlert('requester_id 必填','warning'); return; }
   const target_user_id = $('target_user_id').value;
   const delivered = $('delivered').value;
   const priority = $('priority').value;
-  const page = $('page').value || 1;
   const size = $('size').value || 20;
+  // 只在首页算总数，翻页时不重复计算
+  const total = cursor ? 'none' : $('total_mode').value;
 
-  let url = `/mcp/outgoing/list?requester_id=${encodeURIComponent(requester_id)}&page=${page}&size=${size}`;
+  let url = `/mcp/outgoing/list?requester_id=${encodeURIComponent(requester_id)}&size=${size}&total=${total}`;
+  if(cursor) url += `&cursor=${encodeURIComponent(cursor)}&direction=${direction}`;
   if(target_user_id) url += `&target_user_id=${encodeURIComponent(target_user_id)}`;
   if(delivered !== '') url += `&delivered=${encodeURIComponent(delivered)}`;
   if(priority) url += `&priority=${encodeURIComponent(priority)}`;
@@ -2366,6 +2366,7 @@ async function loadPage() {
     }
     const data = await res.json();
     if(data.status !== 'success'){ showAlert('接口返回: '+ JSON.stringify(data),'warning'); return; }
+    pageCursor = cursor; pageDirection = direction;
     renderTable(data);
   } catch (e) {
     showAlert('请求异常: ' + e, 'danger');
@@ -2390,19 +2391,13 @@ function renderTable(data){
     tbody.appendChild(tr);
   });
 
-  // pager
-  const pager = $('pager');
-  pager.innerHTML = '';
-  const total = data.total || 0;
-  const page = data.page || 1;
-  const size = data.size || 20;
-  const pages = Math.max(1, Math.ceil(total/size));
-  for(let p=1;p<=pages && p<=20;p++){
-    const li = document.createElement('li');
-    li.className = 'page-item ' + (p==page?'active':'');
-    li.innerHTML = `<a class="page-link" href="#">${p}</a>`;
-    li.onclick = (ev)=>{ ev.preventDefault(); $('page').value = p; loadPage(); };
-    pager.appendChild(li);
+  // pager：上一页 / 下一页游标
+  nextCursor = data.next_cursor || null;
+  prevCursor = data.prev_cursor || null;
+  $('nextBtn').disabled = !nextCursor;
+  $('prevBtn').disabled = !prevCursor;
+  if(data.total !== null && data.total !== undefined){
+    $('totalInfo').textContent = (data.total_mode === 'estimate' ? '约 ' : '共 ') + data.total + ' 条';
   }
 }
 
@@ -2422,8 +2417,10 @@ async function postJson(url, body){
   return res;
 }
 
-$('loadBtn').onclick = loadPage;
-$('refreshBtn').onclick = loadPage;
+$('loadBtn').onclick = ()=>loadPage(null, 'next');
+$('refreshBtn').onclick = ()=>loadPage();
+$('nextBtn').onclick = ()=>{ if(nextCursor) loadPage(nextCursor, 'next'); };
+$('prevBtn').onclick = ()=>{ if(prevCursor) loadPage(prevCursor, 'prev'); };
 $('selectAll').onclick = ()=>{
   const checked = $('selectAll').checked;
   document.querySelectorAll('.rowCheck').forEach(c=>c.checked = checked);
@@ -2458,7 +2455,6 @@ $('deleteSelectedBtn').onclick = async ()=>{
   if(params.get('requester_id')) $('requester_id').value = params.get('requester_id');
   if(params.get('target_user_id')) $('target_user_id').value = params.get('target_user_id');
   if(params.get('delivered')) $('delivered').value = params.get('delivered');
-  if(params.get('page')) $('page').value = params.get('page');
   if(params.get('size')) $('size').value = params.get('size');
 })();
 </script>
@@ -2498,9 +2494,8 @@ class RegisterResponse(BaseModel):
     detail: Optional[str] = None
 
 @app.post("/mcp/auth/login", response_model=LoginResponse)
-def login(login_request: LoginRequest):
+def login(login_request: LoginRequest, db: Session = Depends(get_db)):
     """使用 external_id 和密码进行登录"""
-    db = SessionLocal()
     try:
         # 通过 external_id 查找用户
         user = db.query(User).filter(User.external_id == login_request.external_id).first()
@@ -2528,9 +2523,8 @@ def login(login_request: LoginRequest):
         db.close()
 
 @app.post("/mcp/auth/register", response_model=RegisterResponse)
-def register(register_request: RegisterRequest):
+def register(register_request: RegisterRequest, db: Session = Depends(get_db)):
     """用户注册接口"""
-    db = SessionLocal()
     try:
         # 验证密码确认
         if register_request.password != register_request.confirm_password:
@@ -2594,6 +2588,10 @@ def register(register_request: RegisterRequest):
         db.add(new_user)
         db.commit()
         db.refresh(new_user)
+        # 该 id 之前可能已被缓存为“无班级”
+        open_window_schedule.invalidate_user(new_user.id)
+        roster_cache.invalidate_user(new_user)
+        external_id_cache.invalidate(new_user.external_id)
         
         return RegisterResponse(
             status="success",
@@ -2615,9 +2613,8 @@ class ParentChildSelectionResponse(BaseModel):
     detail: Optional[str] = None
 
 @app.post("/mcp/parent/select_child", response_model=ParentChildSelectionResponse)
-def parent_select_child(selection_request: ParentChildSelectionRequest):
+def parent_select_child(selection_request: ParentChildSelectionRequest, db: Session = Depends(get_db)):
     """家长选择孩子接口"""
-    db = SessionLocal()
     try:
         parent_id = get_user_id_from_external_id(db, selection_request.parent_id) or int(selection_request.parent_id)
         student_id = get_user_id_from_external_id(db, selection_request.student_id) or int(selection_request.student_id)
@@ -2653,7 +2650,9 @@ def parent_select_child(selection_request: ParentChildSelectionRequest):
             parent_id=parent_id,
             student_id=student_id
         ))
+        note_writer(db, selection_request.parent_id, parent_id)
         db.commit()
+        roster_cache.invalidate_links(parent_id=parent_id, student_id=student_id)
         
         return ParentChildSelectionResponse(status="success", detail="孩子选择成功")
     except Exception as e:
@@ -2668,9 +2667,8 @@ class AvailableStudentsResponse(BaseModel):
     detail: Optional[str] = None
 
 @app.get("/mcp/parent/available_students", response_model=AvailableStudentsResponse)
-def get_available_students(parent_id: str = Query(...)):
+def get_available_students(parent_id: str = Query(...), db: Session = Depends(get_db)):
     """获取家长可选择的同班学生列表"""
-    db = SessionLocal()
     try:
         parent_user_id = get_user_id_from_external_id(db, parent_id) or int(parent_id)
         if not parent_user_id:
@@ -2681,16 +2679,13 @@ def get_available_students(parent_id: str = Query(...)):
             return AvailableStudentsResponse(status="error", detail="用户不是家长角色")
         
         # 获取同班级的所有学生
-        students = db.query(User).filter(
-            User.class_id == parent_user.class_id,
-            User.role == UserRole.student
-        ).all()
+        if parent_user.class_id:
+            students = roster_cache.members(db, parent_user.class_id, UserRole.student)
+        else:
+            students = db.query(User).filter(User.class_id == None, User.role == UserRole.student).all()
         
         # 获取已经关联的学生ID
-        related_student_ids = db.query(parent_students.c.student_id).filter(
-            parent_students.c.parent_id == parent_user_id
-        ).all()
-        related_ids = [r[0] for r in related_student_ids]
+        related_ids = set(roster_cache.children_of(db, parent_user_id))
         
         # 过滤掉已经关联的学生
         available_students = []
@@ -2700,7 +2695,7 @@ def get_available_students(parent_id: str = Query(...)):
                     "id": student.id,
                     "external_id": student.external_id,
                     "username": student.username,
-                    "class_id": student.class_id
+                    "class_id": parent_user.class_id
                 })
         
         return AvailableStudentsResponse(status="success", students=available_students)
@@ -2715,9 +2710,8 @@ class ParentStatusResponse(BaseModel):
     detail: Optional[str] = None
 
 @app.get("/mcp/parent/status", response_model=ParentStatusResponse)
-def get_parent_status(parent_id: str = Query(...)):
+def get_parent_status(parent_id: str = Query(...), db: Session = Depends(get_db)):
     """检查家长是否已经选择了孩子"""
-    db = SessionLocal()
     try:
         parent_user_id = get_user_id_from_external_id(db, parent_id) or int(parent_id)
         if not parent_user_id:
@@ -2744,7 +2738,23 @@ def get_parent_status(parent_id: str = Query(...)):
     finally:
         db.close()
 
+@app.get("/mcp/admin/startup")
+def startup_report():
+    """启动耗时：各阶段距导入开始的秒数、首个请求完成时间、最慢的模块导入。"""
+    return {"status": "success", "startup": startup_profile.report()}
+
+startup_profile.mark("app_module_loaded")
+
+# 最后注册，在其它 startup 钩子之后执行
+@app.on_event("startup")
+def _startup_complete():
+    startup_profile.mark("startup_complete")
+    startup_profile.uninstall_import_timer()
+    logger.info(startup_profile.summary())
+
 # -------------------- 启动用 --------------------
 if __name__ == "__main__":
     import uvicorn
+    # 开发时直接运行：先建表 / 补列（只在主进程做一次，reload 重启 worker 不再重复）
+    init_db()
     uvicorn.run("mcp.app:app", host="0.0.0.0", port=8000, reload=True)
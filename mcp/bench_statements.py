@@ -0,0 +1,143 @@
+# mcp/bench_statements.py
+"""
+热路径查询的微基准：对比原 ORM Query 写法（每次重建表达式）与预先构造、bindparam 传参的语句。
+
+    python -m mcp.bench_statements [--db-url sqlite:///bench.db] [--number 2000] [--rows 200]
+
+每个查询输出两项（微秒 / 次）：
+  - build：构造语句 + 生成编译缓存键（SQLAlchemy 每次执行前都要做；命中编译缓存后剩下的纯 Python 开销）
+  - execute：实际执行并取回结果（含 build）
+默认在临时 SQLite 文件上运行；--db-url 指向 MySQL 测试库可看真实驱动下的差异（会建表并写入测试数据）。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple
+
+
+def _per_call(fn: Callable, number: int) -> float:
+    fn()
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m mcp.bench_statements")
+    parser.add_argument("--db-url", default=None, help="default: a temporary SQLite file")
+    parser.add_argument("--number", type=int, default=2000, help="calls per measurement")
+    parser.add_argument("--rows", type=int, default=200, help="queue rows / messages seeded for the bench user")
+    args = parser.parse_args(argv)
+
+    os.environ["DATABASE_URL"] = args.db_url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ.setdefault("DB_ASYNC", "0")
+
+    from sqlalchemy import and_, case, func, or_
+    from shared.models import (
+        Class, Message, OpenWindow, OutgoingPayload, OutgoingQueue, User, UserRole,
+    )
+    from . import db as mdb
+    from . import outgoing, openwindows
+    from .app import _MESSAGES_FOR_RECEIVER, _USERNAMES_BY_ID
+
+    mdb.init_db()
+    session = mdb.SessionLocal()
+    now = datetime.now().replace(microsecond=0)
+    cls = Class(name="Bench", class_code="BENCH-1")
+    session.add(cls)
+    session.flush()
+    sender = User(username="bench_sender", password_hash="x", role=UserRole.teacher,
+                  external_id="bench-t", managed_class_id=cls.id)
+    user = User(username="bench_user", password_hash="x", role=UserRole.student,
+                external_id="bench-s", class_id=cls.id)
+    session.add_all([sender, user])
+    session.flush()
+    session.add(OpenWindow(class_id=cls.id, start_time="00:00", end_time="00:00", days_json=[]))
+    shared = OutgoingPayload(ref_key="bench", payload={"type": "notice", "text": "bench"}, created_at=now)
+    session.add(shared)
+    session.flush()
+    for i in range(args.rows):
+        # 全部在未来才可见：认领查询走完整过滤但不改行，可重复执行
+        session.add(OutgoingQueue(target_user_id=user.id, payload_id=shared.id, priority="normal",
+                                  deliver_after=now + timedelta(days=1), created_at=now, delivered=False))
+        session.add(Message(sender_id=sender.id, receiver_id=user.id, content=f"m{i}", timestamp=now))
+    session.commit()
+
+    uid, owner, exclude = user.id, outgoing.terminal_owner(user.id), [1, 2, 3]
+    Q = OutgoingQueue
+
+    # ---- 原写法（本次改动前的代码） ----
+    def claim_orm():
+        return (session.query(Q)
+                .filter(and_(Q.delivered == False, or_(Q.deliver_after == None, Q.deliver_after <= now)),
+                        or_(Q.leased_until == None, Q.leased_until < now, Q.lease_owner == owner))
+                .filter(Q.target_user_id == uid).filter(Q.id.notin_(exclude))
+                .order_by(Q.priority.desc(), Q.created_at.asc()).limit(20).with_for_update(skip_locked=True))
+
+    def next_visible_orm():
+        future_due = func.min(case((Q.deliver_after > now, Q.deliver_after)))
+        lease_expiry = func.min(case((and_(Q.leased_until > now, Q.lease_owner != owner), Q.leased_until)))
+        return session.query(future_due, lease_expiry).filter(and_(Q.target_user_id == uid, Q.delivered == False))
+
+    def messages_orm():
+        return session.query(Message).filter(Message.receiver_id == uid).order_by(Message.timestamp.desc())
+
+    def windows_orm():
+        return session.query(OpenWindow).filter(OpenWindow.class_id == cls.id)
+
+    def user_class_orm():
+        return session.query(User.class_id, User.managed_class_id).filter(User.id == uid)
+
+    def external_id_orm():
+        return session.query(User).filter(User.external_id == "bench-s")
+
+    # ---- 预构造语句 + 参数 ----
+    claim_stmt = outgoing._claim_stmt(False, True, True)
+    claim_params = {"now": now, "owner": owner, "limit": 20, "target_user_id": uid, "exclude_ids": exclude}
+    cases: List[Tuple[str, Callable, Callable, Callable, Callable]] = [
+        ("poll: claim_due",
+         lambda: claim_orm().statement._generate_cache_key(), lambda: claim_orm().all(),
+         lambda: claim_stmt._generate_cache_key(),
+         lambda: session.execute(claim_stmt, claim_params).scalars().all()),
+        ("poll: next_visible_at",
+         lambda: next_visible_orm().statement._generate_cache_key(), lambda: next_visible_orm().one(),
+         lambda: outgoing._next_visible_stmt()._generate_cache_key(),
+         lambda: session.execute(outgoing._next_visible_stmt(),
+                                 {"now": now, "owner": owner, "target_user_id": uid}).one()),
+        ("get_messages",
+         lambda: messages_orm().statement._generate_cache_key(), lambda: messages_orm().all(),
+         lambda: _MESSAGES_FOR_RECEIVER._generate_cache_key(),
+         lambda: session.execute(_MESSAGES_FOR_RECEIVER, {"receiver_id": uid}).scalars().all()),
+        ("get_messages: senders",
+         lambda: session.query(User).filter(User.id.in_([sender.id])).statement._generate_cache_key(),
+         lambda: session.query(User).filter(User.id.in_([sender.id])).all(),
+         lambda: _USERNAMES_BY_ID._generate_cache_key(),
+         lambda: session.execute(_USERNAMES_BY_ID, {"ids": [sender.id]}).all()),
+        ("open windows: load class",
+         lambda: windows_orm().statement._generate_cache_key(), lambda: windows_orm().all(),
+         lambda: openwindows._WINDOWS_OF_CLASS._generate_cache_key(),
+         lambda: session.execute(openwindows._WINDOWS_OF_CLASS, {"class_id": cls.id}).all()),
+        ("open windows: class of user",
+         lambda: user_class_orm().statement._generate_cache_key(), lambda: user_class_orm().first(),
+         lambda: openwindows._CLASS_OF_USER._generate_cache_key(),
+         lambda: session.execute(openwindows._CLASS_OF_USER, {"user_id": uid}).first()),
+        ("external_id lookup (cache miss)",
+         lambda: external_id_orm().statement._generate_cache_key(), lambda: external_id_orm().first(),
+         lambda: mdb._USER_ID_BY_EXTERNAL_ID._generate_cache_key(),
+         lambda: session.execute(mdb._USER_ID_BY_EXTERNAL_ID, {"external_id": "bench-s"}).scalar()),
+    ]
+
+    print(f"{mdb.engine.dialect.name}, {args.rows} rows, {args.number} calls per measurement (us/call)")
+    print(f"{'query':34} {'build before':>13} {'build after':>12} {'exec before':>12} {'exec after':>11} {'speedup':>8}")
+    for name, build_old, exec_old, build_new, exec_new in cases:
+        b0, b1 = _per_call(build_old, args.number), _per_call(build_new, args.number)
+        e0, e1 = _per_call(exec_old, max(1, args.number // 10)), _per_call(exec_new, max(1, args.number // 10))
+        session.rollback()
+        print(f"{name:34} {b0:13.1f} {b1:12.1f} {e0:12.1f} {e1:11.1f} {e0 / e1:7.2f}x")
+    session.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
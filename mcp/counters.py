@@ -0,0 +1,157 @@
+# mcp/counters.py
+"""
+outgoing_queue 未投递计数（按用户），避免面板 / 终端角标每次 COUNT(*) 全表。
+全局总数读取时对各用户行求和，不单独维护一行（单行会成为所有入队 / 确认事务争抢的热点锁）。
+
+- ORM 入队：Session 钩子在 flush 时按 target_user_id 累加
+- Core 批量入队：调用方显式 adjust_pending
+- 确认 / 标记已投递 / 删除：先 lock_queue_rows 锁住目标行，再 settle_pending 只扣减原本未投递的行，
+  并发重复确认不会重复扣减
+计数与业务写入在同一事务提交；若怀疑漂移，可用 rebuild_pending_counters 全量重算。
+"""
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, event, func, insert, literal, select, text, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from shared.models import OutgoingPendingCounter, OutgoingQueue
+
+logger = logging.getLogger("mcp.counters")
+
+SEED_LOCK_NAME = "outgoing_pending_counters_seed"  # MySQL GET_LOCK 名称，串行化多进程的初始重算
+
+_table = OutgoingPendingCounter.__table__
+
+
+def adjust_pending(conn: Connection, deltas: Dict[int, int]) -> None:
+    """
+    按 {target_user_id: 增量} 累加计数。UPSERT，不存在的行自动创建。
+    按主键升序更新，多个事务同时调整时加锁顺序一致，避免死锁。
+    """
+    deltas = {int(k): int(v) for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    rows = [{"target_user_id": uid, "pending": n} for uid, n in sorted(deltas.items())]
+    dialect = conn.dialect.name
+    if dialect == "mysql":
+        stmt = mysql_insert(_table)
+        stmt = stmt.on_duplicate_key_update(pending=_table.c.pending + stmt.inserted.pending)
+        conn.execute(stmt, rows)
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[_table.c.target_user_id],
+            set_={"pending": _table.c.pending + stmt.excluded.pending},
+        )
+        conn.execute(stmt, rows)
+    else:
+        for row in rows:
+            res = conn.execute(
+                update(_table)
+                .where(_table.c.target_user_id == row["target_user_id"])
+                .values(pending=_table.c.pending + row["pending"])
+            )
+            if res.rowcount == 0:
+                conn.execute(insert(_table).values(**row))
+
+
+def lock_queue_rows(db: Session, *criteria) -> List:
+    """锁住（FOR UPDATE）满足条件的队列行，返回 [(id, target_user_id, delivered)]。"""
+    return db.execute(
+        select(OutgoingQueue.id, OutgoingQueue.target_user_id, OutgoingQueue.delivered)
+        .where(*criteria)
+        .with_for_update()
+    ).all()
+
+
+def settle_pending(db: Session, rows: Iterable) -> None:
+    """lock_queue_rows 取到的行即将被标记已投递或删除：扣减其中原本未投递的行。"""
+    deltas = Counter(int(r.target_user_id) for r in rows if not r.delivered)
+    adjust_pending(db.connection(), {uid: -n for uid, n in deltas.items()})
+
+
+def recount_pending(db: Session, user_ids: Iterable[int]) -> None:
+    """按队列重算指定用户的计数（无法精确得知插入了哪些行时使用）。"""
+    ids = sorted({int(u) for u in user_ids})
+    if not ids:
+        return
+    actual = dict(db.execute(
+        select(OutgoingQueue.target_user_id, func.count())
+        .where(OutgoingQueue.target_user_id.in_(ids), OutgoingQueue.delivered == False)
+        .group_by(OutgoingQueue.target_user_id)
+    ).all())
+    current = dict(db.execute(
+        select(_table.c.target_user_id, _table.c.pending)
+        .where(_table.c.target_user_id.in_(ids))
+        .with_for_update()
+    ).all())
+    adjust_pending(db.connection(), {uid: actual.get(uid, 0) - current.get(uid, 0) for uid in ids})
+
+
+def pending_count(db: Session, user_id: Optional[int] = None) -> int:
+    """user_id 为 None 时返回全局总数（各用户行之和）。"""
+    if user_id is None:
+        n = db.execute(select(func.sum(_table.c.pending))).scalar()
+    else:
+        n = db.execute(select(_table.c.pending).where(_table.c.target_user_id == int(user_id))).scalar()
+    return max(int(n or 0), 0)
+
+
+def rebuild_pending_counters(db: Session) -> int:
+    """按 outgoing_queue 全量重算计数（一次 GROUP BY），返回全局未投递数。不提交。"""
+    pending = OutgoingQueue.delivered == False
+    db.execute(delete(_table))
+    db.execute(insert(_table).from_select(
+        ["target_user_id", "pending"],
+        select(OutgoingQueue.target_user_id, func.count()).where(pending).group_by(OutgoingQueue.target_user_id)
+    ))
+    return pending_count(db)
+
+
+def ensure_pending_counters(conn: Connection, lock_timeout: int = 30) -> bool:
+    """
+    计数表为空而队列里有未投递项（新建表 / 首次升级）时重算一次并提交；返回是否重算。由 init_db 调用。
+    多个进程同时初始化时，MySQL 上先取 GET_LOCK 再检查，后拿到锁的进程看到已有计数行即跳过；
+    SQLite 的写事务本身串行。
+    """
+    mysql = conn.dialect.name == "mysql"
+    if mysql:
+        got = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                           {"name": SEED_LOCK_NAME, "timeout": lock_timeout}).scalar()
+        conn.commit()
+        if not got:
+            raise RuntimeError(f"timed out waiting for lock {SEED_LOCK_NAME!r}")
+    try:
+        with conn.begin():
+            if conn.execute(select(literal(1)).select_from(_table).limit(1)).first():
+                return False
+            if not conn.execute(select(literal(1)).where(OutgoingQueue.delivered == False).limit(1)).first():
+                return False
+            total = rebuild_pending_counters(conn)
+        logger.info("Pending counters rebuilt from outgoing_queue (%d pending)", total)
+        return True
+    finally:
+        if mysql:
+            conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": SEED_LOCK_NAME})
+            conn.commit()
+
+
+def _count_enqueued(session, flush_context):
+    deltas = Counter(
+        int(obj.target_user_id) for obj in session.new
+        if isinstance(obj, OutgoingQueue) and obj.target_user_id is not None and not obj.delivered
+    )
+    if deltas:
+        adjust_pending(session.connection(), deltas)
+
+
+def install_counter_hooks(target=Session) -> None:
+    """ORM 新增的未投递行在同一次 flush 中计入。"""
+    if event.contains(target, "after_flush", _count_enqueued):
+        return
+    event.listen(target, "after_flush", _count_enqueued)
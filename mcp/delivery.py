@@ -0,0 +1,406 @@
+# mcp/delivery.py
+"""
+异步投递引擎：认领 outgoing_queue 中到期的项，并发回调 / 记录日志，批量提交结果。
+
+- 连接池化的 HTTP 客户端 + 并发上限（Semaphore）
+- "http_batch" 模式：按条数 / 字节预算把多项合并成一次回调，接收方逐项返回成功与否
+- 每项记录失败次数，按指数退避写 next_attempt_at
+- 超过 max_attempts 的项移入 outgoing_dead_letter
+- 一轮的结果（成功 / 退避 / 死信）在一个事务里提交
+"""
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, insert, update
+
+from shared.models import OutgoingQueue, OutgoingDeadLetter
+from .counters import lock_queue_rows, settle_pending
+from .outgoing import claim_due, delivery_owner, resolve_payloads, row_payload, DELIVERY_LEASE_SECONDS
+
+logger = logging.getLogger("mcp.delivery")
+
+DELIVERY_MODES = ("log", "http", "http_batch")
+BATCH_GROUP_BY = ("none", "target")
+
+
+class DeliveryEngine:
+    """由 /mcp/delivery/start|stop|status|config|trigger 控制；运行在应用的事件循环里。"""
+
+    def __init__(self, session_factory: Callable, now_fn: Callable[[], datetime]):
+        self._session_factory = session_factory
+        self._now = now_fn
+
+        # 配置（可通过 configure 修改）
+        self.mode = "log"            # DELIVERY_MODES 之一；非 "log" 模式必须配置 callback
+        self.callback: Optional[str] = None
+        self.poll_interval = 5       # 秒，空闲时的扫描间隔
+        self.batch_size = 100        # 每轮最多认领多少项（http_batch 模式下至少认领 batch_max_items 项）
+        self.concurrency = 20        # 同时进行的回调请求上限（也是连接池大小）
+        self.timeout = 5.0           # 单次回调超时（秒）
+        self.max_attempts = 8        # 超过后移入死信表
+        self.backoff_base = 5        # 秒；第 n 次失败后等待 base * 2^(n-1)
+        self.backoff_max = 3600      # 秒；退避上限
+        # http_batch 模式
+        self.batch_max_items = 500          # 单次回调最多多少项
+        self.batch_max_bytes = 1024 * 1024  # 单次回调 items 序列化后的大致字节上限
+        # "none"：跨用户按条数 / 字节预算装箱（默认）；"target"：一次回调只含同一用户的项
+        self.batch_group_by = "none"
+
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+        self._client = None
+        self._client_stale = False
+        # 同一进程内的投递轮次串行执行（后台循环与 /mcp/delivery/trigger 共用同一个租约 owner）
+        self._round_lock = asyncio.Lock()
+        self._stats = {"delivered": 0, "failed": 0, "dead_lettered": 0, "rounds": 0,
+                       "last_round_at": None, "last_error": None}
+
+    # ---------------- 配置 / 状态 ----------------
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def config(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "callback": self.callback,
+            "poll_interval": self.poll_interval,
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "timeout": self.timeout,
+            "max_attempts": self.max_attempts,
+            "backoff_base": self.backoff_base,
+            "backoff_max": self.backoff_max,
+            "batch_max_items": self.batch_max_items,
+            "batch_max_bytes": self.batch_max_bytes,
+            "batch_group_by": self.batch_group_by,
+        }
+
+    def status(self) -> Dict[str, Any]:
+        return {"running": self.running, **self.config(), "stats": dict(self._stats)}
+
+    def configure(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """校验并应用配置；非法值抛 ValueError（路由层转成 400）。"""
+        mode = body.get("mode")
+        if mode and mode not in DELIVERY_MODES:
+            raise ValueError("mode must be one of: " + ", ".join(repr(m) for m in DELIVERY_MODES))
+        callback = body["callback"] if body.get("callback") is not None else self.callback
+        self._require_callback(mode or self.mode, callback)
+        if mode:
+            self.mode = mode
+        self.callback = callback
+        group_by = body.get("batch_group_by")
+        if group_by:
+            if group_by not in BATCH_GROUP_BY:
+                raise ValueError("batch_group_by must be one of: " + ", ".join(repr(g) for g in BATCH_GROUP_BY))
+            self.batch_group_by = group_by
+        for key in ("poll_interval", "batch_size", "concurrency", "max_attempts", "backoff_base", "backoff_max",
+                    "batch_max_items", "batch_max_bytes"):
+            if body.get(key) is not None:
+                try:
+                    val = int(body[key])
+                except Exception:
+                    raise ValueError(f"{key} must be int")
+                if val < 1:
+                    raise ValueError(f"{key} must be >= 1")
+                setattr(self, key, val)
+        if body.get("timeout") is not None:
+            try:
+                self.timeout = float(body["timeout"])
+            except Exception:
+                raise ValueError("timeout must be number")
+        # 连接池大小 / 超时变化后，在下一轮开始前重建客户端（不打断进行中的请求）
+        if body.get("concurrency") is not None or body.get("timeout") is not None:
+            self._client_stale = True
+        return self.config()
+
+    @staticmethod
+    def _require_callback(mode: str, callback: Optional[str]) -> None:
+        if mode != "log" and not callback:
+            raise ValueError(f"callback is required for mode {mode!r}")
+
+    # ---------------- 启停 ----------------
+    async def start(self) -> bool:
+        if self.running:
+            return False
+        self._stop.clear()
+        self._task = asyncio.create_task(self._loop())
+        return True
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=self.timeout + 2)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+            except Exception:
+                pass
+            self._task = None
+        await self._close_client()
+
+    async def _loop(self):
+        logger.info("Delivery engine started (interval=%s, concurrency=%s)", self.poll_interval, self.concurrency)
+        while not self._stop.is_set():
+            try:
+                res = await self.run_once()
+                if res["count"] or res["failed"]:
+                    logger.info("Delivered %d items, failed %d, dead-lettered %d",
+                                res["count"], len(res["failed"]), len(res["dead_lettered"]))
+                # 满批说明可能还有积压，立即进行下一轮
+                if res["claimed"] >= self._claim_limit():
+                    continue
+            except Exception as e:
+                self._stats["last_error"] = str(e)
+                logger.exception("Unhandled error in delivery engine")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+        logger.info("Delivery engine stopped")
+
+    # ---------------- 一轮投递 ----------------
+    async def run_once(self) -> Dict[str, Any]:
+        async with self._round_lock:
+            return await self._run_round()
+
+    async def _run_round(self) -> Dict[str, Any]:
+        # 没有回调地址时不认领，否则这些项要等租约过期才能被别人取走
+        self._require_callback(self.mode, self.callback)
+        items = await run_in_threadpool(self._claim)
+        result = {"claimed": len(items), "count": 0, "processed": [], "failed": [], "dead_lettered": []}
+        if not items:
+            return result
+
+        outcomes = await self._deliver(items)
+        summary = await run_in_threadpool(self._commit, items, outcomes)
+        result.update(summary)
+        result["count"] = len(summary["processed"])
+
+        self._stats["rounds"] += 1
+        self._stats["last_round_at"] = self._now().isoformat()
+        self._stats["delivered"] += len(summary["processed"])
+        self._stats["failed"] += len(summary["failed"])
+        self._stats["dead_lettered"] += len(summary["dead_lettered"])
+        return result
+
+    def _claim_limit(self) -> int:
+        """每轮认领条数；http_batch 模式下认领量不少于一次回调的条数上限，否则批永远装不满。"""
+        if self.mode == "http_batch":
+            return max(self.batch_size, self.batch_max_items)
+        return self.batch_size
+
+    def _claim(self) -> List[Dict[str, Any]]:
+        db = self._session_factory()
+        try:
+            rows = claim_due(db, delivery_owner(), self._now(), self._claim_limit(),
+                             DELIVERY_LEASE_SECONDS, retry_ready=True)
+            payloads = resolve_payloads(db, rows)
+            items = [{
+                "id": r.id,
+                "target_user_id": r.target_user_id,
+                "payload": row_payload(r, payloads),
+                "priority": r.priority,
+                "attempts": int(r.attempts or 0),
+                "created_at": r.created_at,
+            } for r in rows]
+            db.commit()
+            return items
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _deliver(self, items: List[Dict[str, Any]]) -> Dict[int, Optional[str]]:
+        """返回 {queue_id: None(成功) / 错误信息}。"""
+        if self._client_stale:
+            self._client_stale = False
+            await self._close_client()
+        if self.mode == "log":
+            for item in items:
+                logger.info("Deliver (log-mode) queue_id=%s target_user=%s payload=%s",
+                            item["id"], item["target_user_id"], item["payload"])
+            return {item["id"]: None for item in items}
+
+        sem = asyncio.Semaphore(self.concurrency)
+        if self.mode == "http_batch":
+            async def batch(chunk):
+                async with sem:
+                    return await self._post_batch(chunk)
+
+            outcomes: Dict[int, Optional[str]] = {}
+            for part in await asyncio.gather(*(batch(c) for c in self._chunks(items))):
+                outcomes.update(part)
+            return outcomes
+
+        async def one(item):
+            async with sem:
+                return item["id"], await self._post_one(item)
+
+        return dict(await asyncio.gather(*(one(i) for i in items)))
+
+    async def _post_one(self, item: Dict[str, Any]) -> Optional[str]:
+        try:
+            resp = await self._http().post(self.callback, json={
+                "queue_id": item["id"],
+                "target_user_id": item["target_user_id"],
+                "payload": item["payload"],
+            })
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+        if 200 <= resp.status_code < 300:
+            return None
+        return f"callback_status:{resp.status_code}"
+
+    @staticmethod
+    def _wire_item(item: Dict[str, Any]) -> Dict[str, Any]:
+        return {"queue_id": item["id"], "target_user_id": item["target_user_id"], "payload": item["payload"]}
+
+    def _chunks(self, items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """按 batch_group_by 分组，再按条数 / 字节预算切块（单项超预算时单独成块）。"""
+        if self.batch_group_by == "target":
+            groups: Dict[int, List[Dict[str, Any]]] = {}
+            for item in items:
+                groups.setdefault(item["target_user_id"], []).append(item)
+            grouped = list(groups.values())
+        else:
+            grouped = [items]
+
+        chunks = []
+        for group in grouped:
+            cur, cur_bytes = [], 0
+            for item in group:
+                size = len(json.dumps(self._wire_item(item), ensure_ascii=False, default=str).encode("utf-8"))
+                if cur and (len(cur) >= self.batch_max_items or cur_bytes + size > self.batch_max_bytes):
+                    chunks.append(cur)
+                    cur, cur_bytes = [], 0
+                cur.append(item)
+                cur_bytes += size
+            if cur:
+                chunks.append(cur)
+        return chunks
+
+    async def _post_batch(self, chunk: List[Dict[str, Any]]) -> Dict[int, Optional[str]]:
+        """
+        POST {"items": [{queue_id, target_user_id, payload}, ...]}。
+        接收方返回 {"results": [{"queue_id": 1, "ok": true} | {"queue_id": 2, "ok": false, "error": "..."}]}；
+        响应里没有提到的项按失败处理，留在队列里按退避重试。
+        """
+        ids = [item["id"] for item in chunk]
+        try:
+            resp = await self._http().post(self.callback, json={"items": [self._wire_item(i) for i in chunk]})
+        except Exception as e:
+            err = str(e) or e.__class__.__name__
+            return {i: err for i in ids}
+        if not 200 <= resp.status_code < 300:
+            return {i: f"callback_status:{resp.status_code}" for i in ids}
+        try:
+            results = resp.json().get("results") or []
+        except Exception:
+            return {i: "callback_bad_response" for i in ids}
+
+        outcomes: Dict[int, Optional[str]] = {i: "callback_no_result" for i in ids}
+        for r in results:
+            try:
+                qid = int(r.get("queue_id"))
+            except Exception:
+                continue
+            if qid in outcomes:
+                outcomes[qid] = None if r.get("ok") else str(r.get("error") or "callback_item_failed")
+        return outcomes
+
+    def _backoff(self, attempts: int) -> timedelta:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(0, attempts - 1)))
+        # 少量抖动，避免同一批失败项在同一时刻一起重试
+        return timedelta(seconds=delay + random.uniform(0, self.backoff_base))
+
+    def _commit(self, items: List[Dict[str, Any]], outcomes: Dict[int, Optional[str]]) -> Dict[str, List[int]]:
+        now = self._now()
+        owner = delivery_owner()
+        ok_ids, retry_rows, dead_rows = [], [], []
+        for item in items:
+            err = outcomes.get(item["id"], "no_result")
+            if err is None:
+                ok_ids.append(item["id"])
+                continue
+            attempts = item["attempts"] + 1
+            logger.warning("Delivery failed queue_id=%s attempt=%d: %s", item["id"], attempts, err)
+            if attempts >= self.max_attempts:
+                dead_rows.append({**item, "attempts": attempts, "last_error": err})
+            else:
+                retry_rows.append({
+                    "id": item["id"],
+                    "attempts": attempts,
+                    "next_attempt_at": now + self._backoff(attempts),
+                    "last_error": err[:255],
+                    "leased_until": None,
+                    "lease_owner": None,
+                })
+
+        db = self._session_factory()
+        try:
+            # 三种结果都只作用于仍由本进程持有租约、尚未投递的行：
+            # 租约过期后被别人认领或已被确认的行不覆盖、不移入死信；锁行后按原状态扣减未投递计数
+            ids = ok_ids + [r["id"] for r in retry_rows] + [d["id"] for d in dead_rows]
+            owned = {r.id: r for r in lock_queue_rows(
+                db, OutgoingQueue.id.in_(ids), OutgoingQueue.lease_owner == owner, OutgoingQueue.delivered == False
+            )}
+            processed = [i for i in ok_ids if i in owned]
+            retry_rows = [r for r in retry_rows if r["id"] in owned]
+            dead_rows = [d for d in dead_rows if d["id"] in owned]
+            if processed:
+                db.execute(
+                    update(OutgoingQueue)
+                    .where(OutgoingQueue.id.in_(processed))
+                    .values(delivered=True, delivered_at=now, leased_until=None, lease_owner=None)
+                )
+                settle_pending(db, [owned[i] for i in processed])
+            if retry_rows:
+                db.execute(update(OutgoingQueue), retry_rows)
+            if dead_rows:
+                db.execute(insert(OutgoingDeadLetter), [{
+                    "queue_id": d["id"],
+                    "target_user_id": d["target_user_id"],
+                    "payload": d["payload"],
+                    "priority": d["priority"],
+                    "attempts": d["attempts"],
+                    "last_error": d["last_error"],
+                    "created_at": d["created_at"],
+                    "failed_at": now,
+                } for d in dead_rows])
+                db.execute(delete(OutgoingQueue).where(OutgoingQueue.id.in_([d["id"] for d in dead_rows])))
+                settle_pending(db, [owned[d["id"]] for d in dead_rows])
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("commit failed for delivery round (%d items)", len(items))
+            raise
+        finally:
+            db.close()
+        return {
+            "processed": processed,
+            "failed": [r["id"] for r in retry_rows],
+            "dead_lettered": [d["id"] for d in dead_rows],
+        }
+
+    # ---------------- HTTP 客户端 ----------------
+    def _http(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
+            )
+        return self._client
+
+    async def _close_client(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
@@ -0,0 +1,295 @@
+# mcp/fanout.py
+"""
+群发任务：接口只创建 fanout_jobs 记录并立即返回 job_id，
+后台按 user id 升序分块解析收件人并批量入队，每块一个事务（入队 + 推进 cursor 同时提交）。
+进程中途退出或某块失败时，任务租约过期后从 cursor 处继续，已提交的块不会重复。
+"""
+import asyncio
+import bisect
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, func, or_, select
+
+from shared.models import FanoutJob, OutgoingQueue, User, UserRole
+from .outgoing import WORKER_ID, bulk_enqueue
+from .roster import roster_cache
+
+logger = logging.getLogger("mcp.fanout")
+
+JOB_LEASE_SECONDS = 60
+
+
+def fanout_owner() -> str:
+    return f"fanout:{WORKER_ID}"
+
+
+def audience_filter(audience: Dict[str, Any]):
+    """把任务的 audience 转为 User 上的过滤条件；为空表示全体用户，返回 None。"""
+    conds = []
+    class_ids = [int(c) for c in (audience.get("class_ids") or [])]
+    if class_ids:
+        conds.append(User.class_id.in_(class_ids))
+    roles = []
+    for r in audience.get("roles") or []:
+        try:
+            roles.append(UserRole(r))
+        except ValueError:
+            roles.append(r)
+    if roles:
+        conds.append(User.role.in_(roles))
+    if not conds:
+        return None
+    return and_(*conds) if audience.get("combine") == "and" else or_(*conds)
+
+
+def roster_audience(db, audience: Dict[str, Any]) -> Optional[List[int]]:
+    """
+    只按班级（或班级 AND 角色）圈定的 audience 直接从花名册缓存取收件人，返回升序 id 列表；
+    其它 audience（全体、按角色、班级 OR 角色）返回 None，由 users 表分块查询。
+    """
+    class_ids = [int(c) for c in (audience.get("class_ids") or [])]
+    roles = audience.get("roles") or []
+    if not class_ids or (roles and audience.get("combine") != "and"):
+        return None
+    ids = set()
+    for cid in class_ids:
+        members = roster_cache.members(db, cid)
+        ids.update(m.id for m in members if not roles or m.role in roles)
+    return sorted(ids)
+
+
+def create_job(db, kind: str, payload_id: int, audience: Dict[str, Any], now: datetime,
+               priority: str = "normal", deliver_after: Optional[datetime] = None,
+               created_by: Optional[int] = None) -> FanoutJob:
+    """创建任务（不提交）；调用方提交后再 fanout_worker.wake()。"""
+    job = FanoutJob(
+        kind=kind,
+        payload_id=payload_id,
+        priority=priority or "normal",
+        deliver_after=deliver_after,
+        audience=audience,
+        created_by=created_by,
+        status="pending",
+        created_at=now,
+    )
+    db.add(job)
+    db.flush()
+    return job
+
+
+def job_to_dict(job: FanoutJob) -> Dict[str, Any]:
+    done = int(job.enqueued or 0) + int(job.skipped or 0)
+    progress = None
+    if job.total:
+        progress = round(min(done / job.total, 1.0), 4)
+    elif job.status == "done":
+        progress = 1.0
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "total": job.total,
+        "enqueued": int(job.enqueued or 0),
+        "skipped": int(job.skipped or 0),
+        "progress": progress,
+        "cursor": int(job.cursor or 0),
+        "attempts": int(job.attempts or 0),
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class FanoutWorker:
+    """后台 worker：有新任务时被 wake() 立即唤醒，空闲时每 poll_interval 秒检查一次可继续的任务。"""
+
+    def __init__(self, session_factory: Callable, now_fn: Callable[[], datetime]):
+        self._session_factory = session_factory
+        self._now = now_fn
+
+        self.chunk_size = 500     # 每块收件人数（一个事务）
+        self.max_attempts = 5     # 同一任务连续失败次数上限
+        self.poll_interval = 5    # 秒
+
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop_ref: Optional[asyncio.AbstractEventLoop] = None
+
+    # ---------------- 生命周期 ----------------
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._loop_ref = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self) -> None:
+        """可在任意线程调用（同步路由在线程池中创建任务后调用）。"""
+        if self._loop_ref is None or self._wake is None:
+            return
+        try:
+            self._loop_ref.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:
+            pass
+
+    async def _loop(self):
+        while True:
+            try:
+                worked = await run_in_threadpool(self.run_pending)
+            except Exception:
+                logger.exception("Fanout worker round failed")
+                worked = 0
+            if worked:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    # ---------------- 处理 ----------------
+    def run_pending(self) -> int:
+        """认领一个任务并处理到结束（或失败），返回处理的任务数（0 / 1）。"""
+        job_id = self._claim()
+        if job_id is None:
+            return 0
+        while True:
+            try:
+                if self._process_chunk(job_id):
+                    break
+            except Exception as e:
+                logger.exception("Fanout job %s chunk failed", job_id)
+                self._record_failure(job_id, e)
+                break
+        return 1
+
+    def _claim(self) -> Optional[int]:
+        now = self._now()
+        owner = fanout_owner()
+        db = self._session_factory()
+        try:
+            job = db.execute(
+                select(FanoutJob)
+                .where(
+                    FanoutJob.status.in_(("pending", "running")),
+                    or_(FanoutJob.leased_until == None, FanoutJob.leased_until < now,
+                        FanoutJob.lease_owner == owner),
+                )
+                .order_by(FanoutJob.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            ).scalars().first()
+            if job is None:
+                db.rollback()
+                return None
+            job.status = "running"
+            job.lease_owner = owner
+            job.leased_until = now + timedelta(seconds=JOB_LEASE_SECONDS)
+            if job.started_at is None:
+                job.started_at = now
+            job_id = job.id
+            db.commit()
+            return job_id
+        finally:
+            db.close()
+
+    def _process_chunk(self, job_id: int) -> bool:
+        """处理下一块收件人；任务结束（完成或租约丢失）返回 True。"""
+        now = self._now()
+        owner = fanout_owner()
+        db = self._session_factory()
+        try:
+            job = db.get(FanoutJob, job_id, with_for_update=True)
+            if job is None or job.status != "running" or job.lease_owner != owner:
+                db.rollback()
+                return True
+
+            roster_ids = roster_audience(db, job.audience or {})
+            if roster_ids is not None:
+                if job.total is None:
+                    job.total = len(roster_ids)
+                start = bisect.bisect_right(roster_ids, int(job.cursor or 0))
+                chunk: List[int] = roster_ids[start:start + self.chunk_size]
+            else:
+                cond = audience_filter(job.audience or {})
+                base = select(User.id)
+                if cond is not None:
+                    base = base.where(cond)
+                if job.total is None:
+                    job.total = db.execute(
+                        select(func.count()).select_from(base.subquery())
+                    ).scalar() or 0
+
+                chunk = db.execute(
+                    base.where(User.id > int(job.cursor or 0)).order_by(User.id).limit(self.chunk_size)
+                ).scalars().all()
+
+            if chunk:
+                # 已有同一内容未投递项的用户跳过（重复提交同一通知等）
+                existing = set(db.execute(
+                    select(OutgoingQueue.target_user_id).where(
+                        OutgoingQueue.payload_id == job.payload_id,
+                        OutgoingQueue.target_user_id.in_(chunk),
+                        OutgoingQueue.delivered == False,
+                    )
+                ).scalars().all())
+                targets = [uid for uid in chunk if uid not in existing]
+                n = bulk_enqueue(db, targets, job.payload_id, job.priority, now, job.deliver_after)
+                job.enqueued = int(job.enqueued or 0) + n
+                job.skipped = int(job.skipped or 0) + (len(chunk) - n)
+                job.cursor = chunk[-1]
+
+            finished = len(chunk) < self.chunk_size
+            if finished:
+                job.status = "done"
+                job.finished_at = now
+                job.lease_owner = None
+                job.leased_until = None
+            else:
+                job.leased_until = now + timedelta(seconds=JOB_LEASE_SECONDS)
+            # max_attempts 限制的是“连续”失败：本块成功即清零
+            job.error = None
+            job.attempts = 0
+            db.commit()
+            return finished
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _record_failure(self, job_id: int, exc: Exception) -> None:
+        """记录错误并释放租约；未超过 max_attempts 时保持 running，下一轮从 cursor 继续。"""
+        db = self._session_factory()
+        try:
+            job = db.get(FanoutJob, job_id)
+            if job is None:
+                return
+            job.attempts = int(job.attempts or 0) + 1
+            job.error = str(exc)[:2000]
+            job.lease_owner = None
+            if job.attempts >= self.max_attempts:
+                job.status = "failed"
+                job.finished_at = self._now()
+                job.leased_until = None
+            else:
+                # 稍后重试，避免立即重复失败
+                job.leased_until = self._now() + timedelta(seconds=self.poll_interval)
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Failed to record fanout job %s failure", job_id)
+        finally:
+            db.close()
@@ -0,0 +1,157 @@
+# mcp/leader.py
+"""
+多 worker / 多实例部署时的领导者选举：scheduler_leases 表中一行租约，
+持有者每 renew_interval 秒续约，租约过期（持有进程退出 / 卡死）后其它进程在下一次尝试时接管。
+
+只有领导者运行会重复扫描、重复入队的单例循环（memo 提醒、每日一句定时器、保留清理）；
+投递引擎、群发任务按行租约（SKIP LOCKED）认领，可在所有 worker 上运行。
+租约时间用应用服务器时钟，各主机需保持时间同步。
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+
+from shared.models import SchedulerLease
+from .outgoing import WORKER_ID
+
+logger = logging.getLogger("mcp.leader")
+
+
+class LeaderElector:
+    def __init__(self, session_factory: Callable, now_fn: Callable[[], datetime], name: str = "scheduler"):
+        self._session_factory = session_factory
+        self._now = now_fn
+        self.name = name
+        self.owner = WORKER_ID
+        self.lease_seconds = int(os.environ.get("LEADER_LEASE_SECONDS", "15"))
+        self.renew_interval = max(1, self.lease_seconds // 3)
+
+        self.is_leader = False
+        self._lease_until: Optional[datetime] = None
+        self._on_elected: List[Callable[[], Awaitable[Any]]] = []
+        self._on_demoted: List[Callable[[], Awaitable[Any]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._changes = 0
+
+    def register(self, start: Callable[[], Awaitable[Any]], stop: Callable[[], Awaitable[Any]]) -> None:
+        """登记一个单例组件：当选时 start，失去领导权 / 关闭时 stop（按登记的逆序）。"""
+        self._on_elected.append(start)
+        self._on_demoted.insert(0, stop)
+
+    # ---------------- 租约 ----------------
+    def try_acquire(self) -> bool:
+        """获取或续约；返回本进程此刻是否持有租约。"""
+        now = self._now()
+        until = now + timedelta(seconds=self.lease_seconds)
+        db = self._session_factory()
+        try:
+            lease = db.get(SchedulerLease, self.name, with_for_update=True)
+            if lease is None:
+                db.add(SchedulerLease(name=self.name, owner=self.owner, leased_until=until,
+                                      acquired_at=now, heartbeat_at=now))
+                try:
+                    db.commit()
+                except IntegrityError:
+                    # 另一个进程同时插入了这一行，本轮放弃
+                    db.rollback()
+                    return False
+                self._lease_until = until
+                return True
+            if lease.owner == self.owner or lease.leased_until is None or lease.leased_until < now:
+                if lease.owner != self.owner:
+                    lease.owner = self.owner
+                    lease.acquired_at = now
+                lease.leased_until = until
+                lease.heartbeat_at = now
+                db.commit()
+                self._lease_until = until
+                return True
+            db.rollback()
+            return False
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def release(self) -> None:
+        """主动让出（关闭时），其它进程无需等待过期即可接管。"""
+        db = self._session_factory()
+        try:
+            lease = db.get(SchedulerLease, self.name, with_for_update=True)
+            if lease is not None and lease.owner == self.owner:
+                lease.leased_until = None
+                db.commit()
+            else:
+                db.rollback()
+        except Exception:
+            db.rollback()
+            logger.exception("Failed to release leader lease %s", self.name)
+        finally:
+            db.close()
+
+    # ---------------- 循环 ----------------
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+            await run_in_threadpool(self.release)
+
+    async def _loop(self):
+        while True:
+            try:
+                held = await run_in_threadpool(self.try_acquire)
+            except Exception:
+                logger.exception("Leader lease %s renewal failed", self.name)
+                # 续约失败且租约已到期：别人可能已接管，先停下单例循环
+                held = self.is_leader and self._lease_until is not None and self._now() < self._lease_until
+            if held and not self.is_leader:
+                await self._elect()
+            elif not held and self.is_leader:
+                await self._demote()
+            await asyncio.sleep(self.renew_interval)
+
+    async def _elect(self):
+        self.is_leader = True
+        self._changes += 1
+        logger.info("Became leader for %s (%s)", self.name, self.owner)
+        for cb in self._on_elected:
+            try:
+                await cb()
+            except Exception:
+                logger.exception("Leader start callback failed")
+
+    async def _demote(self):
+        self.is_leader = False
+        self._changes += 1
+        logger.info("Lost leadership for %s (%s)", self.name, self.owner)
+        for cb in self._on_demoted:
+            try:
+                await cb()
+            except Exception:
+                logger.exception("Leader stop callback failed")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "owner": self.owner,
+            "is_leader": self.is_leader,
+            "lease_until": self._lease_until.isoformat() if self._lease_until and self.is_leader else None,
+            "lease_seconds": self.lease_seconds,
+            "changes": self._changes,
+        }
@@ -0,0 +1,126 @@
+# mcp/notify.py
+"""
+进程内通知中心：按 target_user_id 登记等待者（长轮询 / 推送连接），
+outgoing_queue 入队事务提交后唤醒对应用户，等待期间不访问数据库。
+"""
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from shared.models import OutgoingQueue
+
+# session.info 中暂存“本事务入队了哪些用户”的 key
+_PENDING_KEY = "_notify_user_ids"
+
+
+class Listener:
+    """单个等待者。由 NotificationHub.register 在事件循环线程中创建。"""
+
+    __slots__ = ("user_id", "event", "loop")
+
+    def __init__(self, user_id: int, loop: asyncio.AbstractEventLoop):
+        self.user_id = user_id
+        self.event = asyncio.Event()
+        self.loop = loop
+
+    async def wait(self, timeout: Optional[float]) -> bool:
+        """等待通知；被唤醒返回 True，超时返回 False。唤醒后自动复位，可重复等待。"""
+        if timeout is not None and timeout <= 0:
+            fired = self.event.is_set()
+        else:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+                fired = True
+            except asyncio.TimeoutError:
+                fired = False
+        self.event.clear()
+        return fired
+
+
+class NotificationHub:
+    """user_id -> 等待者集合。notify 可在任意线程调用（线程池里的同步路由、后台线程）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners: Dict[int, Set[Listener]] = {}
+
+    def register(self, user_id: int) -> Listener:
+        listener = Listener(int(user_id), asyncio.get_running_loop())
+        with self._lock:
+            self._listeners.setdefault(listener.user_id, set()).add(listener)
+        return listener
+
+    def unregister(self, listener: Listener) -> None:
+        with self._lock:
+            group = self._listeners.get(listener.user_id)
+            if group is None:
+                return
+            group.discard(listener)
+            if not group:
+                del self._listeners[listener.user_id]
+
+    @contextmanager
+    def listen(self, user_id: int):
+        """先登记再查询，避免“查询后、等待前”到达的通知丢失。"""
+        listener = self.register(user_id)
+        try:
+            yield listener
+        finally:
+            self.unregister(listener)
+
+    def notify(self, user_id: int) -> None:
+        self.notify_many((user_id,))
+
+    def notify_many(self, user_ids: Iterable[int]) -> None:
+        with self._lock:
+            targets = [l for uid in set(user_ids) for l in self._listeners.get(int(uid), ())]
+        for listener in targets:
+            try:
+                listener.loop.call_soon_threadsafe(listener.event.set)
+            except RuntimeError:
+                # 事件循环已关闭（进程退出中），忽略
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._listeners),
+                "listeners": sum(len(g) for g in self._listeners.values()),
+            }
+
+
+notify_hub = NotificationHub()
+
+
+def notify_after_commit(session: Session, user_ids: Iterable[int]) -> None:
+    """Core 批量插入等绕过 ORM 的入队路径，手动登记需要在提交后唤醒的用户。"""
+    session.info.setdefault(_PENDING_KEY, set()).update(int(u) for u in user_ids)
+
+
+def _collect_enqueued(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, OutgoingQueue) and obj.target_user_id is not None:
+            session.info.setdefault(_PENDING_KEY, set()).add(int(obj.target_user_id))
+
+
+def _notify_on_commit(session):
+    user_ids = session.info.pop(_PENDING_KEY, None)
+    if user_ids:
+        notify_hub.notify_many(user_ids)
+
+
+def _discard_on_rollback(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def install_session_hooks(target=Session) -> None:
+    """在 Session 上挂钩：flush 时收集新入队的 target_user_id，commit 后统一唤醒。"""
+    if event.contains(target, "after_commit", _notify_on_commit):
+        return
+    event.listen(target, "after_flush", _collect_enqueued)
+    event.listen(target, "after_commit", _notify_on_commit)
+    event.listen(target, "after_rollback", _discard_on_rollback)
@@ -0,0 +1,218 @@
+# mcp/openwindows.py
+"""
+开放时段（open_windows）的编译缓存：把每个班级的时段编译成“一周中的分钟”位图，
+判断某一时刻是否开放只需一次移位运算，不再逐条解析 days_json / 'HH:MM'。
+
+学生命令的开放时段校验与后台 memo 提醒共用同一份缓存。
+本进程内新增 / 删除时段时调用 invalidate_class，注册 / 修改用户后调用 invalidate_user；
+其它 worker 的修改靠 TTL 过期后重新加载。
+"""
+import json
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, select, text
+
+from shared.models import OpenWindow, User
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+WEEKDAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+# 缓存未命中时的加载查询（预先构造，参数用 bindparam 传入）
+_WINDOWS_OF_CLASS = select(OpenWindow.id, OpenWindow.start_time, OpenWindow.end_time, OpenWindow.days_json).where(
+    OpenWindow.class_id == bindparam("class_id")
+)
+_CLASS_OF_USER = select(User.class_id, User.managed_class_id).where(User.id == bindparam("user_id"))
+_CLASS_OF_STUDENT = text("SELECT class_id FROM class_students WHERE student_id = :sid LIMIT 1")
+
+
+def _parse_hm(hm: str) -> int:
+    h, m = str(hm).split(":")
+    return int(h) * 60 + int(m)
+
+
+def _parse_days(days) -> List[int]:
+    """days_json -> 星期下标列表；为空表示每天。无法识别的名字忽略。"""
+    if isinstance(days, str):
+        try:
+            days = json.loads(days)
+        except Exception:
+            days = []
+    days = days or []
+    idx = [WEEKDAY_NAMES.index(d) for d in days if d in WEEKDAY_NAMES]
+    if days and not idx:
+        return []
+    return idx or list(range(7))
+
+
+def _span(start: int, end: int) -> int:
+    """[start, end) 分钟区间的位掩码（end 可超过一周，自动回绕）。"""
+    if end <= MINUTES_PER_WEEK:
+        return ((1 << (end - start)) - 1) << start
+    return _span(start, MINUTES_PER_WEEK) | _span(0, end - MINUTES_PER_WEEK)
+
+
+def compile_window(start_time: str, end_time: str, days_json) -> int:
+    """
+    把一个时段编译为一周分钟位图。语义与原逐条判断一致：
+      - start == end：所列日期全天开放
+      - start < end：所列日期的 [start, end)
+      - start > end（跨午夜）：所列日期的 [start, 24:00) 加次日的 [00:00, end)
+    days 为空表示每天。
+    """
+    st, et = _parse_hm(start_time), _parse_hm(end_time)
+    bits = 0
+    for d in _parse_days(days_json):
+        base = d * MINUTES_PER_DAY
+        if st == et:
+            bits |= _span(base, base + MINUTES_PER_DAY)
+        elif st < et:
+            bits |= _span(base + st, base + et)
+        else:
+            bits |= _span(base + st, base + MINUTES_PER_DAY + et)
+    return bits
+
+
+def minute_of_week(now: datetime) -> int:
+    """now 为北京时间（aware 或 naive 均可，只取本地字段）。"""
+    return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+
+class OpenWindowSchedule:
+    """class_id -> (整体位图, [(window_id, 位图)])；user_id -> class_id。均带 TTL。"""
+
+    def __init__(self, ttl: float = 60.0, user_ttl: float = 300.0):
+        self.ttl = ttl
+        self.user_ttl = user_ttl
+        self._lock = threading.Lock()
+        self._classes: Dict[int, Tuple[float, int, List[Tuple[int, int]]]] = {}
+        # 失效代数：invalidate_class / invalidate_user 递增（单个 / 全部），加载期间代数变了说明读到的可能是旧数据，不写回缓存
+        self._class_gen: Dict[int, int] = {}
+        self._class_epoch = 0
+        self._user_class: Dict[int, Tuple[float, Optional[int]]] = {}
+        self._user_gen: Dict[int, int] = {}
+        self._user_epoch = 0
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    # ---------------- 加载 ----------------
+    def _load_class(self, db, class_id: int) -> Tuple[int, List[Tuple[int, int]]]:
+        union, per_window = 0, []
+        for w in db.execute(_WINDOWS_OF_CLASS, {"class_id": int(class_id)}).all():
+            try:
+                bits = compile_window(w.start_time, w.end_time, w.days_json)
+            except Exception:
+                # 配置无法解析的时段忽略（与原逻辑一致）
+                continue
+            union |= bits
+            per_window.append((int(w.id), bits))
+        return union, per_window
+
+    def _class_entry(self, db, class_id: int) -> Tuple[int, List[Tuple[int, int]]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._classes.get(int(class_id))
+            if entry is not None and entry[0] > now:
+                self._stats["hits"] += 1
+                return entry[1], entry[2]
+            self._stats["misses"] += 1
+            gen = (self._class_epoch, self._class_gen.get(int(class_id), 0))
+        union, per_window = self._load_class(db, class_id)
+        with self._lock:
+            if gen == (self._class_epoch, self._class_gen.get(int(class_id), 0)):
+                self._classes[int(class_id)] = (now + self.ttl, union, per_window)
+        return union, per_window
+
+    def class_for_user(self, db, user_id: int) -> Optional[int]:
+        """学生 class_id / 教师 managed_class_id，都没有时回退 class_students 表。"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._user_class.get(int(user_id))
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            gen = (self._user_epoch, self._user_gen.get(int(user_id), 0))
+        class_id = None
+        row = db.execute(_CLASS_OF_USER, {"user_id": int(user_id)}).first()
+        if row is not None:
+            class_id = row.class_id or row.managed_class_id
+            if class_id is None:
+                try:
+                    res = db.execute(_CLASS_OF_STUDENT, {"sid": int(user_id)}).fetchone()
+                    class_id = res[0] if res else None
+                except Exception:
+                    class_id = None
+        with self._lock:
+            if gen == (self._user_epoch, self._user_gen.get(int(user_id), 0)):
+                self._user_class[int(user_id)] = (now + self.user_ttl, class_id)
+        return class_id
+
+    # ---------------- 查询 ----------------
+    def class_open_at(self, db, class_id: int, now: datetime) -> bool:
+        union, _ = self._class_entry(db, class_id)
+        return bool((union >> minute_of_week(now)) & 1)
+
+    def windows_open_at(self, db, class_id: int, now: datetime) -> List[int]:
+        """该班级此刻处于开放状态的时段 id 列表（memo 提醒按时段去重用）。"""
+        _, per_window = self._class_entry(db, class_id)
+        m = minute_of_week(now)
+        return [wid for wid, bits in per_window if (bits >> m) & 1]
+
+    def next_open_on(self, db, class_id: int, day: date, after: datetime) -> Optional[Tuple[datetime, int]]:
+        """
+        day 当天、不早于 after 的第一个开放分钟：返回 (北京时间 naive datetime, window_id)，当天不再开放返回 None。
+        after 所在分钟正处于开放状态时返回 after 本身（memo 提醒据此设置 deliver_after）。
+        """
+        after = after.replace(tzinfo=None)
+        if after.date() > day:
+            return None
+        _, per_window = self._class_entry(db, class_id)
+        day_start = day.weekday() * MINUTES_PER_DAY
+        offset = after.hour * 60 + after.minute if after.date() == day else 0
+        span = MINUTES_PER_DAY - offset
+        best: Optional[Tuple[int, int]] = None
+        for wid, bits in per_window:
+            mask = (bits >> (day_start + offset)) & ((1 << span) - 1)
+            if mask:
+                first = (mask & -mask).bit_length() - 1
+                if best is None or first < best[0]:
+                    best = (first, wid)
+        if best is None:
+            return None
+        at = datetime.combine(day, datetime.min.time()) + timedelta(minutes=offset + best[0])
+        return max(at, after), best[1]
+
+    def user_open_at(self, db, user_id: int, now: datetime) -> bool:
+        class_id = self.class_for_user(db, user_id)
+        if class_id is None:
+            return False
+        return self.class_open_at(db, class_id, now)
+
+    # ---------------- 失效 ----------------
+    def invalidate_class(self, class_id: Optional[int] = None) -> None:
+        with self._lock:
+            if class_id is None:
+                self._classes.clear()
+                self._class_epoch += 1
+            else:
+                self._classes.pop(int(class_id), None)
+                self._class_gen[int(class_id)] = self._class_gen.get(int(class_id), 0) + 1
+            self._stats["invalidations"] += 1
+
+    def invalidate_user(self, user_id: Optional[int] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                self._user_class.clear()
+                self._user_epoch += 1
+            else:
+                self._user_class.pop(int(user_id), None)
+                self._user_gen[int(user_id)] = self._user_gen.get(int(user_id), 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"classes": len(self._classes), "users": len(self._user_class), **self._stats}
+
+
+open_window_schedule = OpenWindowSchedule()
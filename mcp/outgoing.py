@@ -0,0 +1,318 @@
+# mcp/outgoing.py
+"""
+outgoing_queue 的认领（租约）逻辑。
+
+多个 uvicorn worker、投递线程、终端 poll 可能同时取同一批未投递行；
+这里用 SELECT ... FOR UPDATE SKIP LOCKED 原子认领，并写入 leased_until / lease_owner。
+租约过期未确认的行重新对所有投递者可见。
+
+群发内容存一份在 outgoing_payloads，队列行只带 payload_id；读取时用 resolve_payloads 一次批量取回。
+"""
+import base64
+import hashlib
+import json
+import os
+import socket
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, case, func, insert, or_, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from shared.models import OutgoingPayload, OutgoingQueue
+from .counters import adjust_pending, recount_pending
+from .notify import notify_after_commit
+
+# 本进程标识（写入 lease_owner，便于排查是谁持有租约）
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+POLL_LEASE_SECONDS = 60      # 终端 poll / stream 认领后需在此时间内 ack
+DELIVERY_LEASE_SECONDS = 60  # 投递线程认领后的处理时限
+
+
+def terminal_owner(user_id: int) -> str:
+    """同一用户的 poll 与 stream 共用一个 owner：终端重连/重复 poll 能立刻拿回自己未 ack 的项。"""
+    return f"terminal:{int(user_id)}"
+
+
+def delivery_owner() -> str:
+    return f"delivery:{WORKER_ID}"
+
+
+def _due_filter(now: datetime):
+    return and_(
+        OutgoingQueue.delivered == False,
+        or_(OutgoingQueue.deliver_after == None, OutgoingQueue.deliver_after <= now),
+    )
+
+
+def _lease_free(owner: str, now: datetime):
+    """未被认领、租约已过期，或本来就是自己持有的租约。"""
+    return or_(
+        OutgoingQueue.leased_until == None,
+        OutgoingQueue.leased_until < now,
+        OutgoingQueue.lease_owner == owner,
+    )
+
+
+# ---------------- 热路径语句 ----------------
+# poll / stream / 投递引擎每次认领都执行同一形状的查询：语句按形状构造一次并缓存，参数用 bindparam 传入，
+# 不再每次经 ORM Query 重建表达式、重新生成编译缓存键（见 python -m mcp.bench_statements）。
+
+@lru_cache(maxsize=None)
+def _claim_stmt(retry_ready: bool, by_user: bool, exclude: bool):
+    now = bindparam("now")
+    stmt = select(OutgoingQueue).where(_due_filter(now), _lease_free(bindparam("owner"), now))
+    if retry_ready:
+        stmt = stmt.where(or_(OutgoingQueue.next_attempt_at == None, OutgoingQueue.next_attempt_at <= now))
+    if by_user:
+        stmt = stmt.where(OutgoingQueue.target_user_id == bindparam("target_user_id"))
+    if exclude:
+        stmt = stmt.where(OutgoingQueue.id.notin_(bindparam("exclude_ids", expanding=True)))
+    return (
+        stmt.order_by(OutgoingQueue.priority.desc(), OutgoingQueue.created_at.asc())
+        .limit(bindparam("limit"))
+        .with_for_update(skip_locked=True)
+    )
+
+
+@lru_cache(maxsize=None)
+def _next_visible_stmt():
+    now = bindparam("now")
+    future_due = func.min(case((OutgoingQueue.deliver_after > now, OutgoingQueue.deliver_after)))
+    lease_expiry = func.min(case((
+        and_(OutgoingQueue.leased_until > now, OutgoingQueue.lease_owner != bindparam("owner")),
+        OutgoingQueue.leased_until,
+    )))
+    return select(future_due, lease_expiry).where(
+        OutgoingQueue.target_user_id == bindparam("target_user_id"), OutgoingQueue.delivered == False
+    )
+
+
+_PAYLOADS_BY_ID = select(OutgoingPayload.id, OutgoingPayload.payload).where(
+    OutgoingPayload.id.in_(bindparam("ids", expanding=True))
+)
+
+
+def claim_due(
+    db: Session,
+    owner: str,
+    now: datetime,
+    limit: int,
+    lease_seconds: int,
+    target_user_id: Optional[int] = None,
+    exclude_ids: Optional[Iterable[int]] = None,
+    retry_ready: bool = False,
+) -> List[OutgoingQueue]:
+    """
+    认领最多 limit 条可投递行并续上租约。被其它事务锁住的行直接跳过（SKIP LOCKED）。
+    retry_ready=True 时跳过仍在退避期（next_attempt_at 未到）的行（投递引擎用）。
+    不在这里提交：调用方读取所需字段后 commit，行锁随之释放，租约保留。
+    """
+    exclude = list(exclude_ids) if exclude_ids else None
+    stmt = _claim_stmt(retry_ready, target_user_id is not None, exclude is not None)
+    params = {"now": now, "owner": owner, "limit": int(limit)}
+    if target_user_id is not None:
+        params["target_user_id"] = int(target_user_id)
+    if exclude is not None:
+        params["exclude_ids"] = exclude
+    rows = db.execute(stmt, params).scalars().all()
+    until = now + timedelta(seconds=lease_seconds)
+    for r in rows:
+        r.leased_until = until
+        r.lease_owner = owner
+    return rows
+
+
+def next_visible_at(db: Session, owner: str, now: datetime, target_user_id: int) -> Optional[datetime]:
+    """
+    该用户下一条项何时变为可认领：最近的未来 deliver_after，或他人租约的最早过期时间。
+    供长轮询 / 推送连接决定最长等待时间。
+    """
+    row: Tuple[Optional[datetime], Optional[datetime]] = db.execute(
+        _next_visible_stmt(), {"now": now, "owner": owner, "target_user_id": int(target_user_id)}
+    ).one()
+    candidates = [t for t in row if t is not None]
+    return min(candidates) if candidates else None
+
+
+
+# ---------------- 共享 payload ----------------
+def payload_hash_key(payload: Dict[str, Any]) -> str:
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return "sha256:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_or_create_payload(db: Session, payload: Dict[str, Any], now: datetime,
+                          ref_key: Optional[str] = None) -> int:
+    """
+    返回共享 payload 的 id。ref_key 缺省按内容哈希，相同内容只存一份。
+    并发插入同一 ref_key 时唯一约束冲突，回退到读取已存在的行。不在这里提交。
+    """
+    key = ref_key or payload_hash_key(payload)
+    row = db.query(OutgoingPayload.id, OutgoingPayload.last_used_at).filter(OutgoingPayload.ref_key == key).first()
+    if row is not None:
+        # 按天刷新使用时间，保留清理只回收长期无人引用的内容
+        if row.last_used_at is None or row.last_used_at < now - timedelta(days=1):
+            db.query(OutgoingPayload).filter(OutgoingPayload.id == row.id).update(
+                {OutgoingPayload.last_used_at: now}, synchronize_session=False)
+        return row.id
+    try:
+        with db.begin_nested():
+            obj = OutgoingPayload(ref_key=key, payload=payload, created_at=now, last_used_at=now)
+            db.add(obj)
+            db.flush()
+        return obj.id
+    except IntegrityError:
+        return db.query(OutgoingPayload.id).filter(OutgoingPayload.ref_key == key).scalar()
+
+
+def resolve_payloads(db: Session, rows: Iterable[Any]) -> Dict[int, Dict[str, Any]]:
+    """收集行中引用的 payload_id，一次 IN 查询取回 {payload_id: payload}。行只需有 payload / payload_id 属性。"""
+    ids = {r.payload_id for r in rows if r.payload is None and r.payload_id is not None}
+    if not ids:
+        return {}
+    found = db.execute(_PAYLOADS_BY_ID, {"ids": list(ids)}).all()
+    return {pid: payload for pid, payload in found}
+
+
+def row_payload(row: Any, payloads: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    """行内 payload 优先，否则取共享 payload；引用已被清理时返回空 dict。"""
+    if row.payload is not None:
+        return row.payload
+    return payloads.get(row.payload_id) or {}
+
+
+# ---------------- 批量入队 ----------------
+BULK_INSERT_CHUNK = 1000
+
+
+def bulk_enqueue(db: Session, target_user_ids: Iterable[int], payload_id: int, priority: str,
+                 now: datetime, deliver_after: Optional[datetime] = None) -> int:
+    """
+    给一组用户各插入一行引用同一 payload 的队列项（Core executemany，分块），
+    并登记未投递计数与提交后唤醒（绕过 ORM，flush 钩子看不到这些行）。不提交，返回插入行数。
+    """
+    user_ids = [int(u) for u in target_user_ids]
+    for i in range(0, len(user_ids), BULK_INSERT_CHUNK):
+        db.execute(insert(OutgoingQueue), [{
+            "target_user_id": uid,
+            "payload_id": payload_id,
+            "priority": priority,
+            "deliver_after": deliver_after,
+            "created_at": now,
+        } for uid in user_ids[i:i + BULK_INSERT_CHUNK]])
+    if user_ids:
+        adjust_pending(db.connection(), {uid: 1 for uid in user_ids})
+        notify_after_commit(db, user_ids)
+    return len(user_ids)
+
+
+def _insert_ignore(dialect: str):
+    """唯一键冲突时跳过该行的 INSERT（MySQL: INSERT IGNORE；SQLite: ON CONFLICT DO NOTHING）。"""
+    table = OutgoingQueue.__table__
+    if dialect == "mysql":
+        return mysql_insert(table).prefix_with("IGNORE")
+    if dialect == "sqlite":
+        return sqlite_insert(table).on_conflict_do_nothing()
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    return pg_insert(table).on_conflict_do_nothing()
+
+
+def enqueue_deduped(db: Session, rows: List[Dict[str, Any]]) -> int:
+    """
+    按 dedupe_key 幂等入队：先一次 IN 查询滤掉已存在的 key，剩余的用 INSERT IGNORE 批量写入，
+    并发写入同一 key 时由唯一索引兜底。rows 每项需含 dedupe_key / target_user_id / created_at，
+    以及 payload 或 payload_id 等列（各行列集合一致）。不提交，返回实际插入行数。
+    """
+    by_key: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        by_key.setdefault(r["dedupe_key"], r)
+    keys = list(by_key)
+    for i in range(0, len(keys), BULK_INSERT_CHUNK):
+        chunk = keys[i:i + BULK_INSERT_CHUNK]
+        for k in db.execute(select(OutgoingQueue.dedupe_key).where(OutgoingQueue.dedupe_key.in_(chunk))).scalars():
+            by_key.pop(k, None)
+    fresh = list(by_key.values())
+    if not fresh:
+        return 0
+
+    stmt = _insert_ignore(db.get_bind().dialect.name)
+    inserted = 0
+    for i in range(0, len(fresh), BULK_INSERT_CHUNK):
+        inserted += db.execute(stmt, fresh[i:i + BULK_INSERT_CHUNK]).rowcount
+
+    targets = [int(r["target_user_id"]) for r in fresh]
+    if inserted == len(fresh):
+        deltas: Dict[int, int] = {}
+        for uid in targets:
+            deltas[uid] = deltas.get(uid, 0) + 1
+        adjust_pending(db.connection(), deltas)
+    else:
+        # 与并发写入撞 key，无法得知哪些行是本次插入的：按队列重算这些用户
+        recount_pending(db, targets)
+    notify_after_commit(db, targets)
+    return inserted
+
+
+# ---------------- 管理列表的游标（keyset）分页 ----------------
+def list_order(backwards: bool = False):
+    """
+    列表顺序：(priority_rank desc, created_at desc, id desc)；backwards=True 为其逆序（向前翻页时使用）。
+    与 ix_outgoing_rank_created / ix_outgoing_target_rank_created 的列顺序一致，可按索引顺序读、不额外排序。
+    """
+    cols = (OutgoingQueue.priority_rank, OutgoingQueue.created_at, OutgoingQueue.id)
+    return [c.asc() if backwards else c.desc() for c in cols]
+
+
+def encode_list_cursor(row: OutgoingQueue) -> str:
+    key = [int(row.priority_rank), row.created_at.isoformat(), int(row.id)]
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_list_cursor(cursor: str) -> Tuple[int, datetime, int]:
+    """解析 encode_list_cursor 生成的游标；格式不对抛 ValueError。"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        rank, created_at, row_id = json.loads(raw)
+        return int(rank), datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+def keyset_filter(cursor: Tuple[int, datetime, int], backwards: bool = False):
+    """
+    取游标之后（backwards=True 时为之前）的行。展开成 OR/AND 而非行值比较，
+    兼容不支持 (a, b, c) < (x, y, z) 的数据库。
+    """
+    rank, created_at, row_id = cursor
+    r = OutgoingQueue.priority_rank
+    if backwards:
+        return or_(r > rank, and_(r == rank, or_(
+            OutgoingQueue.created_at > created_at,
+            and_(OutgoingQueue.created_at == created_at, OutgoingQueue.id > row_id),
+        )))
+    return or_(r < rank, and_(r == rank, or_(
+        OutgoingQueue.created_at < created_at,
+        and_(OutgoingQueue.created_at == created_at, OutgoingQueue.id < row_id),
+    )))
+
+
+def estimate_count(db: Session, query) -> Optional[int]:
+    """
+    用优化器统计估算行数（MySQL：EXPLAIN 的 rows），不扫描全表。
+    其它数据库没有廉价的估算，返回 None，由调用方决定是否退回精确计数。
+    """
+    bind = db.get_bind()
+    if bind.dialect.name != "mysql":
+        return None
+    sql = query.statement.compile(dialect=bind.dialect, compile_kwargs={"literal_binds": True})
+    plan = db.execute(text(f"EXPLAIN {sql}")).mappings().first()
+    if not plan or plan.get("rows") is None:
+        return None
+    filtered = plan.get("filtered")
+    return int(int(plan["rows"]) * (float(filtered) if filtered is not None else 100.0) / 100.0)
@@ -0,0 +1,264 @@
+# mcp/quotes.py
+"""
+每日一句定时广播：启动时加载所有启用的 daily_quotes，按下一次触发时间放入小顶堆，
+睡到最早的触发时间再入队，不再每分钟扫全表比较 broadcast_time。
+
+- 本进程修改某条 quote 时 reload_quote 增量更新（旧堆项按版本号惰性作废）
+- 每 change_poll_interval 秒查一次 daily_quotes 的 (行数, 最大 id, revision 之和)，
+  与上次加载时不同（其它 worker 新建 / 修改 / 删除）则全量重载
+- 每 reload_interval 秒全量重载一次，兜底直接改库的变更
+- 记录实际触发时间与计划时间的差（lag），错过的分钟在 status 中可见
+"""
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func
+
+from shared.models import DailyQuote
+
+logger = logging.getLogger("mcp.quotes")
+
+
+def _parse_hm(hm: Optional[str]) -> Optional[Tuple[int, int]]:
+    try:
+        h, m = str(hm).split(":")
+        h, m = int(h), int(m)
+    except Exception:
+        return None
+    if not (0 <= h < 24 and 0 <= m < 60):
+        return None
+    return h, m
+
+
+class DailyQuoteScheduler:
+    """
+    fire_fn(quote_id, day) 在线程池中执行实际入队（幂等，由 dedupe_key 保证），返回入队条数。
+    now_fn 返回北京时间 naive datetime。
+    """
+
+    def __init__(self, session_factory: Callable, now_fn: Callable[[], datetime],
+                 fire_fn: Callable[[int, date], int]):
+        self._session_factory = session_factory
+        self._now = now_fn
+        self._fire = fire_fn
+
+        self.reload_interval = 600   # 秒，全量重载间隔
+        self.change_poll_interval = 15  # 秒，检查 daily_quotes 是否被其它 worker 修改
+        self.grace_seconds = 120     # 启动 / 重载时，计划时间已过去不超过该秒数的仍补发
+        self.late_threshold = 60     # lag 超过该秒数计为 late（错过了计划的那一分钟）
+
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[datetime, int, int]] = []      # (计划时间, quote_id, 版本)
+        self._entries: Dict[int, Tuple[int, Tuple[int, int]]] = {}  # quote_id -> (版本, (h, m))
+        self._fired_on: Dict[int, date] = {}
+        self._version = 0
+
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop_ref: Optional[asyncio.AbstractEventLoop] = None
+        self._last_reload = 0.0
+        self._last_check = 0.0
+        self._fingerprint: Optional[Tuple[Any, ...]] = None
+        self._stats: Dict[str, Any] = {
+            "fired": 0, "enqueued": 0, "late": 0, "errors": 0,
+            "last_lag": None, "max_lag": 0.0, "total_lag": 0.0, "last_fire_at": None,
+        }
+
+    # ---------------- 生命周期 ----------------
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._loop_ref = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _kick(self) -> None:
+        if self._loop_ref is None or self._wake is None:
+            return
+        try:
+            self._loop_ref.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:
+            pass
+
+    # ---------------- 计划 ----------------
+    def _next_fire(self, quote_id: int, hm: Tuple[int, int], now: datetime) -> datetime:
+        """今天的计划时间（未触发且未超过宽限期）或明天的。"""
+        planned = now.replace(hour=hm[0], minute=hm[1], second=0, microsecond=0)
+        if self._fired_on.get(quote_id) == planned.date() or planned < now - timedelta(seconds=self.grace_seconds):
+            planned += timedelta(days=1)
+        return planned
+
+    def _schedule(self, quote_id: int, hm: Optional[Tuple[int, int]], now: datetime) -> None:
+        """设置 / 取消一条 quote 的计划（需持有 _lock）。"""
+        if hm is None:
+            self._entries.pop(quote_id, None)
+            return
+        self._version += 1
+        self._entries[quote_id] = (self._version, hm)
+        heapq.heappush(self._heap, (self._next_fire(quote_id, hm, now), quote_id, self._version))
+
+    @staticmethod
+    def _schedulable(q: Optional[DailyQuote]) -> Optional[Tuple[int, int]]:
+        if q is None or not q.active or not q.class_id:
+            return None
+        return _parse_hm(q.broadcast_time)
+
+    @staticmethod
+    def _fingerprint_of(db) -> Tuple[Any, ...]:
+        """daily_quotes 的变更指纹：新建 / 删除改变行数或最大 id，ORM 修改使 revision 之和增大。"""
+        return tuple(db.query(func.count(DailyQuote.id), func.max(DailyQuote.id),
+                              func.sum(DailyQuote.revision)).one())
+
+    def reload_all(self) -> int:
+        """全量重载启用的 quotes，返回计划中的条数。"""
+        db = self._session_factory()
+        try:
+            fingerprint = self._fingerprint_of(db)
+            rows = db.query(DailyQuote.id, DailyQuote.active, DailyQuote.class_id, DailyQuote.broadcast_time).filter(
+                DailyQuote.active == True, DailyQuote.broadcast_time != None, DailyQuote.class_id != None
+            ).all()
+        finally:
+            db.close()
+        now = self._now()
+        with self._lock:
+            self._heap, self._entries = [], {}
+            for r in rows:
+                self._schedule(int(r.id), self._schedulable(r), now)
+            self._last_reload = self._last_check = time.monotonic()
+            self._fingerprint = fingerprint
+            count = len(self._entries)
+        self._kick()
+        return count
+
+    def check_changes(self) -> bool:
+        """daily_quotes 的指纹与上次加载时不同则全量重载，返回是否重载。"""
+        db = self._session_factory()
+        try:
+            fingerprint = self._fingerprint_of(db)
+        finally:
+            db.close()
+        with self._lock:
+            self._last_check = time.monotonic()
+            changed = fingerprint != self._fingerprint
+        if changed:
+            self.reload_all()
+        return changed
+
+    def reload_quote(self, quote_id: int) -> None:
+        """
+        某条 quote 新建 / 修改 / 启停后调用（可在任意线程）。本进程的定时器没有运行时直接返回，
+        运行中的定时器（可能在其它 worker）由 check_changes 发现修改。
+        """
+        if not self.running:
+            return
+        db = self._session_factory()
+        try:
+            q = db.get(DailyQuote, int(quote_id))
+            hm = self._schedulable(q)
+        finally:
+            db.close()
+        with self._lock:
+            self._schedule(int(quote_id), hm, self._now())
+        self._kick()
+
+    def _pop_due(self, now: datetime) -> List[Tuple[datetime, int]]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                planned, qid, ver = heapq.heappop(self._heap)
+                entry = self._entries.get(qid)
+                if entry is None or entry[0] != ver:
+                    continue  # 已被重载 / 取消的旧堆项
+                due.append((planned, qid))
+                self._fired_on[qid] = planned.date()
+                heapq.heappush(self._heap, (planned + timedelta(days=1), qid, ver))
+        return due
+
+    def _seconds_until_next(self, now: datetime) -> float:
+        with self._lock:
+            while self._heap:
+                planned, qid, ver = self._heap[0]
+                entry = self._entries.get(qid)
+                if entry is not None and entry[0] == ver:
+                    break
+                heapq.heappop(self._heap)
+            until = (self._heap[0][0] - now).total_seconds() if self._heap else float(self.reload_interval)
+        reload_in = self.reload_interval - (time.monotonic() - self._last_reload)
+        check_in = self.change_poll_interval - (time.monotonic() - self._last_check)
+        return max(0.0, min(until, reload_in, check_in))
+
+    # ---------------- 主循环 ----------------
+    async def _run(self):
+        while True:
+            try:
+                if time.monotonic() - self._last_reload >= self.reload_interval or not self._last_reload:
+                    await run_in_threadpool(self.reload_all)
+                elif time.monotonic() - self._last_check >= self.change_poll_interval:
+                    await run_in_threadpool(self.check_changes)
+                now = self._now()
+                for planned, qid in self._pop_due(now):
+                    await self._fire_one(planned, qid)
+                timeout = self._seconds_until_next(self._now())
+            except Exception:
+                logger.exception("Daily quote scheduler error")
+                timeout = 30
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _fire_one(self, planned: datetime, quote_id: int) -> None:
+        started = self._now()
+        lag = (started - planned).total_seconds()
+        try:
+            n = await run_in_threadpool(self._fire, quote_id, planned.date())
+        except Exception:
+            self._stats["errors"] += 1
+            logger.exception("Daily quote %s broadcast failed (planned %s)", quote_id, planned)
+            return
+        s = self._stats
+        s["fired"] += 1
+        s["enqueued"] += int(n or 0)
+        s["last_lag"] = round(lag, 3)
+        s["max_lag"] = round(max(s["max_lag"], lag), 3)
+        s["total_lag"] += lag
+        s["last_fire_at"] = started.isoformat()
+        if lag > self.late_threshold:
+            s["late"] += 1
+            logger.warning("Daily quote %s fired %.1fs late (planned %s)", quote_id, lag, planned)
+
+    # ---------------- 状态 ----------------
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            live = sorted(
+                (planned, qid) for planned, qid, ver in self._heap
+                if self._entries.get(qid, (None,))[0] == ver
+            )
+            scheduled = len(self._entries)
+        s = dict(self._stats)
+        s["avg_lag"] = round(s.pop("total_lag") / s["fired"], 3) if s["fired"] else None
+        return {
+            "running": self.running,
+            "scheduled": scheduled,
+            "next": [{"quote_id": qid, "at": planned.isoformat()} for planned, qid in live[:5]],
+            **s,
+        }
@@ -0,0 +1,112 @@
+# mcp/reminders.py
+"""
+memo 提醒在写入时计算：新增 memo 时按学生所在班级的开放时段（openwindows 位图）
+算出 remind_date 当天下一个开放时刻，入队一条 deliver_after 为该时刻的提醒，
+投递引擎 / 终端到点自然可见，不再每轮扫描当天全部 memo。
+
+- 开放时段新增 / 删除时 reschedule_class 重算该班级尚未到期的提醒
+- memo 确认（删除）时 cancel_memo_reminder 撤销未投递的提醒
+- 后台循环只做兜底（sweep_day）：补齐当天缺失提醒的 memo（部署前创建的、写入时计算失败的等）
+每个 memo 每天只有一条提醒，由 dedupe_key 唯一索引保证。
+"""
+from datetime import date, datetime
+from typing import List, Optional
+
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.orm import Session
+
+from shared.models import Memo, OutgoingQueue, User
+from .counters import settle_pending
+from .openwindows import open_window_schedule
+from .outgoing import BULK_INSERT_CHUNK, enqueue_deduped
+
+
+def memo_dedupe_key(day: date, memo_id: int) -> str:
+    return f"memo:{day.isoformat()}:{int(memo_id)}"
+
+
+def _lock_reminder(db: Session, key: str):
+    return db.execute(
+        select(OutgoingQueue.id, OutgoingQueue.target_user_id, OutgoingQueue.delivered,
+               OutgoingQueue.deliver_after)
+        .where(OutgoingQueue.dedupe_key == key)
+        .with_for_update()
+    ).first()
+
+
+def schedule_memo_reminder(db: Session, memo: Memo, now: datetime) -> Optional[datetime]:
+    """
+    为 memo 写入 / 调整 / 撤销提醒，返回计划投递时间（当天不再开放时为 None）。不提交。
+    已到期（可能已被终端取走）或已投递的提醒不再改动。
+    """
+    now = now.replace(tzinfo=None)
+    key = memo_dedupe_key(memo.remind_date, memo.id)
+    class_id = open_window_schedule.class_for_user(db, int(memo.student_id))
+    nxt = open_window_schedule.next_open_on(db, class_id, memo.remind_date, now) if class_id else None
+
+    row = _lock_reminder(db, key)
+    if row is not None and (row.delivered or (row.deliver_after is not None and row.deliver_after <= now)):
+        return row.deliver_after
+
+    if nxt is None:
+        if row is not None:
+            db.execute(delete(OutgoingQueue).where(OutgoingQueue.id == row.id))
+            settle_pending(db, [row])
+        return None
+
+    at, window_id = nxt
+    payload = {
+        "type": "memo_reminder",
+        "memo_id": memo.id,
+        "open_window_id": window_id,
+        "content": memo.content,
+    }
+    if row is not None:
+        db.execute(update(OutgoingQueue).where(OutgoingQueue.id == row.id)
+                   .values(deliver_after=at, payload=payload))
+    else:
+        enqueue_deduped(db, [{
+            "target_user_id": int(memo.student_id),
+            "payload": payload,
+            "priority": "normal",
+            "deliver_after": at,
+            "created_at": now,
+            "dedupe_key": key,
+        }])
+    return at
+
+
+def cancel_memo_reminder(db: Session, memo: Memo) -> None:
+    """memo 被确认 / 删除前调用：撤销其未投递的提醒。不提交。"""
+    row = _lock_reminder(db, memo_dedupe_key(memo.remind_date, memo.id))
+    if row is not None and not row.delivered:
+        db.execute(delete(OutgoingQueue).where(OutgoingQueue.id == row.id))
+        settle_pending(db, [row])
+
+
+def reschedule_class(db: Session, class_id: int, now: datetime) -> int:
+    """班级开放时段变化后重算该班学生今天及以后的 memo 提醒，返回处理的 memo 数。不提交。"""
+    now = now.replace(tzinfo=None)
+    memos: List[Memo] = db.query(Memo).join(User, User.id == Memo.student_id).filter(
+        or_(User.class_id == int(class_id), User.managed_class_id == int(class_id)),
+        Memo.remind_date >= now.date(),
+    ).all()
+    for m in memos:
+        schedule_memo_reminder(db, m, now)
+    return len(memos)
+
+
+def sweep_day(db: Session, day: date, now: datetime) -> int:
+    """兜底：day 当天还没有提醒行的 memo 逐个补算，返回新排上提醒的 memo 数。不提交。"""
+    memos: List[Memo] = db.query(Memo).filter(Memo.remind_date == day).all()
+    by_key = {memo_dedupe_key(day, m.id): m for m in memos}
+    keys = list(by_key)
+    for i in range(0, len(keys), BULK_INSERT_CHUNK):
+        chunk = keys[i:i + BULK_INSERT_CHUNK]
+        for k in db.execute(select(OutgoingQueue.dedupe_key).where(OutgoingQueue.dedupe_key.in_(chunk))).scalars():
+            by_key.pop(k, None)
+    scheduled = 0
+    for m in by_key.values():
+        if schedule_memo_reminder(db, m, now) is not None:
+            scheduled += 1
+    return scheduled
@@ -0,0 +1,279 @@
+# mcp/retention.py
+"""
+outgoing_queue 保留策略：已投递超过 TTL 的行按批搬到 outgoing_queue_archive，
+归档表超过保留天数的数据再清理（MySQL 上若已按天分区则直接 DROP PARTITION），
+随后回收热表和归档表都不再引用的共享 payload。
+每批一个事务、每轮限定批数，避免长事务和大范围锁。
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import DateTime, delete, insert, literal, select, text
+
+from shared.models import OutgoingPayload, OutgoingQueue, OutgoingQueueArchive
+
+logger = logging.getLogger("mcp.retention")
+
+# 归档时从热表复制的列（archived_at 单独填）
+_ARCHIVE_COLUMNS = ("id", "created_at", "target_user_id", "payload", "payload_id", "priority",
+                    "deliver_after", "delivered_at", "attempts")
+
+
+class RetentionManager:
+    """由 /mcp/retention/status|config|run 控制；后台循环在启动时开启。"""
+
+    def __init__(self, session_factory: Callable, now_fn: Callable[[], datetime]):
+        self._session_factory = session_factory
+        self._now = now_fn
+
+        self.delivered_ttl_hours = int(os.environ.get("RETENTION_DELIVERED_TTL_HOURS", "72"))
+        self.archive_ttl_days = int(os.environ.get("RETENTION_ARCHIVE_DAYS", "180"))  # 0 = 永久保留
+        self.batch_size = 1000       # 每批搬多少行（一个事务）
+        self.max_batches = 50        # 每轮最多多少批，剩余的留给下一轮
+        self.interval = 600          # 秒，后台循环间隔
+        self.partition_days_ahead = 7
+
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._last: Dict[str, Any] = {}
+
+    # ---------------- 配置 / 状态 ----------------
+    def config(self) -> Dict[str, Any]:
+        return {
+            "delivered_ttl_hours": self.delivered_ttl_hours,
+            "archive_ttl_days": self.archive_ttl_days,
+            "batch_size": self.batch_size,
+            "max_batches": self.max_batches,
+            "interval": self.interval,
+        }
+
+    def status(self) -> Dict[str, Any]:
+        running = self._task is not None and not self._task.done()
+        return {"running": running, **self.config(), "last_run": dict(self._last)}
+
+    def configure(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        for key in ("delivered_ttl_hours", "archive_ttl_days", "batch_size", "max_batches", "interval"):
+            if body.get(key) is not None:
+                try:
+                    val = int(body[key])
+                except Exception:
+                    raise ValueError(f"{key} must be int")
+                if val < (0 if key == "archive_ttl_days" else 1):
+                    raise ValueError(f"{key} out of range")
+                setattr(self, key, val)
+        return self.config()
+
+    # ---------------- 后台循环 ----------------
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Retention run failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> Dict[str, Any]:
+        async with self._lock:
+            archived = await run_in_threadpool(self.archive_delivered)
+            purged = await run_in_threadpool(self.purge_archive)
+            payloads = await run_in_threadpool(self.purge_payloads)
+            self._last = {"at": self._now().isoformat(), "archived": archived, **purged,
+                          "purged_payloads": payloads}
+            if archived or purged.get("purged") or purged.get("dropped_partitions"):
+                logger.info("Retention: %s", self._last)
+            return dict(self._last)
+
+    # ---------------- 热表 -> 归档表 ----------------
+    def archive_delivered(self) -> int:
+        """把 delivered_at 早于 TTL 的已投递行按批搬到归档表，返回搬动行数。"""
+        cutoff = self._now() - timedelta(hours=self.delivered_ttl_hours)
+        src_cols = [getattr(OutgoingQueue, c) for c in _ARCHIVE_COLUMNS]
+        total = 0
+        for _ in range(self.max_batches):
+            db = self._session_factory()
+            try:
+                ids = db.execute(
+                    select(OutgoingQueue.id)
+                    .where(OutgoingQueue.delivered == True, OutgoingQueue.delivered_at < cutoff)
+                    .order_by(OutgoingQueue.id)
+                    .limit(self.batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                archived_at = self._now()
+                db.execute(
+                    insert(OutgoingQueueArchive).from_select(
+                        list(_ARCHIVE_COLUMNS) + ["archived_at"],
+                        select(*src_cols, literal(archived_at, DateTime))
+                        .where(OutgoingQueue.id.in_(ids))
+                    )
+                )
+                db.execute(delete(OutgoingQueue).where(OutgoingQueue.id.in_(ids)))
+                db.commit()
+                total += len(ids)
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            if len(ids) < self.batch_size:
+                break
+        return total
+
+    # ---------------- 归档表清理 ----------------
+    def purge_archive(self) -> Dict[str, Any]:
+        if self.archive_ttl_days <= 0:
+            return {"purged": 0}
+        cutoff = self._now() - timedelta(days=self.archive_ttl_days)
+        db = self._session_factory()
+        try:
+            if db.get_bind().dialect.name == "mysql" and self._archive_partitions(db):
+                self._ensure_future_partitions(db)
+                return {"dropped_partitions": self._drop_partitions_before(db, cutoff)}
+
+            purged = 0
+            for _ in range(self.max_batches):
+                keys = db.execute(
+                    select(OutgoingQueueArchive.id, OutgoingQueueArchive.created_at)
+                    .where(OutgoingQueueArchive.created_at < cutoff)
+                    .limit(self.batch_size)
+                ).all()
+                if not keys:
+                    break
+                db.execute(delete(OutgoingQueueArchive).where(
+                    OutgoingQueueArchive.id.in_([k[0] for k in keys]),
+                    OutgoingQueueArchive.created_at < cutoff
+                ))
+                db.commit()
+                purged += len(keys)
+                if len(keys) < self.batch_size:
+                    break
+            return {"purged": purged}
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    # ---------------- 共享 payload 回收 ----------------
+    def purge_payloads(self) -> int:
+        """
+        删除热表和归档表都不再引用、且超过保留期未被复用的共享 payload。
+        archive_ttl_days=0（归档永久保留）时不回收。
+        """
+        if self.archive_ttl_days <= 0:
+            return 0
+        cutoff = self._now() - timedelta(days=self.archive_ttl_days)
+        in_queue = select(OutgoingQueue.id).where(OutgoingQueue.payload_id == OutgoingPayload.id).exists()
+        in_archive = select(OutgoingQueueArchive.id).where(OutgoingQueueArchive.payload_id == OutgoingPayload.id).exists()
+        total = 0
+        for _ in range(self.max_batches):
+            db = self._session_factory()
+            try:
+                ids = db.execute(
+                    select(OutgoingPayload.id)
+                    .where(OutgoingPayload.created_at < cutoff,
+                           (OutgoingPayload.last_used_at == None) | (OutgoingPayload.last_used_at < cutoff),
+                           ~in_queue, ~in_archive)
+                    .limit(self.batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                db.execute(delete(OutgoingPayload).where(OutgoingPayload.id.in_(ids)))
+                db.commit()
+                total += len(ids)
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            if len(ids) < self.batch_size:
+                break
+        return total
+
+    # ---------------- MySQL 按天分区（可选） ----------------
+    @staticmethod
+    def _partition_name(day) -> str:
+        return "p" + day.strftime("%Y%m%d")
+
+    def _archive_partitions(self, db) -> List[str]:
+        rows = db.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :t AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        ), {"t": OutgoingQueueArchive.__tablename__}).scalars().all()
+        return list(rows)
+
+    def partition_archive_table(self) -> Dict[str, Any]:
+        """
+        把归档表改为按 created_at 天 RANGE 分区（仅 MySQL；一次性操作，表大时请在低峰执行）。
+        之后过期数据按分区 DROP，不再逐行 DELETE。
+        """
+        db = self._session_factory()
+        try:
+            if db.get_bind().dialect.name != "mysql":
+                raise ValueError("partitioning is only supported on MySQL")
+            if self._archive_partitions(db):
+                return {"status": "already_partitioned"}
+            today = self._now().date()
+            first = db.execute(select(OutgoingQueueArchive.created_at)
+                               .order_by(OutgoingQueueArchive.created_at).limit(1)).scalar()
+            start = min(first.date(), today) if first else today
+            days = [start + timedelta(days=i) for i in range((today - start).days + self.partition_days_ahead + 1)]
+            parts = ",".join(
+                f"PARTITION {self._partition_name(d)} VALUES LESS THAN (TO_DAYS('{(d + timedelta(days=1)).isoformat()}'))"
+                for d in days
+            )
+            db.execute(text(
+                f"ALTER TABLE {OutgoingQueueArchive.__tablename__} PARTITION BY RANGE (TO_DAYS(created_at)) "
+                f"({parts}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+            ))
+            db.commit()
+            return {"status": "partitioned", "partitions": len(days) + 1}
+        finally:
+            db.close()
+
+    def _ensure_future_partitions(self, db) -> None:
+        """从 pmax 中拆出未来 partition_days_ahead 天的分区。"""
+        existing = self._archive_partitions(db)
+        if "pmax" not in existing:
+            return
+        last = max((p for p in existing if p != "pmax"), default="")
+        today = self._now().date()
+        # 分区名按日期字典序递增，只在最后一个分区之后追加
+        missing = [d for d in (today + timedelta(days=i) for i in range(self.partition_days_ahead + 1))
+                   if self._partition_name(d) > last]
+        if not missing:
+            return
+        parts = ",".join(
+            f"PARTITION {self._partition_name(d)} VALUES LESS THAN (TO_DAYS('{(d + timedelta(days=1)).isoformat()}'))"
+            for d in missing
+        )
+        db.execute(text(
+            f"ALTER TABLE {OutgoingQueueArchive.__tablename__} REORGANIZE PARTITION pmax INTO "
+            f"({parts}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        ))
+
+    def _drop_partitions_before(self, db, cutoff: datetime) -> List[str]:
+        cutoff_name = self._partition_name(cutoff.date())
+        old = [p for p in self._archive_partitions(db) if p != "pmax" and p < cutoff_name]
+        if old:
+            db.execute(text(f"ALTER TABLE {OutgoingQueueArchive.__tablename__} DROP PARTITION {','.join(old)}"))
+        return old
@@ -0,0 +1,158 @@
+# mcp/roster.py
+"""
+班级花名册缓存：class_id -> 成员 (id, role, username, external_id) 元组 + 该班教师，
+另有 学生 -> 家长、家长 -> 孩子 两个索引。广播入队、通讯录、家长选孩子等按班级取人时
+命中缓存即不再扫描 users 表。
+
+注册、修改资料、家长关联孩子等改动成员关系的接口调用 invalidate_*；
+其它 worker 的修改靠 TTL 过期后重新加载。
+"""
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import or_, select
+
+from shared.models import User, UserRole, parent_students
+
+
+class Member(NamedTuple):
+    id: int
+    role: str
+    username: str
+    external_id: Optional[str]
+
+
+def _role_value(role) -> str:
+    return getattr(role, "value", role)
+
+
+class RosterCache:
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # class_id -> (过期时间, 成员（按 id 升序）, 教师)
+        self._classes: Dict[int, Tuple[float, Tuple[Member, ...], Tuple[Member, ...]]] = {}
+        self._parents: Dict[int, Tuple[float, Tuple[int, ...]]] = {}    # student_id -> parent ids
+        self._children: Dict[int, Tuple[float, Tuple[int, ...]]] = {}   # parent_id -> student ids
+        # 失效代数（同 OpenWindowSchedule）：加载期间被失效的结果不写回缓存
+        self._class_gen: Dict[int, int] = {}
+        self._class_epoch = 0
+        self._parent_gen: Dict[int, int] = {}
+        self._child_gen: Dict[int, int] = {}
+        self._link_epoch = 0
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    # ---------------- 加载 ----------------
+    def _class_entry(self, db, class_id: int) -> Tuple[Tuple[Member, ...], Tuple[Member, ...]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._classes.get(int(class_id))
+            if entry is not None and entry[0] > now:
+                self._stats["hits"] += 1
+                return entry[1], entry[2]
+            self._stats["misses"] += 1
+            gen = (self._class_epoch, self._class_gen.get(int(class_id), 0))
+        rows = db.execute(
+            select(User.id, User.role, User.username, User.external_id, User.class_id, User.managed_class_id)
+            .where(or_(User.class_id == int(class_id), User.managed_class_id == int(class_id)))
+            .order_by(User.id)
+        ).all()
+        members, teachers = [], []
+        for r in rows:
+            m = Member(int(r.id), _role_value(r.role), r.username, r.external_id)
+            if r.class_id == int(class_id):
+                members.append(m)
+            if r.managed_class_id == int(class_id) and m.role == UserRole.teacher.value:
+                teachers.append(m)
+        members, teachers = tuple(members), tuple(teachers)
+        with self._lock:
+            if gen == (self._class_epoch, self._class_gen.get(int(class_id), 0)):
+                self._classes[int(class_id)] = (now + self.ttl, members, teachers)
+        return members, teachers
+
+    def _link_entry(self, db, index: Dict, gens: Dict[int, int], key: int, key_col, val_col) -> Tuple[int, ...]:
+        now = time.monotonic()
+        with self._lock:
+            entry = index.get(int(key))
+            if entry is not None and entry[0] > now:
+                self._stats["hits"] += 1
+                return entry[1]
+            self._stats["misses"] += 1
+            gen = (self._link_epoch, gens.get(int(key), 0))
+        ids = tuple(sorted(int(v) for v in db.execute(select(val_col).where(key_col == int(key))).scalars()))
+        with self._lock:
+            if gen == (self._link_epoch, gens.get(int(key), 0)):
+                index[int(key)] = (now + self.ttl, ids)
+        return ids
+
+    # ---------------- 查询 ----------------
+    def members(self, db, class_id: int, role: Optional[str] = None) -> List[Member]:
+        """class_id 为该班的用户（学生、家长等），可按角色过滤；按 id 升序。"""
+        members, _ = self._class_entry(db, class_id)
+        if role is None:
+            return list(members)
+        role = _role_value(role)
+        return [m for m in members if m.role == role]
+
+    def member_ids(self, db, class_id: int, role: Optional[str] = None) -> List[int]:
+        return [m.id for m in self.members(db, class_id, role)]
+
+    def teachers(self, db, class_id: int) -> List[Member]:
+        """managed_class_id 为该班的教师。"""
+        _, teachers = self._class_entry(db, class_id)
+        return list(teachers)
+
+    def parents_of(self, db, student_id: int) -> Tuple[int, ...]:
+        return self._link_entry(db, self._parents, self._parent_gen, student_id,
+                                parent_students.c.student_id, parent_students.c.parent_id)
+
+    def children_of(self, db, parent_id: int) -> Tuple[int, ...]:
+        return self._link_entry(db, self._children, self._child_gen, parent_id,
+                                parent_students.c.parent_id, parent_students.c.student_id)
+
+    # ---------------- 失效 ----------------
+    def invalidate_class(self, class_id: Optional[int] = None) -> None:
+        with self._lock:
+            if class_id is None:
+                self._classes.clear()
+                self._class_epoch += 1
+            else:
+                self._classes.pop(int(class_id), None)
+                self._class_gen[int(class_id)] = self._class_gen.get(int(class_id), 0) + 1
+            self._stats["invalidations"] += 1
+
+    def invalidate_links(self, parent_id: Optional[int] = None, student_id: Optional[int] = None) -> None:
+        """家长-孩子关联变化；都不传时清空两个索引。"""
+        with self._lock:
+            if parent_id is None and student_id is None:
+                self._parents.clear()
+                self._children.clear()
+                self._link_epoch += 1
+            if parent_id is not None:
+                self._children.pop(int(parent_id), None)
+                self._child_gen[int(parent_id)] = self._child_gen.get(int(parent_id), 0) + 1
+            if student_id is not None:
+                self._parents.pop(int(student_id), None)
+                self._parent_gen[int(student_id)] = self._parent_gen.get(int(student_id), 0) + 1
+            self._stats["invalidations"] += 1
+
+    def invalidate_user(self, user) -> None:
+        """用户新增 / 资料变化：失效其所在班级（学生、家长）和所带班级（教师）。"""
+        for cid in {getattr(user, "class_id", None), getattr(user, "managed_class_id", None)}:
+            if cid is not None:
+                self.invalidate_class(cid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "classes": len(self._classes),
+                "parent_links": len(self._parents),
+                "child_links": len(self._children),
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else None,
+            }
+
+
+roster_cache = RosterCache()
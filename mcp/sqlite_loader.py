@@ -0,0 +1,176 @@
+# mcp/sqlite_loader.py
+"""
+把 MySQL 导出的 campus_assistant.sql 导入 SQLite，供本地 / CI 在没有 MySQL 的环境下跑负载和基准测试：
+
+    python -m mcp.sqlite_loader [--sql campus_assistant.sql] [--db campus_assistant.db] [--force]
+    DATABASE_URL=sqlite:///campus_assistant.db uvicorn mcp.app:app
+
+- 模型中有的表按 shared/models.py 建表（与 init_db 一致，JSON 列为 PortableJSON），
+  导出里模型没有的表（如 class_students）把 MySQL DDL 简单翻译为 SQLite DDL
+- 数据按导出中 CREATE TABLE 的列顺序逐行解析 INSERT ... VALUES，以参数方式插入（不拼 SQL），
+  导出有而模型没有的列忽略；模型有而导出没有、且声明了 info["backfill"] 的列（如 priority_rank）导入后回填
+不导入 mcp.db（避免按默认 DATABASE_URL 连接 MySQL）。
+"""
+import argparse
+import os
+import re
+import sqlite3
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import create_engine
+
+from shared.models import Base
+
+_CREATE_RE = re.compile(r"CREATE TABLE `(?P<name>[^`]+)` \((?P<body>.*?)\n\)[^;]*;", re.S)
+_INSERT_RE = re.compile(r"^INSERT INTO `(?P<name>[^`]+)` VALUES (?P<values>.*);$", re.M)
+_COLUMN_RE = re.compile(r"^\s*`(?P<name>[^`]+)` (?P<rest>.*?),?$")
+_PK_RE = re.compile(r"^\s*PRIMARY KEY \((?P<cols>[^)]*)\)")
+_UNIQUE_RE = re.compile(r"^\s*UNIQUE KEY `[^`]+` \((?P<cols>[^)]*)\)")
+
+_ESCAPES = {"0": "\0", "n": "\n", "r": "\r", "t": "\t", "b": "\b", "Z": "\x1a"}
+
+
+def parse_dump(sql: str) -> Tuple[Dict[str, Tuple[List[str], str]], List[Tuple[str, str]]]:
+    """返回 ({表名: (列名列表, CREATE TABLE 体)}, [(表名, VALUES 文本)])，均按导出中的顺序。"""
+    tables = {}
+    for m in _CREATE_RE.finditer(sql):
+        cols = [c.group("name") for c in map(_COLUMN_RE.match, m.group("body").splitlines()) if c]
+        tables[m.group("name")] = (cols, m.group("body"))
+    inserts = [(m.group("name"), m.group("values")) for m in _INSERT_RE.finditer(sql)]
+    return tables, inserts
+
+
+def iter_rows(values: str) -> Iterator[tuple]:
+    """解析 mysqldump 的 (..),(..) 值列表：字符串（反斜杠转义）、NULL、数字。"""
+    i, n = 0, len(values)
+    row: List = []
+    while i < n:
+        ch = values[i]
+        if ch == "'":
+            buf, i = [], i + 1
+            while values[i] != "'":
+                if values[i] == "\\":
+                    i += 1
+                    buf.append(_ESCAPES.get(values[i], values[i]))
+                else:
+                    buf.append(values[i])
+                i += 1
+            row.append("".join(buf))
+            i += 1
+        elif ch == ")":
+            yield tuple(row)
+            row = []
+            i += 1
+        elif ch in "(,":
+            i += 1
+        else:
+            j = i
+            while j < n and values[j] not in ",)":
+                j += 1
+            token = values[i:j].strip()
+            if token.upper() == "NULL":
+                row.append(None)
+            elif re.fullmatch(r"-?\d+", token):
+                row.append(int(token))
+            else:
+                row.append(float(token))
+            i = j
+
+
+def translate_ddl(name: str, body: str) -> str:
+    """模型之外的表：MySQL CREATE TABLE 体 -> SQLite（只保留列、主键、唯一键；外键 / 普通索引省略）。"""
+    pk: List[str] = []
+    for line in body.splitlines():
+        m = _PK_RE.match(line)
+        if m:
+            pk = [c.strip(" `") for c in m.group("cols").split(",")]
+    parts = []
+    for line in body.splitlines():
+        col = _COLUMN_RE.match(line)
+        if col:
+            rest = col.group("rest")
+            if pk == [col.group("name")] and "AUTO_INCREMENT" in rest:
+                parts.append(f'"{col.group("name")}" INTEGER PRIMARY KEY AUTOINCREMENT')
+                continue
+            rest = re.sub(r"\benum\([^)]*\)", "TEXT", rest, flags=re.I)
+            rest = re.sub(r"\b(AUTO_INCREMENT|unsigned|ON UPDATE CURRENT_TIMESTAMP)\b", "", rest, flags=re.I)
+            rest = re.sub(r"\b(COLLATE|CHARACTER SET) \w+", "", rest, flags=re.I)
+            rest = re.sub(r"\bCOMMENT '(?:[^'\\]|\\.)*'", "", rest, flags=re.I)
+            parts.append(f'"{col.group("name")}" {rest.strip()}')
+            continue
+        uq = _UNIQUE_RE.match(line)
+        if uq:
+            parts.append("UNIQUE (" + uq.group("cols").replace("`", '"') + ")")
+        elif _PK_RE.match(line) and len(pk) > 1:
+            parts.append("PRIMARY KEY (" + ", ".join(f'"{c}"' for c in pk) + ")")
+    return f'CREATE TABLE "{name}" (\n  ' + ",\n  ".join(parts) + "\n)"
+
+
+def load(sql_path: str, db_path: str, force: bool = False) -> Dict[str, int]:
+    """导入并返回 {表名: 行数}。db_path 已存在时需 force=True（删除后重建）。"""
+    if os.path.exists(db_path):
+        if not force:
+            raise FileExistsError(f"{db_path} already exists (use --force to overwrite)")
+        os.remove(db_path)
+    with open(sql_path, encoding="utf-8") as f:
+        tables, inserts = parse_dump(f.read())
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    counts: Dict[str, int] = {}
+    conn = sqlite3.connect(db_path)
+    try:
+        have = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for name, (_, body) in tables.items():
+            if name not in have:
+                conn.execute(translate_ddl(name, body))
+        for name, values in inserts:
+            dump_cols = tables[name][0]
+            table_cols = {r[1] for r in conn.execute(f'PRAGMA table_info("{name}")')}
+            keep = [i for i, c in enumerate(dump_cols) if c in table_cols]
+            cols = ", ".join(f'"{dump_cols[i]}"' for i in keep)
+            stmt = f'INSERT INTO "{name}" ({cols}) VALUES ({", ".join("?" * len(keep))})'
+            rows = [tuple(r[i] for i in keep) for r in iter_rows(values)]
+            conn.executemany(stmt, rows)
+            counts[name] = counts.get(name, 0) + len(rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    try:
+        with engine.begin() as sa_conn:
+            for table in Base.metadata.sorted_tables:
+                if table.name not in counts:
+                    continue
+                for col in table.columns:
+                    if "backfill" in col.info and col.name not in tables[table.name][0]:
+                        sa_conn.execute(col.info["backfill"](table))
+    finally:
+        engine.dispose()
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Import campus_assistant.sql into a SQLite database")
+    parser.add_argument("--sql", default=os.path.join(root, "campus_assistant.sql"))
+    parser.add_argument("--db", default="campus_assistant.db")
+    parser.add_argument("--force", action="store_true", help="overwrite an existing database file")
+    args = parser.parse_args(argv)
+    try:
+        counts = load(args.sql, args.db, force=args.force)
+    except FileExistsError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for name, n in counts.items():
+        print(f"{name}: {n}")
+    print(f"DATABASE_URL=sqlite:///{os.path.abspath(args.db)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# mcp/startup.py
+"""
+启动耗时记录：
+  - 各模块导入耗时（含其导入的子模块，与 python -X importtime 的 cumulative 一致）
+  - 启动阶段（应用模块加载完成、各 startup 钩子等）距包导入开始的时间
+  - 首个请求完成的时间（time to first request）
+mcp 包导入时即开始计时（见 mcp/__init__.py），结果见 /mcp/admin/startup。
+"""
+import importlib.machinery
+import logging
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("mcp.startup")
+
+
+class _ImportTimer:
+    """包装 sys.meta_path 上各 finder 找到的源码 / 扩展模块 loader，记录 exec_module 耗时。"""
+
+    def __init__(self, profile: "StartupProfile"):
+        self._profile = profile
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            loader = spec.loader
+            if isinstance(loader, (importlib.machinery.SourceFileLoader,
+                                   importlib.machinery.SourcelessFileLoader,
+                                   importlib.machinery.ExtensionFileLoader)):
+                loader.exec_module = self._timed(fullname, loader.exec_module)
+            return spec
+        return None
+
+    def _timed(self, name, exec_module):
+        def wrapper(module):
+            started = time.perf_counter()
+            try:
+                return exec_module(module)
+            finally:
+                self._profile.imports[name] = time.perf_counter() - started
+        return wrapper
+
+
+class StartupProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imports: Dict[str, float] = {}
+        self.phases: Dict[str, float] = {}
+        self.first_request: Optional[float] = None
+        self._timer: Optional[_ImportTimer] = None
+        self._lock = threading.Lock()
+
+    def install_import_timer(self) -> None:
+        if self._timer is None:
+            self._timer = _ImportTimer(self)
+            sys.meta_path.insert(0, self._timer)
+
+    def uninstall_import_timer(self) -> None:
+        if self._timer is not None:
+            try:
+                sys.meta_path.remove(self._timer)
+            except ValueError:
+                pass
+            self._timer = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def mark(self, phase: str) -> None:
+        self.phases[phase] = self.elapsed()
+
+    def request_done(self) -> None:
+        if self.first_request is None:
+            with self._lock:
+                if self.first_request is None:
+                    self.first_request = self.elapsed()
+                    logger.info("First request served %.3fs after import", self.first_request)
+
+    def report(self, top: int = 20) -> Dict[str, Any]:
+        imports = sorted(self.imports.items(), key=lambda kv: kv[1], reverse=True)
+        own = {k: v for k, v in imports if k.startswith(("mcp.", "shared."))}
+        return {
+            "phases": {k: round(v, 4) for k, v in self.phases.items()},
+            "first_request": round(self.first_request, 4) if self.first_request is not None else None,
+            "imports_top": [{"module": k, "seconds": round(v, 4)} for k, v in imports[:top]],
+            "imports_own": {k: round(v, 4) for k, v in own.items()},
+            "modules_timed": len(imports),
+        }
+
+    def summary(self) -> str:
+        heaviest = sorted(
+            ((k, v) for k, v in self.imports.items() if "." not in k or k.startswith(("mcp.", "shared."))),
+            key=lambda kv: kv[1], reverse=True,
+        )[:5]
+        phases = ", ".join(f"{k} {v:.3f}s" for k, v in self.phases.items())
+        mods = ", ".join(f"{k} {v:.3f}s" for k, v in heaviest)
+        return f"Startup: {phases}; heaviest imports: {mods}"
+
+
+class FirstRequestMiddleware:
+    """ASGI 中间件：首个 HTTP 请求完成时记录耗时，之后只多一次属性判断。"""
+
+    def __init__(self, app, profile: StartupProfile):
+        self.app = app
+        self.profile = profile
+
+    async def __call__(self, scope, receive, send):
+        if self.profile.first_request is not None or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profile.request_done()
+
+
+startup_profile = StartupProfile()
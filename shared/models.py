@@ -1,7 +1,7 @@
 # shared/models.py
 from sqlalchemy import (
     Table, Column, String, Integer, Date, DateTime, Text, ForeignKey,
-    Enum as SAEnum, Boolean, func
+    Enum as SAEnum, Boolean, Index, JSON, func, literal_column
 )
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.dialects.mysql import JSON as MySQLJSON
@@ -10,6 +10,19 @@ from datetime import datetime
 
 Base = declarative_base()
 
+# JSON 列类型：MySQL 上为原生 JSON，其它方言（本地 / CI 用 SQLite）为通用 JSON（TEXT 存储）
+PortableJSON = JSON().with_variant(MySQLJSON(), "mysql")
+
+
+def priority_rank_of(priority) -> int:
+    """outgoing_queue.priority_rank 的取值：urgent -> 1，其余 -> 0。"""
+    return 1 if priority == "urgent" else 0
+
+
+def _default_priority_rank(context) -> int:
+    # 插入时未显式给出 priority_rank 的行（ORM / bulk insert / INSERT IGNORE）按同一行的 priority 计算
+    return priority_rank_of(context.get_current_parameters().get("priority"))
+
 # -------------------------
 # 多对多关联表：parents <-> students
 # -------------------------
@@ -246,7 +259,7 @@ class Memo(Base):
     remind_date = Column(Date, nullable=False)
 
     # JSON 列不要在 DDL 里设置默认值（MySQL 限制），设置为 nullable 并由应用端补默认值
-    status_json = Column(MySQLJSON, nullable=True)
+    status_json = Column(PortableJSON, nullable=True)
 
     student = relationship("User", foreign_keys=[student_id], back_populates="memos")
 
@@ -280,6 +293,8 @@ class DailyQuote(Base):
     # 为兼容旧数据，保持字符串 'HH:MM'；后续可以迁移为 TIME 类型
     broadcast_time = Column(String(5), nullable=True)
     active = Column(Boolean, nullable=False, default=True)
+    # 每次 ORM 更新加一；每日一句定时器据此发现其它 worker 的修改（直接改库的变更靠定时全量重载）
+    revision = Column(Integer, nullable=False, server_default="0", onupdate=literal_column("revision + 1"))
 
     # relationships
     class_ = relationship("Class", foreign_keys=[class_id], back_populates="daily_quotes")
@@ -299,21 +314,157 @@ class OpenWindow(Base):
     end_time = Column(String(5), nullable=False)
 
     # JSON 列：不要在 DDL 里设置默认值
-    days_json = Column(MySQLJSON, nullable=True)
+    days_json = Column(PortableJSON, nullable=True)
 
     class_ = relationship("Class", foreign_keys=[class_id], back_populates="open_windows")
 
 # ---------- OutgoingQueue ----------
 class OutgoingQueue(Base):
     __tablename__ = "outgoing_queue"
+    __table_args__ = (
+        # 归档任务按 delivered_at 扫描已投递行
+        Index("ix_outgoing_delivered_at", "delivered", "delivered_at"),
+        # 管理列表按 (created_at, id) 游标翻页，常带 target_user_id 过滤
+        Index("ix_outgoing_target_created", "target_user_id", "created_at", "id"),
+        # 管理列表的默认顺序 (priority_rank, created_at, id)，带或不带 target_user_id 过滤都能按索引顺序读
+        Index("ix_outgoing_rank_created", "priority_rank", "created_at", "id"),
+        Index("ix_outgoing_target_rank_created", "target_user_id", "priority_rank", "created_at", "id"),
+        # 群发去重：按 (payload_id, target_user_id) 反连接
+        Index("ix_outgoing_payload_target", "payload_id", "target_user_id"),
+        # 调度器生成项的幂等键；声明为命名唯一索引，upgrade_schema 在已有库上也会补建
+        Index("ux_outgoing_dedupe_key", "dedupe_key", unique=True),
+        # 已被 ix_outgoing_payload_target 覆盖的旧单列索引，upgrade_schema 在已有库上删除
+        {"info": {"retired_indexes": ("ix_outgoing_queue_payload_id",)}},
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     target_user_id = Column(Integer, nullable=False, index=True)
-    payload = Column(MySQLJSON, nullable=False)
+    # 单发项直接存 payload；群发项 payload 为空，通过 payload_id 引用 outgoing_payloads 中的同一份内容
+    payload = Column(PortableJSON, nullable=True)
+    payload_id = Column(Integer, nullable=True)
     priority = Column(String(16), nullable=False, server_default="normal")
+    # priority 的排序值（见 priority_rank_of），存成实列以便排序 / 游标条件走索引；
+    # info["backfill"]：补列（upgrade_schema）或导入没有该列的数据（sqlite_loader）后按 priority 回填
+    priority_rank = Column(Integer, nullable=False, server_default="0", default=_default_priority_rank,
+                           info={"backfill": lambda t: t.update().where(t.c.priority == "urgent")
+                                                              .values(priority_rank=1)})
     deliver_after = Column(DateTime, nullable=True)
     delivered = Column(Boolean, nullable=False, server_default="0")
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
     delivered_at = Column(DateTime, nullable=True)
+    # 调度器生成项的幂等键（如 "memo:2025-10-18:12:3"、"dq:2025-10-18:5:42"），重复入队由唯一索引挡掉
+    dedupe_key = Column(String(128), nullable=True)
+
+    # 租约：被某个投递者（终端 poll / 投递线程）认领后，在 leased_until 之前对其它投递者不可见；
+    # 过期未确认则自动重新可见
+    leased_until = Column(DateTime, nullable=True)
+    lease_owner = Column(String(64), nullable=True)
+
+    # 投递重试：失败次数、下次允许重试的时间（指数退避）、最近一次错误
+    attempts = Column(Integer, nullable=False, server_default="0")
+    next_attempt_at = Column(DateTime, nullable=True)
+    last_error = Column(String(255), nullable=True)
+
+# ---------- OutgoingPendingCounter ----------
+class OutgoingPendingCounter(Base):
+    """
+    未投递项计数，随入队 / 确认 / 删除在同一事务内增减。
+    只有按用户的行；全局总数读取时求和（见 mcp.counters.pending_count）。
+    """
+    __tablename__ = "outgoing_pending_counters"
+
+    target_user_id = Column(Integer, primary_key=True, autoincrement=False)
+    pending = Column(Integer, nullable=False, server_default="0")
+
+# ---------- OutgoingPayload ----------
+class OutgoingPayload(Base):
+    """
+    群发内容只存一份，队列行用 payload_id 引用。
+    ref_key：按业务 id（如 "notice:12"）或内容哈希（"sha256:..."）去重。
+    """
+    __tablename__ = "outgoing_payloads"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    ref_key = Column(String(128), unique=True, nullable=False)
+    payload = Column(PortableJSON, nullable=False)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    # 复用时刷新（按天粒度），归档清理只回收长期未被引用的内容
+    last_used_at = Column(DateTime, nullable=True)
+
+# ---------- OutgoingQueueArchive ----------
+class OutgoingQueueArchive(Base):
+    """
+    已投递且超过保留期的队列项由归档任务从 outgoing_queue 搬到这里，热表保持小而快。
+    主键含 created_at：MySQL 上可按天 RANGE 分区，过期分区直接 DROP。
+    """
+    __tablename__ = "outgoing_queue_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    created_at = Column(DateTime, primary_key=True, nullable=False)
+    target_user_id = Column(Integer, nullable=False, index=True)
+    payload = Column(PortableJSON, nullable=True)
+    payload_id = Column(Integer, nullable=True, index=True)
+    priority = Column(String(16), nullable=False, server_default="normal")
+    deliver_after = Column(DateTime, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    archived_at = Column(DateTime, nullable=False)
+
+# ---------- OutgoingDeadLetter ----------
+class OutgoingDeadLetter(Base):
+    """超过最大重试次数的队列项从 outgoing_queue 移到这里，保留原始内容便于排查/人工重放。"""
+    __tablename__ = "outgoing_dead_letter"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    queue_id = Column(Integer, nullable=False, index=True)
+    target_user_id = Column(Integer, nullable=False, index=True)
+    payload = Column(PortableJSON, nullable=True)
+    priority = Column(String(16), nullable=False, server_default="normal")
+    attempts = Column(Integer, nullable=False, server_default="0")
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=True)
+    failed_at = Column(DateTime, nullable=False)
+
+# ---------- FanoutJob ----------
+class FanoutJob(Base):
+    """
+    群发任务：请求只建任务，后台按用户 id 分块入队，每块一个事务并推进 cursor，
+    中途失败可从上一块继续。audience: {"class_ids": [...], "roles": [...], "combine": "or"|"and"}，
+    class_ids / roles 都为空时为全体用户。
+    """
+    __tablename__ = "fanout_jobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(32), nullable=False)  # notice / daily_quote
+    payload_id = Column(Integer, nullable=False)
+    priority = Column(String(16), nullable=False, server_default="normal")
+    deliver_after = Column(DateTime, nullable=True)
+    audience = Column(PortableJSON, nullable=False)
+    created_by = Column(Integer, nullable=True)
+
+    status = Column(String(16), nullable=False, server_default="pending", index=True)  # pending/running/done/failed
+    cursor = Column(Integer, nullable=False, server_default="0")  # 已处理到的最大 user id
+    total = Column(Integer, nullable=True)                        # 开始处理时统计的收件人数
+    enqueued = Column(Integer, nullable=False, server_default="0")
+    skipped = Column(Integer, nullable=False, server_default="0")  # 已有同内容未投递项而跳过
+    attempts = Column(Integer, nullable=False, server_default="0")
+    error = Column(Text, nullable=True)
+
+    leased_until = Column(DateTime, nullable=True)
+    lease_owner = Column(String(64), nullable=True)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+# ---------- SchedulerLease ----------
+class SchedulerLease(Base):
+    """后台单例循环的领导者租约：每个 name 一行，持有者定期续约，过期后其它进程接管。"""
+    __tablename__ = "scheduler_leases"
+
+    name = Column(String(64), primary_key=True)
+    owner = Column(String(128), nullable=True)
+    leased_until = Column(DateTime, nullable=True)
+    acquired_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
 
 # End of file
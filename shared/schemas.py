@@ -62,6 +62,7 @@ class PostNoticeCommand(Command):
 class PostNoticeResponse(BaseModel):
     status: str
     notice_id: Optional[int] = None
+    job_id: Optional[int] = None
     detail: Optional[str] = None
 
 class PlayAudioContext(BaseModel):
@@ -1,4 +1,6 @@
 @echo off
 cd /d "d:\python\campus-assistant"
+echo Initializing database schema...
+python.exe -m mcp.db init
 echo Starting backend server...
 python.exe -m uvicorn mcp.app:app --host 0.0.0.0 --port 8000
@@ -25,6 +25,13 @@ def main():
     # 设置工作目录
     os.chdir("d:\\python\\campus-assistant")
     
+    # 建表 / 补列（worker 启动时不再执行）
+    init = subprocess.run([sys.executable, "-m", "mcp.db", "init"], capture_output=True, text=True)
+    if init.returncode != 0:
+        logging.error(f"Schema initialization failed: {init.stderr.strip()}")
+        sys.exit(1)
+    logging.info(init.stdout.strip())
+    
     # 启动 uvicorn 服务器
     cmd = [
         sys.executable,  # 使用当前 Python 解释器
@@ -0,0 +1,39 @@
+# tests/conftest.py
+"""测试在临时 SQLite 上运行：导入 mcp.db 前设置 DATABASE_URL，避免按默认配置连接 MySQL。"""
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("DB_ASYNC", "0")
+
+from shared.models import Base  # noqa: E402
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """每个测试一个按当前模型建好全部表的临时库。"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_factory(engine):
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
@@ -0,0 +1,47 @@
+# tests/test_counters.py
+"""未投递计数只按用户维护，全局总数由各用户行求和；计数表为空的库在初始化时补齐一次。"""
+import pytest
+from sqlalchemy import select
+
+from shared.models import OutgoingPendingCounter, OutgoingQueue
+from mcp.counters import (
+    ensure_pending_counters, install_counter_hooks, lock_queue_rows, pending_count, settle_pending,
+)
+
+
+@pytest.fixture(autouse=True)
+def counter_hooks():
+    install_counter_hooks()
+
+
+def _counter_keys(db):
+    return sorted(db.execute(select(OutgoingPendingCounter.target_user_id)).scalars())
+
+
+def test_global_count_is_sum_of_user_rows(db):
+    db.add_all([OutgoingQueue(target_user_id=uid, payload={}) for uid in (1, 1, 2, 3)])
+    db.commit()
+    assert _counter_keys(db) == [1, 2, 3]
+    assert pending_count(db, 1) == 2
+    assert pending_count(db) == 4
+
+    settle_pending(db, lock_queue_rows(db, OutgoingQueue.target_user_id == 1))
+    db.commit()
+    assert pending_count(db, 1) == 0
+    assert pending_count(db) == 2
+
+
+def test_ensure_seeds_empty_table_once(engine, db):
+    db.add_all([OutgoingQueue(target_user_id=uid, payload={}) for uid in (4, 5)])
+    db.commit()
+    db.query(OutgoingPendingCounter).delete()
+    db.commit()
+
+    with engine.connect() as conn:
+        assert ensure_pending_counters(conn) is True
+    assert _counter_keys(db) == [4, 5]
+    assert pending_count(db) == 2
+
+    with engine.connect() as conn:
+        assert ensure_pending_counters(conn) is False
+    assert pending_count(db) == 2
@@ -0,0 +1,116 @@
+# tests/test_delivery.py
+"""投递引擎一轮的三种结果（成功 / 退避重试 / 死信）只作用于本进程仍持有租约、尚未投递的行。"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, update
+
+from shared.models import OutgoingDeadLetter, OutgoingQueue
+from mcp.delivery import DeliveryEngine
+from mcp.outgoing import delivery_owner
+
+NOW = datetime(2025, 10, 18, 8, 0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def delivery(session_factory, clock):
+    return DeliveryEngine(session_factory, clock)
+
+
+def _enqueue(db, n):
+    rows = [OutgoingQueue(target_user_id=7, payload={"n": i}, created_at=NOW - timedelta(minutes=1)) for i in range(n)]
+    db.add_all(rows)
+    db.commit()
+    return [r.id for r in rows]
+
+
+def _failing(errors):
+    """按 queue_id 返回错误（None 表示成功）的回调替身。"""
+    async def post_one(item):
+        return errors.get(item["id"])
+    return post_one
+
+
+def _rows(db):
+    db.expire_all()
+    return {r.id: r for r in db.query(OutgoingQueue)}
+
+
+def test_log_mode_marks_items_delivered(delivery, db):
+    ids = _enqueue(db, 3)
+    res = asyncio.run(delivery.run_once())
+    assert sorted(res["processed"]) == ids
+    assert all(r.delivered and r.lease_owner is None for r in _rows(db).values())
+
+
+def test_http_mode_requires_callback(delivery, db):
+    ids = _enqueue(db, 2)
+    with pytest.raises(ValueError):
+        delivery.configure({"mode": "http"})
+    assert delivery.mode == "log"
+
+    delivery.mode = "http"
+    with pytest.raises(ValueError):
+        asyncio.run(delivery.run_once())
+    rows = _rows(db)
+    assert sorted(rows) == ids
+    assert not any(r.delivered or r.lease_owner for r in rows.values())
+
+
+def test_failures_back_off_then_move_to_dead_letter(delivery, db, clock, monkeypatch):
+    delivery.configure({"mode": "http", "callback": "http://callback.invalid/", "max_attempts": 2})
+    ok, bad = _enqueue(db, 2)
+    monkeypatch.setattr(delivery, "_post_one", _failing({bad: "boom"}))
+
+    res = asyncio.run(delivery.run_once())
+    assert res["processed"] == [ok] and res["failed"] == [bad]
+    retry = _rows(db)[bad]
+    assert retry.attempts == 1 and retry.last_error == "boom"
+    assert retry.lease_owner is None and retry.next_attempt_at > NOW
+
+    # 退避期内不再认领
+    assert asyncio.run(delivery.run_once())["claimed"] == 0
+
+    clock.now = retry.next_attempt_at + timedelta(seconds=1)
+    res = asyncio.run(delivery.run_once())
+    assert res["dead_lettered"] == [bad]
+    assert bad not in _rows(db)
+    dead = db.execute(select(OutgoingDeadLetter)).scalar_one()
+    assert (dead.queue_id, dead.attempts, dead.last_error) == (bad, 2, "boom")
+
+
+def test_commit_skips_rows_no_longer_owned(delivery, db):
+    delivery.max_attempts = 2
+    stolen_ok, stolen_retry, stolen_dead, acked = ids = _enqueue(db, 4)
+    items = delivery._claim()
+    for item in items:
+        if item["id"] == stolen_dead:
+            item["attempts"] = 1
+    # 租约过期后被别的投递者认领，或已被终端确认
+    db.execute(update(OutgoingQueue).where(OutgoingQueue.id.in_([stolen_ok, stolen_retry, stolen_dead]))
+               .values(lease_owner="other"))
+    db.execute(update(OutgoingQueue).where(OutgoingQueue.id == acked).values(delivered=True))
+    db.commit()
+
+    summary = delivery._commit(items, {stolen_ok: None, stolen_retry: "boom", stolen_dead: "boom", acked: "boom"})
+    assert summary == {"processed": [], "failed": [], "dead_lettered": []}
+    rows = _rows(db)
+    assert sorted(rows) == ids
+    assert all(rows[i].lease_owner == "other" and rows[i].attempts == 0 for i in (stolen_ok, stolen_retry, stolen_dead))
+    assert not rows[stolen_ok].delivered
+    assert rows[acked].lease_owner == delivery_owner() and rows[acked].attempts == 0
+    assert db.execute(select(OutgoingDeadLetter)).first() is None
@@ -0,0 +1,146 @@
+# tests/test_fanout.py
+"""群发任务按 user id 分块推进 cursor：失败的块从 cursor 处重试，已有同内容未投递项的用户跳过。"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+import mcp.fanout as fanout
+from shared.models import FanoutJob, OutgoingQueue, User, UserRole
+from mcp.fanout import FanoutWorker, audience_filter, create_job, roster_audience
+from mcp.outgoing import get_or_create_payload
+from mcp.roster import roster_cache
+
+NOW = datetime(2025, 10, 18, 8, 0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def worker(session_factory, clock):
+    w = FanoutWorker(session_factory, clock)
+    w.chunk_size = 2
+    return w
+
+
+def _users(db, specs):
+    """specs: [(class_id, role), ...]，返回按插入顺序的 user id。"""
+    users = [User(username=f"u{i}", password_hash="x", class_id=class_id, role=role)
+             for i, (class_id, role) in enumerate(specs)]
+    db.add_all(users)
+    db.commit()
+    return [u.id for u in users]
+
+
+def _job(db, audience=None):
+    payload_id = get_or_create_payload(db, {"type": "notice", "title": "t"}, NOW)
+    job = create_job(db, "notice", payload_id, audience or {}, NOW)
+    db.commit()
+    return job.id, payload_id
+
+
+def _targets(db, payload_id):
+    return db.execute(
+        select(OutgoingQueue.target_user_id).where(OutgoingQueue.payload_id == payload_id)
+        .order_by(OutgoingQueue.target_user_id)
+    ).scalars().all()
+
+
+def test_failed_chunk_resumes_from_cursor(worker, clock, db, monkeypatch):
+    uids = _users(db, [(1, UserRole.student)] * 5)
+    job_id, payload_id = _job(db)
+
+    real = fanout.bulk_enqueue
+    calls = []
+
+    def fail_second_chunk(*args, **kwargs):
+        calls.append(args[1])
+        if len(calls) == 2:
+            raise RuntimeError("boom")
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(fanout, "bulk_enqueue", fail_second_chunk)
+    assert worker.run_pending() == 1
+
+    job = db.get(FanoutJob, job_id)
+    assert (job.status, job.cursor, job.attempts, job.enqueued) == ("running", uids[1], 1, 2)
+    assert "boom" in job.error
+    assert _targets(db, payload_id) == uids[:2]
+
+    # 失败后短暂保留租约，期满后从 cursor 继续
+    db.expire_all()
+    assert worker.run_pending() == 0
+    clock.now += timedelta(seconds=worker.poll_interval + 1)
+    assert worker.run_pending() == 1
+
+    db.expire_all()
+    job = db.get(FanoutJob, job_id)
+    assert (job.status, job.enqueued, job.attempts, job.error) == ("done", 5, 0, None)
+    assert _targets(db, payload_id) == uids
+    assert calls[2] == uids[2:4]
+
+
+def test_skips_targets_with_pending_row(worker, db):
+    uids = _users(db, [(1, UserRole.student)] * 3)
+    job_id, payload_id = _job(db)
+    db.add(OutgoingQueue(target_user_id=uids[1], payload_id=payload_id, created_at=NOW))
+    db.commit()
+
+    worker.run_pending()
+
+    job = db.get(FanoutJob, job_id)
+    assert (job.status, job.total, job.enqueued, job.skipped) == ("done", 3, 2, 1)
+    assert _targets(db, payload_id) == uids
+
+
+def test_audience_combine(db):
+    s1, t1, s2 = _users(db, [(1, UserRole.student), (1, UserRole.teacher), (2, UserRole.student)])
+    audience = {"class_ids": [1], "roles": [UserRole.student.value]}
+
+    def match(combine):
+        cond = audience_filter(dict(audience, combine=combine))
+        return db.execute(select(User.id).where(cond).order_by(User.id)).scalars().all()
+
+    assert match("and") == [s1]
+    assert match("or") == [s1, t1, s2]
+    assert audience_filter({}) is None
+
+    # 班级 AND 角色走花名册缓存，结果与 users 表查询一致；OR / 全体仍查 users 表
+    roster_cache.invalidate_class()
+    assert roster_audience(db, dict(audience, combine="and")) == match("and")
+    assert roster_audience(db, {"class_ids": [1, 2]}) == [s1, t1, s2]
+    assert roster_audience(db, dict(audience, combine="or")) is None
+    assert roster_audience(db, {"roles": [UserRole.student.value]}) is None
+
+
+def test_job_fails_after_max_attempts(worker, clock, db, monkeypatch):
+    _users(db, [(1, UserRole.student)] * 3)
+    job_id, payload_id = _job(db)
+    worker.max_attempts = 2
+
+    def always_fail(*args, **kwargs):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(fanout, "bulk_enqueue", always_fail)
+    worker.run_pending()
+    clock.now += timedelta(seconds=worker.poll_interval + 1)
+    worker.run_pending()
+
+    job = db.get(FanoutJob, job_id)
+    assert (job.status, job.attempts, job.cursor) == ("failed", 2, 0)
+    assert job.finished_at == clock.now
+    # 失败的任务不再被认领
+    clock.now += timedelta(seconds=worker.poll_interval + 1)
+    assert worker.run_pending() == 0
+    assert db.execute(select(func.count()).select_from(OutgoingQueue)).scalar() == 0
@@ -0,0 +1,87 @@
+# tests/test_leader.py
+"""领导者租约：同一时刻只有一个持有者，续约延长租约，过期或主动释放后其它进程接管。"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from shared.models import SchedulerLease
+from mcp.leader import LeaderElector
+
+NOW = datetime(2025, 10, 18, 8, 0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def electors(session_factory, clock):
+    a = LeaderElector(session_factory, clock)
+    b = LeaderElector(session_factory, clock)
+    a.owner, b.owner = "worker-a", "worker-b"
+    return a, b
+
+
+def _lease(db):
+    db.expire_all()
+    return db.get(SchedulerLease, "scheduler")
+
+
+def test_only_one_holder_until_expiry(electors, clock, db):
+    a, b = electors
+    assert a.try_acquire() is True
+    assert b.try_acquire() is False
+
+    # 续约：租约从本次续约时刻重新计算
+    clock.now += timedelta(seconds=a.lease_seconds - 1)
+    assert a.try_acquire() is True
+    assert _lease(db).leased_until == clock.now + timedelta(seconds=a.lease_seconds)
+    clock.now += timedelta(seconds=a.lease_seconds - 1)
+    assert b.try_acquire() is False
+
+    # a 停止续约，过期后 b 接管
+    clock.now += timedelta(seconds=2)
+    assert b.try_acquire() is True
+    lease = _lease(db)
+    assert (lease.owner, lease.acquired_at) == ("worker-b", clock.now)
+    assert a.try_acquire() is False
+
+
+def test_release_allows_immediate_takeover(electors, db):
+    a, b = electors
+    assert a.try_acquire() is True
+    b.release()  # 非持有者释放不影响租约
+    assert b.try_acquire() is False
+    a.release()
+    assert b.try_acquire() is True
+
+
+def test_callbacks_follow_leadership(electors):
+    a, _ = electors
+    events = []
+
+    async def start():
+        events.append("start")
+
+    async def stop():
+        events.append("stop")
+
+    a.register(start, stop)
+
+    async def run():
+        await a._elect()
+        await a._demote()
+
+    asyncio.run(run())
+    assert events == ["start", "stop"]
+    assert a.status()["changes"] == 2
@@ -0,0 +1,40 @@
+# tests/test_lookup_cache.py
+"""标识解析缓存：LRU 淘汰、负缓存，以及查询期间发生的失效不会被旧结果覆盖。"""
+from mcp.db import LookupCache, _cached_lookup
+
+
+def test_lru_eviction_and_negative_ttl():
+    cache = LookupCache(maxsize=2, ttl=60, negative_ttl=0)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # b 最久未用，被淘汰
+    assert cache.get("b") is LookupCache._MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+    cache.put("missing", None)  # negative_ttl=0：查不到的结果不留在缓存里
+    assert cache.get("missing") is LookupCache._MISSING
+
+
+def test_invalidation_during_lookup_skips_put():
+    cache = LookupCache()
+
+    def stale_query():
+        # 查询进行中另一请求改了该用户的 external_id 并失效缓存
+        cache.invalidate("ext-1")
+        return 42
+
+    assert _cached_lookup(cache, "ext-1", stale_query) == 42
+    assert cache.get("ext-1") is LookupCache._MISSING
+
+    assert _cached_lookup(cache, "ext-1", lambda: 43) == 43
+    assert _cached_lookup(cache, "ext-1", lambda: 44) == 43
+
+
+def test_clear_all_bumps_every_key():
+    cache = LookupCache()
+    version = cache.version("x")
+    cache.invalidate()
+    cache.put("x", 1, version)
+    assert cache.get("x") is LookupCache._MISSING
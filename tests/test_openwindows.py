@@ -0,0 +1,98 @@
+# tests/test_openwindows.py
+"""开放时段编译为一周分钟位图；加载期间发生失效时不把旧数据写回缓存。"""
+from datetime import datetime
+
+import pytest
+
+from shared.models import OpenWindow, User, UserRole
+from mcp.openwindows import OpenWindowSchedule, compile_window, minute_of_week
+
+MON = datetime(2025, 10, 13)  # 周一
+
+
+def _at(day, hm):
+    h, m = map(int, hm.split(":"))
+    return minute_of_week(MON.replace(day=MON.day + day, hour=h, minute=m))
+
+
+def _open(bits, day, hm):
+    return bool((bits >> _at(day, hm)) & 1)
+
+
+def test_compile_window_semantics():
+    bits = compile_window("08:00", "09:00", '["Mon"]')
+    assert _open(bits, 0, "08:00") and _open(bits, 0, "08:59")
+    assert not _open(bits, 0, "09:00") and not _open(bits, 1, "08:30")
+
+    # 跨午夜：周日 23:00 起到周一 01:00（一周末尾回绕）
+    bits = compile_window("23:00", "01:00", '["Sun"]')
+    assert _open(bits, 6, "23:30") and _open(bits, 0, "00:30")
+    assert not _open(bits, 0, "01:00")
+
+    # start == end 全天；days 为空表示每天
+    assert _open(compile_window("07:00", "07:00", '["Tue"]'), 1, "03:00")
+    assert all(_open(compile_window("12:00", "13:00", None), d, "12:30") for d in range(7))
+
+
+@pytest.fixture
+def schedule():
+    return OpenWindowSchedule()
+
+
+def _window(db, class_id, start, end):
+    w = OpenWindow(class_id=class_id, start_time=start, end_time=end, days_json=None)
+    db.add(w)
+    db.commit()
+    return w.id
+
+
+def test_invalidate_class_reloads(schedule, db):
+    _window(db, 1, "08:00", "09:00")
+    noon = MON.replace(hour=12)
+    assert not schedule.class_open_at(db, 1, noon)
+    wid = _window(db, 1, "11:00", "13:00")
+    # 缓存未过期：仍是旧结果
+    assert not schedule.class_open_at(db, 1, noon)
+    schedule.invalidate_class(1)
+    assert schedule.windows_open_at(db, 1, noon) == [wid]
+
+
+def test_invalidate_during_load_skips_put(schedule, db, monkeypatch):
+    _window(db, 1, "08:00", "09:00")
+    real = schedule._load_class
+
+    def load_then_invalidate(db_, class_id):
+        result = real(db_, class_id)
+        schedule.invalidate_class(class_id)
+        return result
+
+    monkeypatch.setattr(schedule, "_load_class", load_then_invalidate)
+    schedule.class_open_at(db, 1, MON)
+    assert schedule.stats()["classes"] == 0
+
+
+def test_user_class_cache_invalidation(schedule, db):
+    # 注册前按该 id 查询，缓存为“无班级”
+    assert schedule.class_for_user(db, 1) is None
+    user = User(id=1, username="s", password_hash="x", role=UserRole.student, class_id=3)
+    db.add(user)
+    db.commit()
+    assert schedule.class_for_user(db, user.id) is None
+    schedule.invalidate_user(user.id)
+    assert schedule.class_for_user(db, user.id) == 3
+
+
+def test_invalidate_user_during_load_skips_put(schedule, db):
+    user = User(username="s", password_hash="x", role=UserRole.student, class_id=3)
+    db.add(user)
+    db.commit()
+
+    class InvalidatingSession:
+        """查询前模拟另一线程修改了用户并失效缓存。"""
+
+        def __getattr__(self, name):
+            schedule.invalidate_user(user.id)
+            return getattr(db, name)
+
+    assert schedule.class_for_user(InvalidatingSession(), user.id) == 3
+    assert schedule.stats()["users"] == 0
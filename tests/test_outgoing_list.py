@@ -0,0 +1,34 @@
+# tests/test_outgoing_list.py
+"""管理列表的排序 / 游标条件基于 priority_rank 实列：写入时自动取值，查询按索引顺序读、不额外排序。"""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert, text
+
+from shared.models import OutgoingQueue
+from mcp.outgoing import keyset_filter, list_order
+
+
+def test_priority_rank_set_on_insert(db):
+    db.add(OutgoingQueue(target_user_id=1, payload={}, priority="urgent"))
+    db.add(OutgoingQueue(target_user_id=1, payload={}))
+    db.execute(insert(OutgoingQueue), [{"target_user_id": 2, "payload": {}, "priority": "urgent"},
+                                       {"target_user_id": 2, "payload": {}, "priority": "normal"}])
+    db.commit()
+    ranks = db.query(OutgoingQueue.priority, OutgoingQueue.priority_rank).order_by(OutgoingQueue.id).all()
+    assert [tuple(r) for r in ranks] == [("urgent", 1), ("normal", 0), ("urgent", 1), ("normal", 0)]
+
+
+@pytest.mark.parametrize("target_user_id", [None, 3])
+@pytest.mark.parametrize("cursor", [None, (0, datetime(2025, 10, 18), 10)])
+def test_list_query_reads_in_index_order(db, target_user_id, cursor):
+    q = db.query(OutgoingQueue)
+    if target_user_id is not None:
+        q = q.filter(OutgoingQueue.target_user_id == target_user_id)
+    if cursor is not None:
+        q = q.filter(keyset_filter(cursor))
+    q = q.order_by(*list_order()).limit(21)
+    sql = q.statement.compile(db.get_bind(), compile_kwargs={"literal_binds": True})
+    plan = " | ".join(r[-1] for r in db.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+    assert "rank_created" in plan
+    assert "TEMP B-TREE" not in plan
@@ -0,0 +1,65 @@
+# tests/test_quotes.py
+"""每日一句定时器：按计划时间出堆；其它 worker 的修改通过 daily_quotes 的变更指纹发现。"""
+from datetime import datetime
+
+import pytest
+
+from shared.models import DailyQuote
+from mcp.quotes import DailyQuoteScheduler
+
+NOW = datetime(2025, 10, 18, 7, 0)
+
+
+@pytest.fixture
+def scheduler(session_factory):
+    return DailyQuoteScheduler(session_factory, lambda: NOW, lambda quote_id, day: 0)
+
+
+def _quote(db, broadcast_time, class_id=1):
+    q = DailyQuote(class_id=class_id, content="c", broadcast_time=broadcast_time, active=True)
+    db.add(q)
+    db.commit()
+    return q
+
+
+def _planned(scheduler):
+    return {n["quote_id"]: n["at"] for n in scheduler.status()["next"]}
+
+
+def test_pop_due_fires_once_and_reschedules(scheduler, db):
+    q = _quote(db, "08:00")
+    assert scheduler.reload_all() == 1
+    assert scheduler._pop_due(datetime(2025, 10, 18, 7, 59)) == []
+    assert scheduler._pop_due(datetime(2025, 10, 18, 8, 0)) == [(datetime(2025, 10, 18, 8, 0), q.id)]
+    assert scheduler._pop_due(datetime(2025, 10, 18, 8, 1)) == []
+    assert _planned(scheduler) == {q.id: "2025-10-19T08:00:00"}
+
+
+def test_check_changes_picks_up_other_workers_edits(scheduler, db):
+    q = _quote(db, "08:00")
+    scheduler.reload_all()
+    assert scheduler.check_changes() is False
+
+    # 其它 worker 修改时间 / 新建 quote：只改库，不调用本进程的 reload_quote
+    q.broadcast_time = "09:30"
+    db.commit()
+    assert scheduler.check_changes() is True
+    assert _planned(scheduler) == {q.id: "2025-10-18T09:30:00"}
+
+    q2 = _quote(db, "10:00", class_id=2)
+    assert scheduler.check_changes() is True
+    assert set(_planned(scheduler)) == {q.id, q2.id}
+
+    db.delete(q2)
+    db.commit()
+    assert scheduler.check_changes() is True
+    assert set(_planned(scheduler)) == {q.id}
+
+
+def test_reload_quote_skipped_when_not_running(scheduler, db):
+    q = _quote(db, "08:00")
+    scheduler.reload_all()
+    q.active = False
+    db.commit()
+    scheduler.reload_quote(q.id)
+    assert scheduler.status()["scheduled"] == 1
@@ -0,0 +1,57 @@
+# tests/test_retention.py
+"""保留策略：超过 TTL 的已投递行按批搬到归档表，未投递 / 未到期的留在热表；归档超期后清理。"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from shared.models import OutgoingQueue, OutgoingQueueArchive
+from mcp.retention import RetentionManager
+
+NOW = datetime(2025, 10, 18, 8, 0)
+
+
+@pytest.fixture
+def retention(session_factory):
+    mgr = RetentionManager(session_factory, lambda: NOW)
+    mgr.delivered_ttl_hours = 72
+    mgr.archive_ttl_days = 30
+    return mgr
+
+
+def _add(db, delivered_at=None, created_at=NOW - timedelta(days=5)):
+    row = OutgoingQueue(target_user_id=1, payload={"k": 1}, created_at=created_at,
+                        delivered=delivered_at is not None, delivered_at=delivered_at)
+    db.add(row)
+    db.commit()
+    return row.id
+
+
+def test_archive_moves_only_expired_delivered_rows_in_batches(retention, db):
+    old = [_add(db, NOW - timedelta(hours=100)) for _ in range(5)]
+    recent = _add(db, NOW - timedelta(hours=1))
+    pending = _add(db)
+
+    retention.batch_size, retention.max_batches = 2, 2
+    assert retention.archive_delivered() == 4  # 每轮最多 2 批 x 2 行，剩余的留给下一轮
+    assert retention.archive_delivered() == 1
+
+    db.expire_all()
+    assert sorted(r.id for r in db.query(OutgoingQueue)) == [recent, pending]
+    archived = db.query(OutgoingQueueArchive).order_by(OutgoingQueueArchive.id).all()
+    assert [a.id for a in archived] == old
+    assert all(a.archived_at == NOW and a.payload == {"k": 1} for a in archived)
+
+
+def test_run_once_purges_expired_archive_rows(retention, db):
+    db.add_all([
+        OutgoingQueueArchive(id=1, created_at=NOW - timedelta(days=40), target_user_id=1, payload={},
+                             archived_at=NOW - timedelta(days=35)),
+        OutgoingQueueArchive(id=2, created_at=NOW - timedelta(days=10), target_user_id=1, payload={},
+                             archived_at=NOW - timedelta(days=5)),
+    ])
+    db.commit()
+    res = asyncio.run(retention.run_once())
+    assert res["archived"] == 0 and res["purged"] == 1
+    db.expire_all()
+    assert [a.id for a in db.query(OutgoingQueueArchive)] == [2]
@@ -0,0 +1,65 @@
+# tests/test_roster.py
+"""花名册缓存按 TTL / 显式失效重新加载；加载期间被失效的结果不写回缓存。"""
+import pytest
+from sqlalchemy import insert
+
+from shared.models import User, UserRole, parent_students
+from mcp.roster import RosterCache
+
+
+@pytest.fixture
+def roster():
+    return RosterCache()
+
+
+def _user(db, name, role, class_id=None, managed_class_id=None):
+    u = User(username=name, password_hash="x", role=role, class_id=class_id, managed_class_id=managed_class_id)
+    db.add(u)
+    db.commit()
+    return u
+
+
+def test_members_and_teachers(roster, db):
+    s = _user(db, "s", UserRole.student, class_id=1)
+    p = _user(db, "p", UserRole.parent, class_id=1)
+    t = _user(db, "t", UserRole.teacher, managed_class_id=1)
+    assert roster.member_ids(db, 1) == [s.id, p.id]
+    assert roster.member_ids(db, 1, UserRole.student) == [s.id]
+    assert [m.id for m in roster.teachers(db, 1)] == [t.id]
+
+    s2 = _user(db, "s2", UserRole.student, class_id=1)
+    assert roster.member_ids(db, 1, "student") == [s.id]
+    roster.invalidate_user(s2)
+    assert roster.member_ids(db, 1, "student") == [s.id, s2.id]
+    assert roster.stats()["hits"] == 3
+
+
+def test_invalidate_class_during_load_skips_put(roster, db):
+    _user(db, "s", UserRole.student, class_id=1)
+
+    class InvalidatingSession:
+        def execute(self, stmt):
+            roster.invalidate_class(1)
+            return db.execute(stmt)
+
+    roster.members(InvalidatingSession(), 1)
+    assert roster.stats()["classes"] == 0
+    roster.members(db, 1)
+    assert roster.stats()["classes"] == 1
+
+
+def test_invalidate_links_during_load_skips_put(roster, db):
+    p = _user(db, "p", UserRole.parent, class_id=1)
+    s = _user(db, "s", UserRole.student, class_id=1)
+
+    class InvalidatingSession:
+        def execute(self, stmt):
+            roster.invalidate_links(parent_id=p.id, student_id=s.id)
+            return db.execute(stmt)
+
+    assert roster.children_of(InvalidatingSession(), p.id) == ()
+    db.execute(insert(parent_students).values(parent_id=p.id, student_id=s.id))
+    db.commit()
+    assert roster.children_of(db, p.id) == (s.id,)
+    assert roster.parents_of(db, s.id) == (p.id,)
+    assert roster.stats()["child_links"] == 1
@@ -0,0 +1,94 @@
+# tests/test_upgrade_schema.py
+"""
+upgrade_schema 在已有（基线结构）的库上补列，并按列的 info["backfill"] 回填由已有数据推出的值；
+表的 info["retired_indexes"] 中的旧索引会被删除。补列后 dedupe_key 唯一索引必须补建，重复入队被挡掉。
+"""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, func, inspect, select, text
+from sqlalchemy.orm import sessionmaker
+
+from shared.models import OutgoingQueue
+import mcp.db as mdb
+from mcp.outgoing import enqueue_deduped
+
+# 基线版本的 outgoing_queue（无 dedupe_key / 租约 / 重试 / priority_rank 等列）
+BASELINE_OUTGOING_QUEUE = """
+CREATE TABLE outgoing_queue (
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    target_user_id INTEGER NOT NULL,
+    payload JSON NOT NULL,
+    priority VARCHAR(16) DEFAULT 'normal' NOT NULL,
+    deliver_after DATETIME,
+    delivered BOOLEAN DEFAULT '0' NOT NULL,
+    created_at DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+    delivered_at DATETIME
+)
+"""
+
+
+@pytest.fixture
+def baseline_engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(BASELINE_OUTGOING_QUEUE))
+        conn.execute(text("CREATE INDEX ix_outgoing_queue_target_user_id ON outgoing_queue (target_user_id)"))
+    monkeypatch.setattr(mdb, "engine", engine)
+    yield engine
+    engine.dispose()
+
+
+def test_upgrade_backfills_priority_rank(baseline_engine):
+    with baseline_engine.begin() as conn:
+        conn.execute(text("INSERT INTO outgoing_queue (target_user_id, payload, priority) "
+                          "VALUES (1, '{}', 'urgent'), (1, '{}', 'normal')"))
+    mdb.init_db()
+    with baseline_engine.connect() as conn:
+        ranks = conn.execute(text("SELECT priority, priority_rank FROM outgoing_queue ORDER BY id")).all()
+    assert [tuple(r) for r in ranks] == [("urgent", 1), ("normal", 0)]
+
+
+def test_upgrade_drops_retired_payload_index(baseline_engine):
+    mdb.init_db()
+    # 之前版本的模型在 payload_id 上建过单列索引
+    with baseline_engine.begin() as conn:
+        conn.execute(text("CREATE INDEX ix_outgoing_queue_payload_id ON outgoing_queue (payload_id)"))
+    mdb.upgrade_schema()
+    names = {i["name"] for i in inspect(baseline_engine).get_indexes("outgoing_queue")}
+    assert "ix_outgoing_queue_payload_id" not in names
+    assert "ix_outgoing_payload_target" in names
+
+
+@pytest.fixture
+def upgraded_engine(baseline_engine):
+    mdb.init_db()
+    yield baseline_engine
+
+
+def test_upgrade_creates_dedupe_unique_index(upgraded_engine):
+    insp = inspect(upgraded_engine)
+    unique = [i["column_names"] for i in insp.get_indexes("outgoing_queue") if i["unique"]]
+    unique += [u["column_names"] for u in insp.get_unique_constraints("outgoing_queue")]
+    assert ["dedupe_key"] in unique
+
+
+def test_second_enqueue_with_same_key_inserts_nothing(upgraded_engine):
+    Session = sessionmaker(bind=upgraded_engine)
+    row = {
+        "target_user_id": 7,
+        "payload": {"type": "memo_reminder", "memo_id": 1},
+        "priority": "normal",
+        "created_at": datetime(2025, 10, 18, 8, 0),
+        "dedupe_key": "memo:2025-10-18:1",
+    }
+    with Session() as db:
+        assert enqueue_deduped(db, [dict(row)]) == 1
+        db.commit()
+    with Session() as db:
+        assert enqueue_deduped(db, [dict(row)]) == 0
+        db.commit()
+    with Session() as db:
+        count = db.execute(select(func.count()).select_from(OutgoingQueue)
+                           .where(OutgoingQueue.dedupe_key == row["dedupe_key"])).scalar()
+    assert count == 1
@@ -55,7 +55,7 @@ const SoupManager: React.FC<SoupManagerProps> = ({ userRole, requesterId, classI
     try {
       const resp = await api.post(`/mcp/trigger_daily_quote/${soup.id}`);
       if (resp.data?.status === 'success') {
-        message.success(`成功为 ${resp.data.enqueued} 个用户触发了鸡汤！`);
+        message.success(`已创建推送任务 #${resp.data.job_id}，鸡汤将在后台发送给班级用户`);
       } else {
         message.error('触发失败: ' + resp.data?.detail);
       }